@@ -0,0 +1,462 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT, 'server')
+CLIENT_DIR = os.path.join(ROOT, 'client')
+SCENARIOS = ('echo', 'pipeline', 'download', 'upload', 'udpdownload', 'udpupload', 'restore', 'tree')
+
+"""
+# Loopback benchmark #
+Runs real server and real client on 127.0.0.1 for every point of the sweep
+(engine x SERVER_PACKET_SIZE x PACKETS_PER_CHECK x ENABLE_CHECK) and every scenario:
+echo          small command round trip
+pipeline      --echo-count echo commands as pipelined requests, latency is time of all of them / count
+download      TCP download of --size bytes          upload       TCP upload of --size bytes
+udpdownload   UDP download of --size bytes          udpupload    UDP upload of --size bytes
+restore       client drops connection halfway through download, reconnects and restores the rest,
+              latency is reconnect + restore, run where nothing was left to restore fails
+tree          listing of --tree-files files, first run builds directory index
+With --allocations server runs under tracemalloc and client traces its own allocations, every transfer reports
+how far traced memory of both sides peaked during it. TCP transfers must stay flat however big --size is
+(receive loops reuse one buffer), UDP ones grow by a few bytes of bitmap and send time per chunk.
+Tracing slows both sides down a lot, throughput of such runs isn't comparable with plain ones.
+Every scenario gets fresh server process, client runs in a worker process of its own,
+so CPU time and peak RSS of both sides belong to that scenario only.
+Prints one JSON object per line (scenario, config, throughput, latency percentiles, cpu, peak RSS),
+progress goes to stderr.
+"""
+
+
+def parse_size(value: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().removesuffix('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_list(value: str, cast=str) -> list:
+    return [cast(item) for item in value.split(',') if item]
+
+
+# Nearest rank percentile
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def free_port(kind: int) -> int:
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_version() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def maxrss_kb(usage) -> int:
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def write_random(path: str, size: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        left = size
+        while left:
+            chunk = os.urandom(min(left, 1024 * 1024))
+            file.write(chunk)
+            left -= len(chunk)
+
+
+# None until server renames finished upload into place
+def uploaded_size(path: str) -> int | None:
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+
+# Server under tracemalloc, SIGUSR1 writes to file given as argument how far traced memory peaked
+# above what was allocated at previous signal
+TRACED_SERVER = '''
+import os, runpy, signal, sys, tracemalloc
+path = sys.argv[1]
+tracemalloc.start()
+base = 0
+def report(signum, frame):
+    global base
+    current, peak = tracemalloc.get_traced_memory()
+    with open(path + '.tmp', 'w') as file:
+        file.write(str(peak - base))
+    os.replace(path + '.tmp', path)
+    tracemalloc.reset_peak()
+    base = current
+signal.signal(signal.SIGUSR1, report)
+sys.argv = ['server.py']
+runpy.run_path('server.py', run_name='__main__')
+'''
+
+
+# Peak of memory server allocated since last call, None if server didn't answer
+def server_traced_peak(pid: int, path: str) -> int | None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except ProcessLookupError:
+        return None
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            with open(path) as file:
+                return int(file.read())
+        time.sleep(0.01)
+    return None
+
+
+def make_tree(root: str, files: int):
+    # About 100 files per directory, two levels deep
+    for i in range(files):
+        directory = os.path.join(root, f'd{i // 10000}', f's{i // 100 % 100}')
+        if i % 100 == 0:
+            os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, f'f{i}.txt'), 'wb').close()
+
+
+class ProcessStats:
+    """CPU time and peak RSS of server process, from /proc while it runs, from wait4 after it exits"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.tick = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def cpu(self) -> tuple[float, float] | None:
+        try:
+            with open(f'/proc/{self.pid}/stat') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return int(fields[11]) / self.tick, int(fields[12]) / self.tick
+
+    def peak_rss_kb(self) -> int | None:
+        try:
+            with open(f'/proc/{self.pid}/status') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.work = args.workdir or tempfile.mkdtemp(prefix='spolks-bench-')
+        self.server_path = os.path.join(self.work, 'srv') + '/'
+        self.client_path = os.path.join(self.work, 'cli') + '/'
+        self.meta = {'version': git_version(), 'python': platform.python_version(), 'platform': platform.platform()}
+
+    def prepare(self):
+        write_random(os.path.join(self.server_path, 'bench', 'data.bin'), self.args.size)
+        write_random(os.path.join(self.client_path, 'bench', 'up.bin'), self.args.size)
+        os.makedirs(os.path.join(self.client_path, 'got'), exist_ok=True)
+        os.makedirs(os.path.join(self.server_path, 'got'), exist_ok=True)
+        if 'tree' in self.args.scenarios:
+            make_tree(os.path.join(self.server_path, 'tree'), self.args.tree_files)
+
+    def env(self, engine: str, packet_size: int, packets_per_check: int, enable_check: bool,
+            chunk_tuning: str) -> dict:
+        port, udp_port = free_port(socket.SOCK_STREAM), free_port(socket.SOCK_DGRAM)
+        return dict(
+            os.environ,
+            SERVER_IP='127.0.0.1', SERVER_PORT=str(port), SERVER_UDP_PORT=str(udp_port), CLIENT_IP='127.0.0.1',
+            SERVER_ENGINE=engine, SERVER_FILES_PATH=self.server_path, CLIENT_FILES_PATH=self.client_path,
+            SERVER_PACKET_SIZE=str(packet_size), CLIENT_PACKET_SIZE=str(packet_size),
+            PACKETS_PER_CHECK=str(packets_per_check), ENABLE_CHECK='true' if enable_check else 'false',
+            SERVER_MAX_CONNECTIONS='64', SERVER_DEBUG_LOADING='false', CLIENT_DEBUG_LOADING='false',
+            SERVER_ZERO_COPY='true' if self.args.zero_copy else 'false', DELTA_SYNC='false',
+            COMPRESSION=self.args.compression, SERVER_SESSION_JOURNAL=os.path.join(self.work, 'journal'),
+            SERVER_METRICS_FILE=os.path.join(self.work, 'metrics.prom'),
+            CLIENT_SESSION_FILE=os.path.join(self.work, 'session'), SERVER_PROGRESS=self.args.progress,
+            CHUNK_TUNING=chunk_tuning, MAX_PACKET_SIZE=str(max(packet_size, self.args.max_packet_size)),
+            SOCKET_BUFFER_SIZE='0',
+        )
+
+    def start_server(self, env: dict) -> subprocess.Popen:
+        log = open(os.path.join(self.work, 'server.log'), 'ab')
+        if self.args.allocations:
+            command = [sys.executable, '-c', TRACED_SERVER, os.path.join(self.work, 'traced')]
+        else:
+            command = [sys.executable, 'server.py']
+        server = subprocess.Popen(command, cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=log)
+        log.close()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                break
+            try:
+                socket.create_connection(('127.0.0.1', int(env['SERVER_PORT'])), timeout=1).close()
+                return server
+            except OSError:
+                time.sleep(0.05)
+        server.kill()
+        raise RuntimeError(f'Server did not start, see {self.work}/server.log')
+
+    def run(self, out):
+        self.prepare()
+        sweep = itertools.product(self.args.engines, self.args.packet_sizes, self.args.packets_per_check,
+                                  self.args.enable_check, self.args.chunk_tuning)
+        for engine, packet_size, packets_per_check, enable_check, chunk_tuning in sweep:
+            config = {'engine': engine, 'packet_size': packet_size, 'packets_per_check': packets_per_check,
+                      'enable_check': enable_check, 'chunk_tuning': chunk_tuning, 'compression': self.args.compression,
+                      'zero_copy': self.args.zero_copy, 'progress': self.args.progress}
+            for scenario in self.args.scenarios:
+                print(f'{scenario} {config}', file=sys.stderr, flush=True)
+                env = self.env(engine, packet_size, packets_per_check, enable_check, chunk_tuning)
+                record = self.measure(scenario, env)
+                out.write(json.dumps({'scenario': scenario, 'config': config, **record, **self.meta}) + '\n')
+                out.flush()
+
+    def measure(self, scenario: str, env: dict) -> dict:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(env['CLIENT_SESSION_FILE'])
+        spec_path = os.path.join(self.work, 'spec.json')
+        result_path = os.path.join(self.work, 'result.json')
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(result_path)
+        server = self.start_server(env)
+        with open(spec_path, 'w') as file:
+            json.dump({'scenario': scenario, 'repeat': self.args.repeat, 'echo_count': self.args.echo_count,
+                       'size': self.args.size, 'allocations': self.args.allocations, 'server_pid': server.pid,
+                       'traced_path': os.path.join(self.work, 'traced')}, file)
+        stats = ProcessStats(server.pid)
+        cpu_before = stats.cpu()
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'worker', spec_path, result_path],
+                           cwd=CLIENT_DIR, env=env, stdout=subprocess.DEVNULL, timeout=self.args.timeout)
+            cpu_after = stats.cpu()
+            server_rss = stats.peak_rss_kb()
+        finally:
+            server.send_signal(signal.SIGKILL)
+            _, _, usage = os.wait4(server.pid, 0)
+            # Popen must not wait for pid which is reaped already
+            server.returncode = -signal.SIGKILL
+        if cpu_before is not None and cpu_after is not None:
+            server_cpu = {'user': cpu_after[0] - cpu_before[0], 'system': cpu_after[1] - cpu_before[1]}
+        else:
+            server_cpu = {'user': usage.ru_utime, 'system': usage.ru_stime}
+        try:
+            with open(result_path) as file:
+                result = json.load(file)
+        except (OSError, ValueError):
+            result = {'ok': False, 'latencies': [], 'bytes': 0, 'cpu': None, 'peak_rss_kb': None}
+        return summarize(result, server_cpu, server_rss or maxrss_kb(usage))
+
+
+def summarize(result: dict, server_cpu: dict, server_rss: int) -> dict:
+    latencies = result['latencies']
+    wall = sum(latencies)
+    record = {
+        'ok': result['ok'],
+        'runs': len(latencies),
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000 if latencies else None,
+            'p99': percentile(latencies, 99) * 1000 if latencies else None,
+            'min': min(latencies) * 1000 if latencies else None,
+            'max': max(latencies) * 1000 if latencies else None,
+        },
+        'cpu_s': {'server': server_cpu, 'client': result['cpu']},
+        'peak_rss_kb': {'server': server_rss, 'client': result['peak_rss_kb']},
+    }
+    if result['bytes'] and wall:
+        record['bytes'] = result['bytes']
+        record['throughput_mib_s'] = result['bytes'] / wall / 1024 ** 2
+    else:
+        record['ops_per_s'] = len(latencies) / wall if wall else None
+    for key in ('cold_ms', 'traced_peak_kb'):
+        if key in result:
+            record[key] = result[key]
+    return record
+
+
+# Client side of one scenario, runs in client directory with benchmark environment
+def worker(spec_path: str, result_path: str):
+    with open(spec_path) as file:
+        spec = json.load(file)
+    sys.path.insert(0, CLIENT_DIR)
+    import client as client_module
+
+    def connect():
+        client = client_module.Client()
+        # Headless as server is, progress bar only costs time and memory here
+        client.show_progress = False
+        client.client_ip = client.server_ip = '127.0.0.1'
+        client.server_port = int(os.environ['SERVER_PORT'])
+        client.sock.connect((client.server_ip, client.server_port))
+        client.restore()
+        return client
+
+    def timed(client, cmd: str) -> float:
+        start = time.perf_counter()
+        client.process(cmd)
+        return time.perf_counter() - start
+
+    # Transfer with peak of memory both sides allocated during it noted
+    def traced(client, cmd: str) -> float:
+        if not spec['allocations']:
+            return timed(client, cmd)
+        server_traced_peak(spec['server_pid'], spec['traced_path'])
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        latency = timed(client, cmd)
+        peaks = extra.setdefault('traced_peak_kb', {'server': 0, 'client': 0})
+        server_peak = server_traced_peak(spec['server_pid'], spec['traced_path'])
+        if server_peak is not None:
+            peaks['server'] = max(peaks['server'], server_peak // 1024)
+        peaks['client'] = max(peaks['client'], (tracemalloc.get_traced_memory()[1] - base) // 1024)
+        return latency
+
+    # Download drops its connection once half of the file came, so it never gets to the end on its own
+    def cut_download(client):
+        @contextlib.contextmanager
+        def cut_halfway(total: int):
+            came = 0
+
+            def bar(count: int = 1):
+                nonlocal came
+                came += count
+                if came - count < total // 2 <= came:
+                    client.sock.shutdown(socket.SHUT_RDWR)
+                    # Data already in socket buffer can still be read after shutdown, download stops right here
+                    raise ConnectionAbortedError('Download is cut halfway')
+
+            yield bar
+
+        client.progress_bar = cut_halfway
+        with contextlib.suppress(OSError):
+            client.process('download files/bench/data.bin files/got/data.bin')
+
+    scenario, repeat, size = spec['scenario'], spec['repeat'], spec['size']
+    client_path = os.environ['CLIENT_FILES_PATH']
+    server_path = os.environ['SERVER_FILES_PATH']
+    client = connect()
+    if spec['allocations']:
+        # alive_progress imports its animations when first bar is made, that isn't memory of transfer
+        with client.progress_bar(0):
+            pass
+        tracemalloc.start()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    latencies, total, ok, extra = [], 0, True, {}
+    if scenario == 'echo':
+        latencies = [timed(client, 'echo ping') for _ in range(spec['echo_count'])]
+    elif scenario == 'pipeline':
+        for _ in range(repeat):
+            start = time.perf_counter()
+            replies = client.pipeline(['echo ping'] * spec['echo_count'])
+            latencies.append((time.perf_counter() - start) / spec['echo_count'])
+            ok = ok and replies == ['ping'] * spec['echo_count']
+    elif scenario == 'tree':
+        latencies = [timed(client, 'tree') for _ in range(repeat)]
+        extra['cold_ms'] = latencies[0] * 1000
+    elif scenario in ('download', 'udpdownload'):
+        for _ in range(repeat):
+            latencies.append(traced(client, f'{scenario} files/bench/data.bin files/got/data.bin'))
+            ok = ok and os.path.getsize(client_path + 'got/data.bin') == size
+        total = size * repeat
+    elif scenario in ('upload', 'udpupload'):
+        for _ in range(repeat):
+            latencies.append(traced(client, f'{scenario} files/got/up.bin files/bench/up.bin'))
+            # Server may still be writing the tail when client is done, upload is renamed into place only after it
+            deadline = time.monotonic() + 5
+            while uploaded_size(server_path + 'got/up.bin') != size and time.monotonic() < deadline:
+                time.sleep(0.01)
+            ok = ok and uploaded_size(server_path + 'got/up.bin') == size
+        total = size * repeat
+    elif scenario == 'restore':
+        target = client_path + 'got/data.bin'
+        for _ in range(repeat):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(target)
+            cut_download(client)
+            client.sock.close()
+            cut = os.path.getsize(target)
+            start = time.perf_counter()
+            client = connect()
+            latencies.append(time.perf_counter() - start)
+            total += size - cut
+            ok = ok and cut < size and os.path.getsize(target) == size
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    with contextlib.suppress(Exception):
+        client.process('logout')
+    with open(result_path, 'w') as file:
+        json.dump({
+            'ok': ok,
+            'latencies': latencies,
+            'bytes': total,
+            'cpu': {'user': after.ru_utime - before.ru_utime, 'system': after.ru_stime - before.ru_stime},
+            'peak_rss_kb': maxrss_kb(after),
+            **extra,
+        }, file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback benchmark of server and client')
+    parser.add_argument('--scenarios', type=parse_list, default=list(SCENARIOS), help=','.join(SCENARIOS))
+    parser.add_argument('--engines', type=parse_list, default=['threads'], help='threads,asyncio')
+    parser.add_argument('--packet-sizes', type=lambda v: parse_list(v, parse_size), default=[1024, 4096, 16384])
+    parser.add_argument('--packets-per-check', type=lambda v: parse_list(v, int), default=[1, 4])
+    parser.add_argument('--enable-check', type=lambda v: parse_list(v, lambda item: item == 'true'),
+                        default=[True, False], help='true,false')
+    parser.add_argument('--size', type=parse_size, default=parse_size('8M'), help='file size of transfers')
+    parser.add_argument('--tree-files', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every transfer and tree')
+    parser.add_argument('--echo-count', type=int, default=500)
+    parser.add_argument('--chunk-tuning', type=parse_list, default=['fixed'], help='fixed,auto')
+    parser.add_argument('--max-packet-size', type=parse_size, default=parse_size('256K'),
+                        help='MAX_PACKET_SIZE of auto chunk tuning')
+    parser.add_argument('--compression', default='none')
+    parser.add_argument('--zero-copy', action='store_true')
+    parser.add_argument('--allocations', action='store_true', help='report peak traced memory of transfers')
+    parser.add_argument('--progress', default='none', help='SERVER_PROGRESS of server, headless by default')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds one scenario may take')
+    parser.add_argument('--workdir', help='directory for generated files, temporary one by default')
+    parser.add_argument('--output', help='file to append results to, stdout by default')
+    parser.add_argument('--keep', action='store_true', help="don't remove temporary directory")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Unknown scenarios {", ".join(sorted(unknown))}')
+    benchmark = Benchmark(args)
+    try:
+        with open(args.output, 'a') if args.output else contextlib.nullcontext(sys.stdout) as out:
+            benchmark.run(out)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(benchmark.work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'worker':
+        worker(sys.argv[2], sys.argv[3])
+    else:
+        main()
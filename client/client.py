@@ -1,31 +1,89 @@
+import argparse
+import contextlib
+import io
+import json
 import math
+import multiprocessing
 import os
+import queue
+import random
+import select
+import signal
 import socket
+import sys
+import threading
 import time
 import uuid
-import json
 
 import dotenv
 from alive_progress import alive_bar
 
 from utils.status_codes import StatusCode
+from utils.flow_control import SlidingWindow, CumulativeAck, agree_window
+from utils.framing import REQUEST_ID, PIPELINED_COMMANDS, FrameType, FrameReader, FrameWriter, HEADER
+from utils.receive_buffer import ReceiveBuffer
+from utils.file_reader import open_reader
+from utils.udp_transfer import UdpSender, UdpReceiver
+from utils.range_state import RangeState
+from utils.delta import DeltaEncoder, block_size, signature, receive_delta
+from utils.compression import Codec, offer, choose
+from utils.archive import collect, whole_entries, send_entries, receive_entries
+from utils.tuning import ChunkTuner, set_buffers
+from utils.exception import ServerBusy, SocketException
 
 
 class Client:
-    def __init__(self):
+    # Job workers pass `session_id`: every one of them is a session of its own and session file is left alone
+    def __init__(self, session_id: str | None = None):
         self.server_port = None
         self.server_ip = None
         self.client_ip = None
         self.client_debug_loading = os.getenv('CLIENT_DEBUG_LOADING') == 'true'
+        self.udp_sock = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_DGRAM,
+        )
+        self.start_path = os.getenv('CLIENT_FILES_PATH')
+        self.packet_size = int(os.getenv('CLIENT_PACKET_SIZE'))
+        self.packets_per_check = int(os.getenv('PACKETS_PER_CHECK'))
+        self.enable_check = os.getenv('ENABLE_CHECK') == 'true'
+        self.delta_sync = os.getenv('DELTA_SYNC') == 'true'
+        self.compression = os.getenv('COMPRESSION', 'none')
+        self.chunk_tuning = os.getenv('CHUNK_TUNING', 'fixed') == 'auto'
+        self.max_packet_size = int(os.getenv('MAX_PACKET_SIZE', self.packet_size))
+        self.file_reader = os.getenv('FILE_READER', 'read')
+        self.read_ahead = int(os.getenv('READ_AHEAD', 8 * 1024 * 1024))
+        self.socket_buffer_size = int(os.getenv('SOCKET_BUFFER_SIZE', 0))
+        self.connect_retries = int(os.getenv('CLIENT_CONNECT_RETRIES', 5))
+        self.pipeline_window = int(os.getenv('PIPELINE_WINDOW', 64))
+        self.request_id = 0
+        self.logged_out = False
+        self.show_progress = True
+        self.open_socket()
+        self.window_size = int(os.getenv('WINDOW_SIZE', 64)) * self.packet_size if self.enable_check else 0
+        self.session_id = str(uuid.uuid4())
+        self.udp_port = int(os.getenv('SERVER_UDP_PORT'))
+        self.udp_window = int(os.getenv('UDP_WINDOW_SIZE', 256))
+        self.parallel_streams = int(os.getenv('PARALLEL_STREAMS', 4))
+        self.range_retries = 3
+        self.session_file = os.getenv('CLIENT_SESSION_FILE') if session_id is None else None
+        if session_id is not None:
+            self.session_id = session_id
+        elif os.path.exists(self.session_file) and os.path.isfile(self.session_file):
+            with open(self.session_file, 'r+') as file:
+                self.session_id = file.read()
+        else:
+            with open(self.session_file, 'w+') as file:
+                file.write(self.session_id)
+        print(self.session_id)
+
+    # Control connection, busy server closes it so every attempt needs a new one
+    def open_socket(self):
         self.sock = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
             proto=socket.IPPROTO_TCP
         )
-        self.udp_sock = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_DGRAM,
-        )
         self.sock.setsockopt(
             socket.SOL_SOCKET,
             socket.SO_REUSEADDR,
@@ -36,66 +94,131 @@ class Client:
             socket.SO_KEEPALIVE,
             1
         )
-        self.start_path = os.getenv('CLIENT_FILES_PATH')
-        self.packet_size = int(os.getenv('CLIENT_PACKET_SIZE'))
-        self.packets_per_check = int(os.getenv('PACKETS_PER_CHECK'))
-        self.enable_check = os.getenv('ENABLE_CHECK') == 'true'
-        self.session_id = str(uuid.uuid4())
-        self.udp_port = int(os.getenv('SERVER_UDP_PORT'))
-        session_file = os.getenv('CLIENT_SESSION_FILE')
-        if os.path.exists(session_file) and os.path.isfile(session_file):
-            with open(session_file, 'r+') as file:
-                self.session_id = file.read()
-        else:
-            with open(session_file, 'w+') as file:
-                file.write(self.session_id)
-        print(self.session_id)
+        self.sock.setsockopt(
+            socket.IPPROTO_TCP,
+            socket.TCP_NODELAY,
+            1
+        )
+        # Buffers must be set before connect, window scale is agreed in handshake
+        set_buffers(self.sock, self.socket_buffer_size)
+        self.reader = FrameReader(self.sock)
+        self.writer = FrameWriter(self.sock)
 
-    # That func binds socket and start session
+    # That func binds socket and start session, busy server is asked again after the time it tells
     def start_session(self, client_ip: str, server_ip: str, server_port: int):
         self.client_ip = client_ip
         self.server_ip = server_ip
         self.server_port = server_port
-        try:
-            print("STARTING SESSION...")
-            self.sock.bind((client_ip, 0))
-            print("SOCKET BINDED")
-            self.sock.connect((server_ip, server_port))
-            self.listen()
-        except Exception as e:
-            print(e)
-        finally:
-            self.sock.close()
+        print("STARTING SESSION...")
+        for attempt in range(self.connect_retries + 1):
+            try:
+                self.sock.bind((client_ip, 0))
+                print("SOCKET BINDED")
+                self.sock.connect((server_ip, server_port))
+                self.listen()
+                break
+            except ServerBusy as e:
+                print(e)
+                if attempt == self.connect_retries:
+                    break
+                self.sock.close()
+                # Jitter keeps rejected clients from coming back all at once
+                time.sleep(e.retry_after * random.uniform(1, 1.5))
+                self.open_socket()
+            except Exception as e:
+                print(e)
+                break
+        self.sock.close()
 
-    # Wrapper for processing input
-    def process(self, inp):
-        self.clear_buffer()
-        self.sock.send(inp.encode('utf-8'))
+    # Wrapper for processing input, False if transfer failed
+    def process(self, inp) -> bool:
+        if inp.startswith('batch '):
+            return self.batch(inp)
+        self.writer.write_text(inp, FrameType.cmd)
         if inp.startswith('download'):
-            self.download(inp)
+            return self.download(inp)
         elif inp.startswith('upload'):
-            self.upload(inp)
+            return self.upload(inp)
+        elif inp.startswith('pdownload'):
+            return self.parallel_download(inp)
         elif inp.startswith('udpdownload'):
-            self.udp_download(inp)
+            return self.udp_download(inp)
         elif inp.startswith('udpupload'):
-            self.udp_upload(inp)
+            return self.udp_upload(inp)
+        elif inp.startswith('tree'):
+            self.tree()
+        elif inp.startswith('mdownload'):
+            return self.archive_download(inp)
+        elif inp.startswith('mupload'):
+            return self.archive_upload(inp)
         else:
-            print(self.sock.recv(self.packet_size).decode('utf-8'))
-
-    def clear_buffer(self):
-        try:
-            self.sock.settimeout(0.1)
-            self.sock.recv(self.packet_size)
-        except Exception as e:
-            pass
-        finally:
-            self.sock.settimeout(None)
+            print(self.reader.read_text())
+        return True
 
     def handle_logout(self):
-        session_file = os.getenv('CLIENT_SESSION_FILE')
-        if os.path.exists(session_file) and os.path.isfile(session_file):
-            os.remove(session_file)
+        if self.session_file is not None and os.path.isfile(self.session_file):
+            os.remove(self.session_file)
         self.sock.close()
+        self.logged_out = True
+
+    """
+    PIPELINED REQUESTS
+    S <- C [request] (id + command)     up to PIPELINE_WINDOW of them unanswered
+    S -> C [reply] (id + text)          in order, client sends more as replies come
+    Client reads replies while it sends, so neither side blocks on full socket buffer of the other.
+    """
+
+    # Runs commands with one text reply (PIPELINED_COMMANDS) without waiting a round trip for each, replies in order
+    def pipeline(self, commands: list[str]) -> list[str]:
+        ids = {}
+        replies: list[str | None] = [None] * len(commands)
+        sent = answered = 0
+        while answered < len(commands):
+            can_send = sent < len(commands) and sent - answered < self.pipeline_window
+            readable, writable, _ = select.select([self.sock], [self.sock] if can_send else [], [])
+            if writable:
+                # Every request the window allows goes out in one send
+                frames = []
+                while sent < len(commands) and sent - answered < self.pipeline_window:
+                    self.request_id = (self.request_id + 1) % 2 ** 32
+                    ids[self.request_id] = sent
+                    payload = REQUEST_ID.pack(self.request_id) + commands[sent].encode('utf-8')
+                    frames.append(HEADER.pack(FrameType.request, len(payload)) + payload)
+                    sent += 1
+                self.sock.sendall(b''.join(frames))
+            if readable:
+                payload = self.reader.read(FrameType.reply)[1]
+                request_id, = REQUEST_ID.unpack_from(payload)
+                if request_id not in ids:
+                    raise SocketException(f'Reply to unknown request {request_id}')
+                replies[ids.pop(request_id)] = payload[REQUEST_ID.size:].decode('utf-8')
+                answered += 1
+        return replies
+
+    # Runs commands of local script file one per line, consecutive pipelined ones go out together
+    def batch(self, inp: str) -> bool:
+        try:
+            with open(inp.removeprefix('batch ').strip()) as file:
+                commands = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+        except OSError as e:
+            print(e)
+            return False
+        group = []
+        for cmd in commands + [None]:
+            if cmd is not None and cmd.split(' ')[0] in PIPELINED_COMMANDS:
+                group.append(cmd)
+                continue
+            for reply in self.pipeline(group):
+                print(reply)
+            group = []
+            if cmd is None:
+                break
+            print(f' > {cmd}')
+            self.process(cmd)
+            if cmd == 'logout' or cmd == 'shutdown':
+                self.handle_logout()
+                break
+        return True
 
     """
     RESTORING SESSION
@@ -111,95 +234,89 @@ class Client:
                ... (continue session)
                if there is need to restore upload/download
     #4         S -> C [err]
-    #5         S -> C [object] ({download: true/false, client_file_path: str, file_size: int})
+    #5         S -> C [object] ({download: true/false, client_file_path: str, file_size: int, offset: int, window: int})
     #6         S <- C [ok]
     #7         S -> C [ok]
     #8         S <- C [ok]
-    #9         S <- C [amount of downloaded bytes]
+    #9         S <- C [object] ({file_size: int, window: int}) (amount of downloaded bytes, agreed window)
     #10        S -> C [ok]
                ... (download/upload process)
+    Offset is the acked byte count of broken transfer (-1 if it went without acks),
+    side which received data truncates its file to it before resuming.
+    Session id travels in session frame, codes in status frames, objects in json frames
     """
 
-    # That func stands for restoring broken sessions and redirect program to download/upload missing files
-    def restore(self):
+    # That func stands for restoring broken sessions and redirect program to download/upload missing files,
+    # returns None if there was no broken transfer, else whether it's finished now
+    def restore(self) -> bool | None:
         dct = {}
-        self.sock.send(self.session_id.encode('utf-8'))
-        response = self.sock.recv(1)
+        self.writer.write_text(self.session_id, FrameType.session)
+        response = self.reader.read_status()
+        if response == StatusCode.busy:
+            raise ServerBusy(self.reader.read_json()['retry_after'])
         if response == StatusCode.ok:
             print('created new session')
             return
         elif response == StatusCode.err:
             print('restoring previous session')
-            self.sock.send(StatusCode.ok)
-            if self.sock.recv(1) == StatusCode.ok:
+            self.writer.write_status(StatusCode.ok)
+            if self.reader.read_status() == StatusCode.ok:
                 print('restored session')
                 return
-            self.sock.send(StatusCode.ok)
-            dct_str = self.sock.recv(self.packet_size).decode('utf-8')
-            dct = json.loads(dct_str)
-            self.sock.send(StatusCode.ok)
-            self.sock.recv(1)
+            dct = self.reader.read_json()
+            self.writer.write_status(StatusCode.ok)
+            self.reader.read_status()
+            self.writer.write_status(StatusCode.ok)
             file_path: str = dct['client_file_path'].removeprefix('/').removeprefix('files/')
             print("unfinished downloading/uploading:", file_path)
+            if dct['download'] == 'true' and int(dct['offset']) >= 0:
+                # Bytes past last ack may be garbage of broken packet, drop them
+                os.truncate(self.start_path + file_path, int(dct['offset']))
             sz = os.path.getsize(self.start_path + file_path)
-            self.sock.send(str(sz).encode('utf-8'))
-            self.sock.recv(1)
+            window = agree_window(self.window_size, int(dct['window']))
+            self.writer.write_json({'file_size': sz, 'window': window})
+            if self.reader.read_status() != StatusCode.ok:
+                print("server can't go on with unfinished transfer")
+                return False
             if dct['download'] == 'true':
                 print('restoring download')
-                self.restore_download(self.start_path + file_path, sz, int(dct['file_size']))
+                return self.restore_download(self.start_path + file_path, sz, int(dct['file_size']), window)
             elif dct['download'] == 'false':
                 print('restoring upload')
-                self.restore_upload(self.start_path + file_path, int(dct['file_size']), sz)
+                return self.restore_upload(self.start_path + file_path, int(dct['file_size']), sz, window)
 
     # Func for restoring downloading files from broken session
-    def restore_download(self, abs_path: str, sz: int, full_sz: int):
-        p_bar = [i for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size))]
+    def restore_download(self, abs_path: str, sz: int, full_sz: int, window: int) -> bool:
+        packets = math.ceil((full_sz - sz) / self.packet_size)
         file = open(abs_path, 'ab')
-        downloaded_bytes = 0
-        check = 0
-        with alive_bar(len(p_bar)) as bar:
+        flow = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size, offset=sz,
+                             before_ack=file.flush)
+        with self.progress_bar(packets) as bar:
             try:
-                for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size)):
-                    line = bytes()
-                    if full_sz - sz - downloaded_bytes >= self.packet_size:
-                        while len(line) < self.packet_size:
-                            buff = self.sock.recv(self.packet_size)
-                            if not buff:
-                                return
-                            line += buff
-                    else:
-                        while len(line) < full_sz - sz - downloaded_bytes:
-                            buff = self.sock.recv(self.packet_size)
-                            if not buff:
-                                return
-                            line += buff
-                    if self.enable_check:
-                        if check % self.packets_per_check == 0:
-                            self.sock.send(StatusCode.ok)
-                        check += 1
-                    downloaded_bytes += len(line)
-                    file.write(line)
-                    bar()
+                if not self.receive_chunks(file, full_sz - sz, flow, self.chunk_tuner(window, sending=False), bar):
+                    return False
+                flow.finish()
+                if not window:
+                    # Server keeps download for restore until it's confirmed
+                    self.writer.write_status(StatusCode.ok)
             except Exception as e:
                 print(e)
+                return False
+            finally:
+                file.close()
+        return True
 
     # Func for restoring uploading files from broken session
-    def restore_upload(self, abs_path: str, sz: int, full_sz: int):
-        to_send = [i for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size))]
-        file = open(abs_path, 'rb')
+    def restore_upload(self, abs_path: str, sz: int, full_sz: int, window: int) -> bool:
+        packets = math.ceil((full_sz - sz) / self.packet_size)
+        file = self.open_reader(abs_path)
         file.seek(sz)
-        check = 0
-        with alive_bar(len(to_send)) as bar:
-            for _ in to_send:
-                bar()
-                data = file.read(self.packet_size)
-                self.sock.send(data)
-                if self.client_debug_loading:
-                    time.sleep(0.001)
-                if self.enable_check:
-                    if check % self.packets_per_check == 0:
-                        self.sock.recv(1)
-                    check += 1
+        flow = SlidingWindow(self.sock, window, offset=sz)
+        with self.progress_bar(packets) as bar:
+            self.send_chunks(file, full_sz - sz, flow, self.chunk_tuner(window), bar)
+        flow.finish()
+        file.close()
+        return True
 
     def listen(self):
         self.restore()
@@ -208,200 +325,584 @@ class Client:
             self.process(inp)
             if inp == 'logout' or inp == 'shutdown':
                 self.handle_logout()
+            if self.logged_out:
                 break
 
     def synchronize_recv(self, timeout=1):
         response = StatusCode.none
         try:
             self.sock.settimeout(timeout)
-            response = self.sock.recv(1)
+            response = self.reader.read_status()
         except Exception as e:
             pass
         finally:
             self.sock.settimeout(None)
             return response
 
+    # Terminal bar of transfer, job workers run transfers side by side and go without it
+    def progress_bar(self, total: int):
+        return alive_bar(total, disable=not self.show_progress)
+
+    # Outbound file data is read through FILE_READER, see file_reader.py
+    def open_reader(self, path: str):
+        return open_reader(path, self.file_reader, self.read_ahead)
+
+    # Chunk size of raw file data, fixed or tuned while transfer goes, see tuning.py
+    def chunk_tuner(self, window: int, sending: bool = True) -> ChunkTuner:
+        return ChunkTuner(self.sock, self.packet_size, self.max_packet_size, window, self.chunk_tuning, sending)
+
+    def send_chunks(self, file, size: int, flow: SlidingWindow, tuner: ChunkTuner, on_progress):
+        while size > 0:
+            data = file.read(min(tuner.size, size))
+            if not data:
+                break
+            flow.wait_open(len(data))
+            self.sock.sendall(data)
+            flow.sent_bytes(len(data))
+            if self.client_debug_loading:
+                time.sleep(0.001)
+            size -= len(data)
+            tuner.measured(len(data))
+            on_progress(tuner.packets(len(data)))
+
+    # False if server went away before all `size` bytes came
+    def receive_chunks(self, file, size: int, flow: CumulativeAck, tuner: ChunkTuner, on_progress) -> bool:
+        buffer = ReceiveBuffer(tuner.max_size)
+        while size > 0:
+            line = buffer.recv_chunk(self.sock, min(tuner.size, size))
+            if line is None:
+                return False
+            file.write(line)
+            flow.received_bytes(len(line))
+            size -= len(line)
+            tuner.measured(len(line))
+            on_progress(tuner.packets(len(line)))
+        return True
+
     def synchronize_send(self):
         try:
             self.sock.settimeout(0.5)
-            self.sock.send(StatusCode.ok)
+            self.writer.write_status(StatusCode.ok)
         except Exception as e:
             pass
         finally:
             self.sock.settimeout(None)
 
+    # That func prints tree listing while it's coming, one frame at a time
+    def tree(self):
+        while True:
+            frame_type, payload = self.reader.read()
+            if frame_type == FrameType.json:
+                break
+            print(payload.decode('utf-8'), end='' if payload.endswith(b'\n') else '\n')
+        cursor = json.loads(payload)['cursor']
+        if cursor is not None:
+            print(f'... more lines, continue with -c {cursor}')
+
     # That func stands for downloading files from server in current session
-    def download(self, inp: str):
+    def download(self, inp: str) -> bool:
         if self.synchronize_recv() != StatusCode.ok:
             print("Can't download file: Wrong args")
-            return
+            return False
         if self.synchronize_recv() != StatusCode.ok:
             print("Can't download file: Wrong paths")
-            return
+            return False
         self.synchronize_send()
-        sz = self.sock.recv(self.packet_size).decode('utf-8')
+        meta = self.reader.read_json()
+        abs_path = self.start_path + inp.split(" ")[2].removeprefix("/").removeprefix("files/")
+        if meta.get('delta') and self.delta_sync and os.path.isfile(abs_path) and os.path.getsize(abs_path):
+            return self.receive_delta(abs_path, meta['size'])
         file = None
         try:
-            file = open(f'{self.start_path + inp.split(" ")[2].removeprefix("/").removeprefix("files/")}', 'wb')
+            file = open(abs_path, 'wb')
         except Exception as e:
-            self.sock.send(StatusCode.err)
-            return
-        sz = int(sz)
-        p_bar = [i for i in range(math.ceil(sz / self.packet_size))]
-        self.synchronize_send()
+            self.writer.write_status(StatusCode.err)
+            return False
+        sz = meta['size']
+        window = agree_window(self.window_size, meta['window'])
+        codec_spec = choose(self.compression, meta.get('compress'))
+        codec = Codec.from_reply(codec_spec, self.packet_size)
+        packets = math.ceil(sz / (codec.block if codec else self.packet_size))
+        self.writer.write_status(StatusCode.ok)
+        self.writer.write_json({'window': window, 'codec': codec_spec})
+        flow = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size, before_ack=file.flush)
         downloaded_bytes = 0
-        check = 0
-        with alive_bar(len(p_bar)) as bar:
-            for i in range(math.ceil(sz / self.packet_size)):
-                line = bytes()
-                if sz - downloaded_bytes >= self.packet_size:
-                    while len(line) < self.packet_size:
-                        buff = self.sock.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                else:
-                    while len(line) < sz - downloaded_bytes:
-                        buff = self.sock.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                downloaded_bytes += len(line)
-                file.write(line)
-                if self.enable_check:
-                    if check % self.packets_per_check == 0:
-                        self.synchronize_send()
-                    check += 1
-                bar()
-            self.synchronize_send()
+        decompress = codec.decompressor() if codec else None
+        with self.progress_bar(packets) as bar:
+            if decompress is None:
+                if not self.receive_chunks(file, sz, flow, self.chunk_tuner(window, sending=False), bar):
+                    return False
+            else:
+                while downloaded_bytes < sz:
+                    # Block carries up to codec.block file bytes, window and acks count them, not compressed ones
+                    line = decompress(self.reader.read(FrameType.compressed)[1])
+                    if not line or downloaded_bytes + len(line) > sz:
+                        print(f'Compressed block of {len(line)} bytes past end of file')
+                        return False
+                    downloaded_bytes += len(line)
+                    file.write(line)
+                    flow.received_bytes(len(line))
+                    bar()
+            flow.finish()
+            if not window:
+                self.synchronize_send()
         file.close()
+        return True
 
     # That func stands for uploading files to server in current session
-    def upload(self, inp: str):
+    def upload(self, inp: str) -> bool:
         try:
             rel_path = inp.split(' ')[2]
         except Exception as e:
-            self.sock.send(StatusCode.err)
-            self.sock.recv(1)
+            self.writer.write_status(StatusCode.err)
+            self.reader.read_status()
             print('Wrong args')
-            return
+            return False
         rel_path = rel_path.removeprefix('/').removeprefix('files/')
         abs_path = self.start_path + rel_path
         if os.path.exists(abs_path) and os.path.isfile(abs_path):
             print('Uploading', abs_path)
-            self.sock.send(StatusCode.ok)
-            file = open(abs_path, "rb")
+            self.writer.write_status(StatusCode.ok)
+            file = self.open_reader(abs_path)
             sz = os.path.getsize(abs_path)
             if self.synchronize_recv() != StatusCode.ok:
                 print("Server didn't reply on ok")
-                return
-            self.sock.send(f"{sz}".encode('utf-8'))
+                return False
+            self.writer.write_json({'size': sz, 'window': self.window_size, 'delta': self.delta_sync,
+                                    'compress': offer(self.compression, abs_path)})
             if self.synchronize_recv() != StatusCode.ok:
                 print("Server didn't reply on size")
-                return
-            to_send = [i for i in range(math.ceil(sz / self.packet_size))]
-            print(math.ceil(sz / self.packet_size), sz)
-            check = 0
-            with alive_bar(len(to_send)) as bar:
-                for _ in to_send:
-                    data = file.read(self.packet_size)
-                    self.sock.send(data)
-                    if self.client_debug_loading:
-                        time.sleep(0.001)
-                    if self.enable_check:
-                        if check % self.packets_per_check == 0:
-                            self.synchronize_recv()
-                        check += 1
-                    bar()
+                return False
+            reply = self.reader.read_json()
+            if reply.get('delta'):
+                with file:
+                    return self.send_delta(file, reply['block'])
+            flow = SlidingWindow(self.sock, reply['window'])
+            codec = Codec.from_reply(reply.get('codec'), self.packet_size)
+            packets = math.ceil(sz / (codec.block if codec else self.packet_size))
+            with self.progress_bar(packets) as bar:
+                if codec is not None:
+                    for size, payload in codec.blocks(file, sz):
+                        flow.wait_open(size)
+                        self.writer.write(FrameType.compressed, payload)
+                        flow.sent_bytes(size)
+                        bar()
+                else:
+                    self.send_chunks(file, sz, flow, self.chunk_tuner(flow.window), bar)
             file.close()
+            flow.finish()
+            if not flow.window:
+                self.synchronize_send()
+            return True
+        print("Wrong paths")
+        self.writer.write_status(StatusCode.err)
+        self.synchronize_recv(5)
+        return False
+
+    # Receiver side of delta sync: local file is the basis, only changed blocks come over network
+    def receive_delta(self, abs_path: str, sz: int) -> bool:
+        block = block_size(sz)
+        try:
+            with open(abs_path, 'rb') as basis:
+                sig = signature(basis, block)
+        except OSError as e:
+            print(e)
+            self.writer.write_status(StatusCode.err)
+            return False
+        self.writer.write_status(StatusCode.ok)
+        self.writer.write_json({'window': 0, 'delta': True, 'block': block})
+        self.writer.write(FrameType.signature, sig)
+        decoder = receive_delta(self.reader, abs_path, block)
+        self.writer.write_status(StatusCode.ok if decoder.ok else StatusCode.err)
+        if decoder.ok:
+            print(f'Delta sync: {decoder.literal_bytes} of {decoder.size} bytes sent, the rest reused')
+        else:
+            print("Delta sync failed: rebuilt file doesn't match, local file is left as it was")
+        return decoder.ok
+
+    # Sender side of delta sync, server's signature comes right after its reply
+    def send_delta(self, file, block: int) -> bool:
+        encoder = DeltaEncoder(self.reader.read(FrameType.signature)[1], block)
+        for frame_type, payload in encoder.frames(file):
+            self.writer.write(frame_type, payload)
+        if self.reader.read_status() == StatusCode.ok:
+            print(f'Delta sync: {encoder.literal_bytes} of {encoder.size} bytes sent, the rest reused')
+            return True
+        print("Delta sync failed: server couldn't rebuild file")
+        return False
+
+    # That func downloads every file which remote dir or glob matches in one stream, whole local files are skipped
+    def archive_download(self, inp: str) -> bool:
+        # Server may take a while to collect big tree, so no timeout here
+        if self.reader.read_status() != StatusCode.ok:
+            print("Can't download files: Wrong args or nothing matches")
+            return False
+        meta = self.reader.read_json()
+        entries = meta['entries']
+        try:
+            root = self.start_path + inp.split(' ')[2].removeprefix('/').removeprefix('files/')
+            os.makedirs(root, exist_ok=True)
+            skip = whole_entries(root, entries)
+        except Exception as e:
+            print(e)
+            self.writer.write_status(StatusCode.err)
+            return False
+        window = agree_window(self.window_size, meta['window'])
+        self.writer.write_json({'skip': skip, 'window': window})
+        flow = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size)
+        with self.progress_bar(len(entries) - len(skip)) as bar:
+            receive_entries(self.sock, self.reader, flow, ReceiveBuffer(self.packet_size), root, entries, skip,
+                            self.packet_size, on_entry=lambda path: bar())
+        flow.finish()
+        if not window:
+            self.synchronize_send()
+        print(f'{len(entries) - len(skip)} files received, {len(skip)} already here')
+        return True
+
+    # That func uploads every file which local dir or glob matches in one stream, whole remote files are skipped
+    def archive_upload(self, inp: str) -> bool:
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Can't upload files: Wrong args")
+            return False
+        try:
+            base, entries = collect(self.start_path, inp.split(' ')[2].removeprefix('/').removeprefix('files/'))
+        except Exception as e:
+            print(e)
+            entries = []
+        if not entries:
+            print('Nothing matches')
+            self.writer.write_status(StatusCode.err)
+            return False
+        self.writer.write_json({'entries': entries, 'window': self.window_size})
+        frame_type, payload = self.reader.read()
+        if frame_type != FrameType.json:
+            print("Server can't take files")
+            return False
+        reply = json.loads(payload)
+        skip = reply['skip']
+        flow = SlidingWindow(self.sock, reply['window'])
+        with self.progress_bar(len(entries) - len(skip)) as bar:
+            send_entries(self.sock, flow, base, entries, skip, self.packet_size, on_entry=bar)
+        flow.finish()
+        if not flow.window:
             self.synchronize_send()
+        print(f'{len(entries) - len(skip)} files sent, {len(skip)} already on server')
+        return True
+
+    # That func stands for downloading one file over several data connections, each of them fetches its own range
+    def parallel_download(self, inp: str) -> bool:
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Can't download file: Wrong args")
+            return False
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Can't download file: Wrong paths")
+            return False
+        meta = self.reader.read_json()
+        sz = meta['size']
+        abs_path = self.start_path + inp.split(" ")[2].removeprefix("/").removeprefix("files/")
+        state = RangeState.load(abs_path, sz)
+        if state is not None:
+            print(f'Resuming {len(state.pending())} ranges, {state.remaining()} bytes left')
         else:
-            print("Wrong paths")
-            self.sock.send(StatusCode.err)
-            self.synchronize_recv(5)
+            state = RangeState.split(abs_path, sz, min(self.parallel_streams, meta['streams']), self.packet_size)
+        try:
+            fd = os.open(abs_path, os.O_RDWR | os.O_CREAT)
+        except OSError as e:
+            print(e)
+            self.writer.write_status(StatusCode.err)
+            return False
+        try:
+            os.ftruncate(fd, sz)
+            self.writer.write_status(StatusCode.ok)
+            pending = state.pending()
+            results = {}
+            lock = threading.Lock()
+            chunks = sum(math.ceil((end - start) / self.packet_size) for start, end in state.ranges)
+            with self.progress_bar(chunks) as bar:
+                def on_progress():
+                    with lock:
+                        bar()
 
-    def udp_download(self, inp: str):
-        self.udp_sock.settimeout(2)
-        # Sync with server!
-        self.udp_sock.sendto("".encode('utf-8'), (self.server_ip, self.udp_port))
+                def run(index: int):
+                    results[index] = self.fetch_range(meta['transfer_id'], fd, state, index, on_progress)
 
-        # Get file size
-        data, addr = self.udp_sock.recvfrom(self.packet_size)
-        sz = int(data.decode('utf-8'))
-        print(sz, addr)
+                workers = [threading.Thread(target=run, args=(index,)) for index in pending]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            os.close(fd)
+        if all(results.get(index) for index in pending):
+            state.remove()
+            self.writer.write_status(StatusCode.ok)
+            return True
+        state.save()
+        self.writer.write_status(StatusCode.err)
+        print('Some ranges failed, run pdownload again to resume them')
+        return False
 
-        # Respond to server with OK
-        self.udp_sock.sendto("OK".encode('utf-8'), addr)
+    # Fetches range over its own data connection, broken connection is reopened from the byte it stopped at
+    def fetch_range(self, transfer_id: int, fd: int, state: RangeState, index: int, on_progress) -> bool:
+        buffer = ReceiveBuffer(self.packet_size)
+        for _ in range(self.range_retries):
+            offset, end = state.ranges[index]
+            try:
+                with socket.create_connection((self.server_ip, self.server_port),
+                                              source_address=(self.client_ip, 0)) as sock:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    FrameWriter(sock).write_json(
+                        {'session_id': self.session_id, 'transfer_id': transfer_id, 'offset': offset,
+                         'size': end - offset},
+                        FrameType.stream
+                    )
+                    reader = FrameReader(sock)
+                    response = reader.read_status()
+                    if response == StatusCode.busy:
+                        raise ServerBusy(reader.read_json()['retry_after'])
+                    if response != StatusCode.ok:
+                        print(f'Server refused range [{offset}, {end})')
+                        return False
+                    while offset < end:
+                        chunk = buffer.recv_chunk(sock, min(self.packet_size, end - offset))
+                        if chunk is None:
+                            raise ConnectionError(f'Connection closed at {offset} of range [{offset}, {end})')
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        state.advance(index, offset)
+                        on_progress()
+                return True
+            except ServerBusy as e:
+                time.sleep(e.retry_after)
+            except OSError as e:
+                print(e)
+        return False
 
-        # Open file
+    def udp_download(self, inp: str) -> bool:
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Can't download file: Wrong args")
+            return False
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Can't download file: Wrong paths")
+            return False
+        meta = self.reader.read_json()
         try:
             file = open(f'{self.start_path + inp.split(" ")[2].removeprefix("/").removeprefix("files/")}', 'wb')
         except Exception as e:
             print(e)
-            return
-
-        p_bar = [i for i in range(math.ceil(sz / self.packet_size))]
-        j = 0
-        packet_num = 0
-        with alive_bar(len(p_bar)) as bar:
-            for i in range(math.ceil(sz / self.packet_size)):
-                g_line = self.udp_sock.recvfrom(self.packet_size + 20)[0]
-                split_idx = g_line.find(b':')
-                l_packet_num = int(g_line[:split_idx])
-                data = g_line[split_idx + 1:]
-                if j == 10:
-                    self.udp_sock.sendto(b"OK", addr)
-                    j = 0
-                if packet_num != l_packet_num:
-                    print('Sequence broken!')
-                    exit(1)
-                packet_num += 1
-                bar()
-                file.write(data)
-                j += 1
-        file.close()
+            self.writer.write_status(StatusCode.err)
+            return False
+        self.writer.write_status(StatusCode.ok)
+        codec_spec = choose(self.compression, meta.get('compress'))
+        self.writer.write_json({'codec': codec_spec})
+        with file, self.progress_bar(math.ceil(meta['size'] / meta['chunk'])) as bar:
+            UdpReceiver(
+                self.udp_sock,
+                meta['transfer_id'],
+                meta['size'],
+                meta['chunk'],
+                peer=(self.server_ip, meta['port']),
+                window=self.udp_window,
+                codec=Codec.from_reply(codec_spec, meta['chunk'])
+            ).receive(file, on_progress=bar)
+        return True
 
-    def udp_upload(self, inp: str):
-        self.udp_sock.sendto("SYNC".encode('utf-8'), (self.sock.getpeername()[0], self.udp_port))
-        data, addr = self.udp_sock.recvfrom(self.packet_size)
+    def udp_upload(self, inp: str) -> bool:
         try:
             rel_path = inp.split(' ')[2]
         except Exception as e:
+            self.writer.write_status(StatusCode.err)
+            self.reader.read_status()
             print('Wrong args')
-            return
+            return False
         rel_path = rel_path.removeprefix('/').removeprefix('files/')
         abs_path = self.start_path + rel_path
-        if os.path.exists(abs_path) and os.path.isfile(abs_path):
-            file = open(abs_path, "rb")
-            sz = os.path.getsize(abs_path)
+        if not (os.path.exists(abs_path) and os.path.isfile(abs_path)):
+            print("Wrong paths")
+            self.writer.write_status(StatusCode.err)
+            self.synchronize_recv(5)
+            return False
+        self.writer.write_status(StatusCode.ok)
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Server didn't reply on ok")
+            return False
+        sz = os.path.getsize(abs_path)
+        self.writer.write_json({'size': sz, 'chunk': self.packet_size, 'compress': offer(self.compression, abs_path)})
+        if self.synchronize_recv() != StatusCode.ok:
+            print("Server can't receive file")
+            return False
+        meta = self.reader.read_json()
+        with self.open_reader(abs_path) as file, self.progress_bar(math.ceil(sz / self.packet_size)) as bar:
+            UdpSender(
+                self.udp_sock,
+                meta['transfer_id'],
+                sz,
+                self.packet_size,
+                peer=(self.server_ip, meta['port']),
+                window=self.udp_window,
+                codec=Codec.from_reply(meta.get('codec'), self.packet_size)
+            ).send(file, on_progress=bar)
+        return True
 
-            # Send file size to server
-            self.udp_sock.sendto(f"{sz}".encode('utf-8'), addr)
-
-            # Receive OK from server
-            data, _ = self.udp_sock.recvfrom(self.packet_size)
-
-            to_send = [i for i in range(math.ceil(sz / self.packet_size))]
-            self.udp_sock.settimeout(2)
-            i = 0
-            packet_num = 0
-            # Start uploading
-            with alive_bar(len(to_send)) as bar:
-                for _ in to_send:
-                    header = f"{packet_num}:".encode('utf-8')
-                    data = file.read(self.packet_size)
-                    self.udp_sock.sendto(header + data, addr)
-                    if i == 10:
-                        self.udp_sock.recvfrom(self.packet_size)
-                        i = 0
-                    i += 1
-                    packet_num += 1
-                    bar()
-            file.close()
+"""
+# Job queue #
+python3 client.py --jobs MANIFEST [--concurrency N] [--retries N]
+MANIFEST is a file or - for stdin, one client command per line, blank lines and # comments are skipped.
+Stdin is read while jobs run, so a pipe may keep feeding it.
+CLIENT_JOBS_CONCURRENCY     worker processes, every one has a control connection and a session of its own
+CLIENT_JOB_RETRIES          times failed job is tried again
+Worker takes next job as soon as previous one ends. Failed job closes its connection, worker waits, connects
+with same session id and restores: broken transfer resumes from the offset server journaled, other jobs run again.
+Job which is out of retries leaves its session behind, worker goes on in a new one.
+Line per job as it ends, then jobs, bytes and throughput of the whole run; exit code is 1 if any job failed.
+"""
+
+
+class JobQueue:
+    def __init__(self, concurrency: int, retries: int):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.client_ip = os.getenv('CLIENT_IP')
+        self.server_ip = os.getenv('SERVER_IP')
+        self.server_port = int(os.getenv('SERVER_PORT'))
+        self.start_path = os.getenv('CLIENT_FILES_PATH')
+        self.context = multiprocessing.get_context('fork')
+        self.connected = False
+
+    def run(self, manifest) -> int:
+        jobs = self.context.Queue()
+        results = self.context.Queue()
+        workers = [self.context.Process(target=self.work, args=(jobs, results)) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        # Workers are forked first, feeder is the only thread besides main one
+        fed = [0]
+        feeder = threading.Thread(target=self.feed, args=(manifest, jobs, fed), daemon=True)
+        feeder.start()
+        start = time.perf_counter()
+        done = failed = total_bytes = 0
+        while feeder.is_alive() or done < fed[0]:
+            try:
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print('All job workers exited')
+                    failed += fed[0] - done
+                    break
+                continue
+            done += 1
+            failed += not result['ok']
+            job_bytes = self.job_bytes(result['cmd']) if result['ok'] else 0
+            total_bytes += job_bytes
+            self.report(done, result, job_bytes)
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+        print(f'{fed[0]} jobs: {fed[0] - failed} ok, {failed} failed, {total_bytes / 2 ** 20:.1f} MiB '
+              f'in {seconds:.2f}s, {total_bytes / 2 ** 20 / seconds:.1f} MiB/s')
+        return 1 if failed else 0
+
+    def feed(self, manifest, jobs, fed: list):
+        for line in manifest:
+            cmd = line.strip()
+            if cmd and not cmd.startswith('#'):
+                jobs.put(cmd)
+                fed[0] += 1
+        for _ in range(self.concurrency):
+            jobs.put(None)
+
+    def report(self, number: int, result: dict, job_bytes: int):
+        rate = f'{job_bytes / 2 ** 20 / result["seconds"]:.1f} MiB/s' if job_bytes else ''
+        tries = f'({result["attempts"]} attempts)' if result['attempts'] > 1 else ''
+        status = 'ok' if result['ok'] else 'FAILED'
+        print(f'[{number}] {status} {result["cmd"]} {result["seconds"]:.2f}s {rate} {tries}')
+        if not result['ok']:
+            for line in result['output'].splitlines():
+                print('    ' + line)
+
+    # Size of local files job covers, throughput of the run counts it
+    def job_bytes(self, cmd: str) -> int:
+        args = cmd.split(' ')
+        if len(args) < 3:
+            return 0
+        path = args[2].removeprefix('/').removeprefix('files/')
+        try:
+            if args[0] in ('mdownload', 'mupload'):
+                return sum(size for _, size, _ in collect(self.start_path, path)[1])
+            if args[0] in ('download', 'upload', 'pdownload', 'udpdownload', 'udpupload'):
+                return os.path.getsize(self.start_path + path)
+            return 0
+        except (OSError, ValueError):
+            return 0
+
+    # Runs in worker process, output of every job is kept and shown only if job failed
+    def work(self, jobs, results):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = Client(session_id=str(uuid.uuid4()))
+        client.show_progress = False
+        for cmd in iter(jobs.get, None):
+            output = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                ok, attempts = self.attempt(client, cmd)
+            results.put({'cmd': cmd, 'ok': ok, 'attempts': attempts, 'seconds': time.perf_counter() - start,
+                         'output': output.getvalue()})
+        if self.connected:
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    client.process('logout')
+                except (OSError, SocketException):
+                    pass
+            client.handle_logout()
+
+    def attempt(self, client: Client, cmd: str) -> tuple[bool, int]:
+        for attempt in range(1, self.retries + 2):
+            try:
+                if not self.connected and self.connect(client):
+                    # Restore finished broken transfer of this job
+                    return True, attempt
+                if client.process(cmd):
+                    return True, attempt
+                print('job failed')
+                delay = min(0.1 * 2 ** attempt, 5)
+            except ServerBusy as e:
+                print(e)
+                delay = e.retry_after * random.uniform(1, 1.5)
+            except (OSError, SocketException) as e:
+                print(e)
+                delay = min(0.1 * 2 ** attempt, 5)
+            # Connection may be anywhere in the middle of a transfer, only restore brings both sides together again
+            client.sock.close()
+            self.connected = False
+            if attempt <= self.retries:
+                time.sleep(delay)
+        # Unfinished transfer of this job mustn't be restored as part of the next one
+        client.session_id = str(uuid.uuid4())
+        return False, self.retries + 1
+
+    # True if restore finished a transfer
+    def connect(self, client: Client) -> bool:
+        # Socket of the last connection, or the one Client opened in __init__, is never connected again
+        client.sock.close()
+        client.open_socket()
+        client.client_ip, client.server_ip, client.server_port = self.client_ip, self.server_ip, self.server_port
+        client.sock.bind((self.client_ip, 0))
+        client.sock.connect((self.server_ip, self.server_port))
+        restored = client.restore()
+        self.connected = True
+        return bool(restored)
 
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description='Client of file server, prompts for commands without --jobs')
+    parser.add_argument('--jobs', type=argparse.FileType('r'), help='manifest of commands, - for stdin')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('CLIENT_JOBS_CONCURRENCY', 4)))
+    parser.add_argument('--retries', type=int, default=int(os.getenv('CLIENT_JOB_RETRIES', 3)))
+    args = parser.parse_args()
+    if args.jobs is not None:
+        sys.exit(JobQueue(args.concurrency, args.retries).run(args.jobs))
     client = Client()
     client.start_session(
         os.getenv('CLIENT_IP'),
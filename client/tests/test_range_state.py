@@ -0,0 +1,49 @@
+from utils.range_state import RangeState
+
+
+def test_split_covers_file_with_aligned_ranges(tmp_path):
+    state = RangeState.split(str(tmp_path / 'file.bin'), 10000, 3, 1024)
+    assert state.ranges == [[0, 4096], [4096, 8192], [8192, 10000]]
+    assert state.remaining() == 10000
+    assert state.pending() == [0, 1, 2]
+
+
+def test_more_streams_than_blocks(tmp_path):
+    state = RangeState.split(str(tmp_path / 'file.bin'), 1000, 4, 1024)
+    assert state.ranges == [[0, 1000]]
+
+
+def test_saved_progress_is_resumed(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as file:
+        file.truncate(8192)
+    state = RangeState.split(path, 8192, 2, 1024)
+    state.advance(0, 4096)
+    state.advance(1, 5000)
+    state.save()
+    resumed = RangeState.load(path, 8192)
+    assert resumed.ranges == [[4096, 4096], [5000, 8192]]
+    assert resumed.pending() == [1]
+    assert resumed.remaining() == 3192
+
+
+def test_progress_is_saved_every_save_every_bytes(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    state = RangeState(path, 8192, [[0, 8192]], save_every=4096)
+    state.advance(0, 1024)
+    assert RangeState.load(path, 8192) is None
+    with open(path, 'wb') as file:
+        file.truncate(8192)
+    state.advance(0, 4096)
+    assert RangeState.load(path, 8192).ranges == [[4096, 8192]]
+
+
+def test_state_of_other_file_is_not_resumed(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as file:
+        file.truncate(8192)
+    RangeState.split(path, 8192, 2, 1024).save()
+    assert RangeState.load(path, 4096) is None
+    state = RangeState.load(path, 8192)
+    state.remove()
+    assert RangeState.load(path, 8192) is None
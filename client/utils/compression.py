@@ -0,0 +1,131 @@
+import lzma
+import os
+import zlib
+
+from .exception.socket_exception import SocketException
+
+"""
+# Negotiated compression #
+Sender offers codecs with transfer metadata, receiver answers with the one it wants, level included:
+X -> R (size window ... compress)   compress - ["zlib", "lzma"], empty if file looks compressed already
+X <- R (window ... codec)           codec - "zlib:6", "lzma:1"..., null - file goes raw
+Each side offers or picks only codecs allowed by its own COMPRESSION (none, zlib[:level], lzma[:level]).
+TCP: file goes as compressed frames, each of them carries one block of up to `block` file bytes.
+     zlib blocks come from one stream flushed after every block, so they share dictionary,
+     lzma can't flush in the middle of stream, so its blocks are separate raw LZMA2 streams.
+UDP: every chunk is compressed on its own and goes as packed datagram if that makes it smaller.
+Windows, acks, progress and restore offsets count file bytes, never compressed ones.
+"""
+
+CODECS = ('zlib', 'lzma')
+DEFAULT_LEVEL = {'zlib': 6, 'lzma': 1}
+# Separate LZMA2 streams need some size to find repeats in
+LZMA_BLOCK = 256 * 1024
+LZMA_MIN_DICT = 4096
+# Types which are compressed already, compressing them again only burns CPU
+COMPRESSED_TYPES = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.mp4', '.mkv', '.avi',
+    '.mov', '.webm', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.7z', '.rar', '.jar', '.apk',
+    '.docx', '.xlsx', '.pptx', '.pdf',
+}
+SAMPLE_SIZE = 64 * 1024
+# Sample has to shrink below that part of its size to be worth compressing
+MAX_RATIO = 0.9
+
+
+def parse_setting(setting: str | None) -> tuple[str, int] | None:
+    if not setting or setting == 'none':
+        return None
+    name, _, level = setting.partition(':')
+    if name not in CODECS:
+        raise ValueError(f'Unknown codec {name}')
+    level = int(level) if level else DEFAULT_LEVEL[name]
+    if not 0 <= level <= 9:
+        raise ValueError(f'Level of {name} has to be 0..9')
+    return name, level
+
+
+# Codecs sender offers for file: none if compression is off or file doesn't shrink
+def offer(setting: str | None, path: str) -> list[str]:
+    if parse_setting(setting) is None or os.path.splitext(path)[1].lower() in COMPRESSED_TYPES:
+        return []
+    with open(path, 'rb') as file:
+        sample = file.read(SAMPLE_SIZE)
+    if sample and len(zlib.compress(sample, 1)) > len(sample) * MAX_RATIO:
+        return []
+    return list(CODECS)
+
+
+# Codec receiver picks from offer, None if there is nothing it wants
+def choose(setting: str | None, offered: list[str] | None) -> str | None:
+    own = parse_setting(setting)
+    if own is None or own[0] not in (offered or []):
+        return None
+    return f'{own[0]}:{own[1]}'
+
+
+class Codec:
+    def __init__(self, spec: str, packet_size: int):
+        self.name, self.level = parse_setting(spec)
+        self.block = packet_size if self.name == 'zlib' else max(packet_size, LZMA_BLOCK)
+
+    @classmethod
+    def from_reply(cls, spec: str | None, packet_size: int) -> 'Codec | None':
+        return cls(spec, packet_size) if spec else None
+
+    # Yields (file bytes, compressed block) for `size` bytes of file
+    def blocks(self, file, size: int):
+        if self.name == 'zlib':
+            stream = zlib.compressobj(self.level)
+            compress = lambda data: stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            compress = self.compress_chunk
+        while size > 0:
+            data = file.read(min(self.block, size))
+            if not data:
+                return
+            size -= len(data)
+            yield len(data), compress(data)
+
+    # Returns function which turns every next block back into file bytes
+    def decompressor(self):
+        if self.name == 'zlib':
+            stream = zlib.decompressobj()
+
+            def decompress(payload: bytes) -> bytes:
+                # One byte over the limit lets zlib consume flush marker behind a full block
+                try:
+                    data = stream.decompress(payload, self.block + 1)
+                except zlib.error as e:
+                    raise SocketException(f'Broken compressed block: {e}')
+                if len(data) > self.block or stream.unconsumed_tail:
+                    raise SocketException(f'Compressed block unpacks to more than {self.block} bytes')
+                return data
+            return decompress
+        return lambda payload: self.decompress_chunk(payload, self.block)
+
+    def compress_chunk(self, data: bytes | memoryview) -> bytes:
+        if self.name == 'zlib':
+            return zlib.compress(data, self.level)
+        return lzma.compress(data, lzma.FORMAT_RAW, filters=self.filters(len(data)))
+
+    # Dictionary bigger than block only costs memory, every block is a stream of its own
+    def filters(self, size: int) -> list[dict]:
+        return [{'id': lzma.FILTER_LZMA2, 'preset': self.level, 'dict_size': max(LZMA_MIN_DICT, size)}]
+
+    # Unpacks block compressed on its own, refuses one which unpacks to more than `limit` bytes
+    def decompress_chunk(self, payload: bytes | memoryview, limit: int) -> bytes:
+        try:
+            if self.name == 'zlib':
+                stream = zlib.decompressobj()
+                data = stream.decompress(payload, limit + 1)
+                complete = stream.eof and not stream.unconsumed_tail
+            else:
+                stream = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=self.filters(limit))
+                data = stream.decompress(payload, limit + 1)
+                complete = stream.eof
+        except (zlib.error, lzma.LZMAError) as e:
+            raise SocketException(f'Broken compressed block: {e}')
+        if not complete or len(data) > limit:
+            raise SocketException(f'Compressed block is cut or unpacks to more than {limit} bytes')
+        return data
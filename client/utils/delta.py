@@ -0,0 +1,217 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import zlib
+
+from .framing import FrameType, FrameReader
+from .exception.socket_exception import SocketException
+
+# Signature entry: weak rolling checksum and strong checksum of one basis block
+BLOCK = struct.Struct('!I16s')
+# Copy instruction: first basis block and number of blocks in a row
+COPY = struct.Struct('!II')
+MIN_BLOCK = 2048
+MAX_BLOCK = 128 * 1024
+ADLER_MOD = 65521
+# New version of file is rebuilt under this suffix next to it
+DELTA_SUFFIX = '.delta'
+
+"""
+# Block-level delta sync #
+Receiver already has some version of the file (basis), it's cut into blocks of `block` bytes.
+S <- R (window=0 delta block)       receiver has basis, block is chosen from size of new file
+S <- R [signature] (weak strong)... adler32 + blake2b of every full basis block
+S -> R [copy] (index count)...      take `count` basis blocks starting from `index`
+S -> R [literal] (bytes)...         data which isn't in basis
+S -> R [json] (size digest)         end of delta, blake2b of whole new file
+S <- R (ok)                         rebuilt file matches digest, err - it doesn't
+Sender checks blocks of its file against strong checksums at block steps, that finds unchanged and appended data.
+When a run of matching blocks breaks, sender rolls weak checksum byte by byte for up to `resync` blocks,
+so data inserted or removed in the middle doesn't shift the rest of the file out of sync.
+Receiver builds new file next to basis and replaces basis only when digest matches,
+so broken delta transfer leaves basis as it was and the next one starts from it again.
+"""
+
+
+# Square root of file size keeps both signature and per block overhead small, like rsync does
+def block_size(size: int) -> int:
+    return min(MAX_BLOCK, max(MIN_BLOCK, 1 << math.isqrt(size).bit_length()))
+
+
+# Adler-32 is computed by zlib in C and still can be rolled one byte at a time
+def weak_checksum(data: bytes | bytearray) -> int:
+    return zlib.adler32(data)
+
+
+def strong_checksum(data: bytes | bytearray) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signature(file, block: int) -> bytes:
+    sig = bytearray()
+    while len(data := file.read(block)) == block:
+        sig += BLOCK.pack(weak_checksum(data), strong_checksum(data))
+    return bytes(sig)
+
+
+class DeltaEncoder:
+    def __init__(self, sig: bytes, block: int, literal_size: int = 64 * 1024, resync: int = 2):
+        self.block = block
+        self.literal_size = literal_size
+        self.resync = resync * block
+        self.weak = set()
+        self.strong: dict[bytes, int] = {}
+        for index in range(len(sig) // BLOCK.size):
+            weak, strong = BLOCK.unpack_from(sig, index * BLOCK.size)
+            self.weak.add(weak)
+            self.strong.setdefault(strong, index)
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.size = 0
+        self.literal_bytes = 0
+        self.run: list[int] | None = None
+
+    # Yields (frame_type, payload) of every delta frame, end frame included
+    def frames(self, file):
+        block = self.block
+        data = bytearray()
+        pos = 0
+        start = 0
+        budget = self.resync
+        eof = False
+        while True:
+            # Window data[pos:pos + block] needs one more byte behind it to roll
+            if len(data) - pos <= block and not eof:
+                del data[:start]
+                pos -= start
+                start = 0
+                chunk = file.read(max(self.literal_size, block))
+                if chunk:
+                    self.digest.update(chunk)
+                    self.size += len(chunk)
+                    data += chunk
+                else:
+                    eof = True
+                continue
+            if len(data) - pos < block:
+                break
+            index = self.strong.get(strong_checksum(data[pos:pos + block]))
+            if index is not None:
+                yield from self.flush_literal(data[start:pos])
+                yield from self.add_copy(index)
+                pos += block
+                start = pos
+                budget = self.resync
+                continue
+            if budget > 0:
+                limit = min(budget, len(data) - pos - block)
+                if limit <= 0:
+                    break
+                moved = self.roll(data, pos, limit) - pos
+                budget -= moved
+                pos += moved
+            else:
+                pos += block
+            if pos - start >= self.literal_size:
+                yield from self.flush_literal(data[start:pos])
+                start = pos
+        yield from self.flush_literal(data[start:])
+        yield from self.flush_copies()
+        yield FrameType.json, json.dumps({'size': self.size, 'digest': self.digest.hexdigest()}).encode('utf-8')
+
+    # Moves window by up to `limit` bytes, stops right where weak checksum matches some block
+    def roll(self, data: bytearray, pos: int, limit: int) -> int:
+        block = self.block
+        weak = weak_checksum(data[pos:pos + block])
+        a, b = weak & 0xffff, weak >> 16
+        for p in range(pos, pos + limit):
+            out, new = data[p], data[p + block]
+            a = (a - out + new) % ADLER_MOD
+            b = (b - block * out + a - 1) % ADLER_MOD
+            if (b << 16 | a) in self.weak:
+                return p + 1
+        return pos + limit
+
+    def add_copy(self, index: int):
+        if self.run is not None and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+            return
+        yield from self.flush_copies()
+        self.run = [index, 1]
+
+    def flush_copies(self):
+        if self.run is not None:
+            yield FrameType.copy, COPY.pack(*self.run)
+            self.run = None
+
+    def flush_literal(self, data: bytearray):
+        if not data:
+            return
+        yield from self.flush_copies()
+        self.literal_bytes += len(data)
+        yield FrameType.literal, bytes(data)
+
+
+class DeltaDecoder:
+    """Builds new version of `path` next to it from basis blocks and literal data"""
+
+    def __init__(self, path: str, block: int, copy_size: int = 1024 * 1024):
+        self.path = path
+        self.tmp_path = path + DELTA_SUFFIX
+        self.basis = open(path, 'rb')
+        self.out = open(self.tmp_path, 'wb')
+        self.block = block
+        self.copy_size = max(1, copy_size // block) * block
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.size = 0
+        self.literal_bytes = 0
+        self.ok = False
+
+    def write(self, data: bytes):
+        self.out.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    # Applies one delta frame, returns True after end frame
+    def apply(self, frame_type: int, payload: bytes) -> bool:
+        if frame_type == FrameType.copy:
+            index, count = COPY.unpack(payload)
+            self.basis.seek(index * self.block)
+            left = count * self.block
+            while left:
+                data = self.basis.read(min(self.copy_size, left))
+                if not data or len(data) % self.block:
+                    raise SocketException(f'Copy of blocks {index}..{index + count} is out of basis')
+                self.write(data)
+                left -= len(data)
+            return False
+        if frame_type == FrameType.literal:
+            self.literal_bytes += len(payload)
+            self.write(payload)
+            return False
+        if frame_type == FrameType.json:
+            end = json.loads(payload)
+            self.ok = end['size'] == self.size and end['digest'] == self.digest.hexdigest()
+            return True
+        raise SocketException(f'Unexpected frame of type {frame_type} in delta')
+
+    # Basis is replaced only by file which matched digest
+    def close(self):
+        self.basis.close()
+        self.out.close()
+        if self.ok:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+# Rebuilds `path` from delta read from `reader`, returns decoder with result and stats
+def receive_delta(reader: FrameReader, path: str, block: int) -> DeltaDecoder:
+    decoder = DeltaDecoder(path, block)
+    try:
+        while not decoder.apply(*reader.read()):
+            pass
+    finally:
+        decoder.close()
+    return decoder
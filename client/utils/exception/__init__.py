@@ -1,4 +1,5 @@
 from .socket_exception import SocketException
 from .parser_exception import ParserException
+from .busy_exception import ServerBusy
 
-__all__ = ['SocketException', 'ParserException']
\ No newline at end of file
+__all__ = ['SocketException', 'ParserException', 'ServerBusy']
\ No newline at end of file
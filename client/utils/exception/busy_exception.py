@@ -0,0 +1,7 @@
+from .socket_exception import SocketException
+
+
+class ServerBusy(SocketException):
+    def __init__(self, retry_after: float):
+        super().__init__(f'Server is busy, retry after {retry_after}s')
+        self.retry_after = retry_after
\ No newline at end of file
@@ -0,0 +1,88 @@
+import json
+import socket
+import struct
+
+from .flow_control import recv_exact
+from .exception.socket_exception import SocketException
+
+# Frame header: type of payload + payload length
+HEADER = struct.Struct('!BI')
+# Long text (tree listing) is cut into frames of about that size, whatever chunk size of file data is
+TEXT_FRAME = 4096
+# Id in front of payload of request and reply frames
+REQUEST_ID = struct.Struct('!I')
+# Commands answered with exactly one text frame, only they may go as pipelined requests
+PIPELINED_COMMANDS = frozenset({'echo', 'time', 'stime', 'help', 'mkdir', 'rm', 'stats'})
+
+"""
+# Command channel framing #
+Every control message travels as one frame:
+[type: 1 byte][length: 4 bytes, big endian][payload: length bytes]
+Only raw file contents and flow control acks go unframed, and only after both sides agreed on file size.
+Reader never reads past the end of a frame, so raw file data right behind it stays in socket.
+
+# Pipelined requests #
+C -> S [request] (id + command)     any number of them, client doesn't wait for replies in between
+S -> C [reply] (id + text)          one per request, in order requests came
+Server runs requests one by one like cmd frames. Other commands than PIPELINED_COMMANDS get error reply.
+"""
+
+
+class FrameType:
+    cmd = 1
+    text = 2
+    status = 3
+    json = 4
+    session = 5
+    stream = 6
+    signature = 7
+    copy = 8
+    literal = 9
+    compressed = 10
+    entry = 11
+    request = 12
+    reply = 13
+
+
+class FrameWriter:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    def write(self, frame_type: int, payload: bytes = b''):
+        # Header and payload in one send, small frames shouldn't wait for delayed ack
+        self.sock.sendall(HEADER.pack(frame_type, len(payload)) + payload)
+
+    def write_status(self, code: bytes):
+        self.write(FrameType.status, code)
+
+    def write_text(self, text: str | bytes, frame_type: int = FrameType.text):
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        self.write(frame_type, text)
+
+    def write_json(self, obj: dict, frame_type: int = FrameType.json):
+        self.write(frame_type, json.dumps(obj).encode('utf-8'))
+
+
+class FrameReader:
+    def __init__(self, sock: socket.socket, max_size: int = 16 * 1024 * 1024):
+        self.sock = sock
+        self.max_size = max_size
+
+    def read(self, expected: int | None = None) -> tuple[int, bytes]:
+        frame_type, length = HEADER.unpack(recv_exact(self.sock, HEADER.size))
+        if length > self.max_size:
+            raise SocketException(f'Frame of {length} bytes exceeds limit of {self.max_size}')
+        payload = recv_exact(self.sock, length) if length else b''
+        if expected is not None and frame_type != expected:
+            raise SocketException(f'Expected frame of type {expected}, got {frame_type}')
+        return frame_type, payload
+
+    def read_status(self) -> bytes:
+        return self.read(FrameType.status)[1]
+
+    def read_text(self, frame_type: int = FrameType.text) -> str:
+        return self.read(frame_type)[1].decode('utf-8')
+
+    def read_json(self, frame_type: int = FrameType.json) -> dict:
+        return json.loads(self.read(frame_type)[1])
@@ -0,0 +1,64 @@
+import json
+import math
+import os
+import threading
+
+
+class RangeState:
+    """
+    Ranges of parallel download and how far each of them got, kept in `<file>.ranges` next to the file.
+    Range is [next byte to fetch, end), so broken download resumes every range from the byte it stopped at.
+    Offset is advanced only after bytes are written, state is saved every `save_every` bytes and on exit.
+    """
+
+    def __init__(self, path: str, size: int, ranges: list[list[int]], save_every: int = 4 * 1024 * 1024):
+        self.path = path
+        self.state_path = path + '.ranges'
+        self.size = size
+        self.ranges = ranges
+        self.save_every = save_every
+        self.unsaved = 0
+        self.lock = threading.RLock()
+
+    # Cuts file into `streams` ranges aligned to `align` bytes
+    @classmethod
+    def split(cls, path: str, size: int, streams: int, align: int) -> 'RangeState':
+        step = max(1, math.ceil(size / max(1, streams) / align)) * align
+        return cls(path, size, [[start, min(start + step, size)] for start in range(0, size, step)])
+
+    # Returns saved state of previous download of the same file, None if there is nothing to resume
+    @classmethod
+    def load(cls, path: str, size: int) -> 'RangeState | None':
+        try:
+            with open(path + '.ranges', 'r') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if saved.get('size') != size or not os.path.isfile(path) or os.path.getsize(path) != size:
+            return None
+        return cls(path, size, saved['ranges'])
+
+    def pending(self) -> list[int]:
+        return [i for i, (start, end) in enumerate(self.ranges) if start < end]
+
+    def remaining(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def advance(self, index: int, offset: int):
+        with self.lock:
+            self.unsaved += offset - self.ranges[index][0]
+            self.ranges[index][0] = offset
+            if self.unsaved >= self.save_every:
+                self.save()
+
+    def save(self):
+        with self.lock:
+            self.unsaved = 0
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump({'size': self.size, 'ranges': self.ranges}, file)
+            os.replace(tmp_path, self.state_path)
+
+    def remove(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
@@ -0,0 +1,24 @@
+import socket
+
+
+class ReceiveBuffer:
+    """
+    Preallocated buffer for raw file data. Chunks are read with recv_into straight into it
+    and handed to file.write as memoryview, so receive loop doesn't allocate per fragment.
+    Returned view is only valid until next recv_chunk call.
+    """
+
+    def __init__(self, packet_size: int):
+        self.buff = bytearray(packet_size)
+        self.view = memoryview(self.buff)
+
+    # Returns None if peer closed connection before chunk was complete
+    def recv_chunk(self, sock: socket.socket, size: int) -> memoryview | None:
+        got = 0
+        while got < size:
+            received = sock.recv_into(self.view[got:size])
+            if not received:
+                return None
+            got += received
+        return self.view[:size]
+
@@ -6,3 +6,5 @@ class StatusCode:
     not_found = int.to_bytes(5, length=1, byteorder='big')
     unauthorized = int.to_bytes(6, length=1, byteorder='big')
     none = int.to_bytes(7, length=1, byteorder='big')
+    # Server is overloaded, json frame with retry_after seconds follows
+    busy = int.to_bytes(8, length=1, byteorder='big')
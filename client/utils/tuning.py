@@ -0,0 +1,114 @@
+import math
+import socket
+import struct
+import time
+
+"""
+# Transfer tuning #
+CHUNK_TUNING=fixed  raw file data goes in PACKET_SIZE chunks, socket buffers are kernel's or SOCKET_BUFFER_SIZE
+CHUNK_TUNING=auto   chunk starts at PACKET_SIZE and is doubled while throughput grows, up to MAX_PACKET_SIZE,
+                    and is set back to the best one once it doesn't. Socket buffer of the side is grown
+                    to twice the bandwidth-delay product: measured throughput * rtt of kernel (TCP_INFO, Linux)
+Raw data is a plain byte stream after size is agreed, so every side picks its own chunk and nothing is negotiated.
+Chunk never exceeds half of the agreed window: receiver acks only whole chunks, so sender would stall.
+Chunks are multiples of PACKET_SIZE, progress still counts PACKET_SIZE packets.
+Compressed blocks and UDP datagrams keep PACKET_SIZE, their size is a part of the protocol.
+Control frames don't depend on chunk at all, they are sent whole and read by their length.
+"""
+
+# Seconds of transfer behind one throughput sample
+SAMPLE_TIME = 0.1
+# Chunk keeps growing while doubling brings at least that much more throughput
+GAIN = 1.05
+MAX_SOCKET_BUFFER = 16 * 1024 * 1024
+# tcpi_rtt of Linux struct tcp_info, microseconds
+TCP_INFO_RTT = 68
+
+
+# Smoothed rtt of connection in seconds, None where kernel doesn't tell it
+def tcp_rtt(sock) -> float | None:
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT + 4)
+    except (OSError, AttributeError):
+        return None
+    if len(info) < TCP_INFO_RTT + 4:
+        return None
+    rtt = struct.unpack_from('=I', info, TCP_INFO_RTT)[0]
+    return rtt / 1e6 if rtt else None
+
+
+# Static buffers from SOCKET_BUFFER_SIZE, set before connect/listen so window scale fits them; 0 leaves kernel's
+def set_buffers(sock: socket.socket, size: int):
+    if size <= 0:
+        return
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+
+class ChunkTuner:
+    """Chunk size of one raw transfer, `sending` side grows send buffer, receiving one - receive buffer"""
+
+    def __init__(self, sock, packet_size: int, max_size: int, window: int = 0, auto: bool = False,
+                 sending: bool = True):
+        self.sock = sock
+        self.packet_size = packet_size
+        self.auto = auto
+        limit = min(max_size, window // 2) if window else max_size
+        self.max_size = max(packet_size, limit // packet_size * packet_size) if auto else packet_size
+        self.size = packet_size
+        self.option = socket.SO_SNDBUF if sending else socket.SO_RCVBUF
+        self.best_rate = 0.0
+        self.best_size = packet_size
+        self.growing = self.max_size > packet_size
+        self.sample_bytes = 0
+        self.sample_start = time.monotonic()
+
+    # Progress packets in chunk
+    def packets(self, size: int) -> int:
+        return math.ceil(size / self.packet_size)
+
+    def measured(self, size: int):
+        if not self.auto:
+            return
+        self.sample_bytes += size
+        now = time.monotonic()
+        elapsed = now - self.sample_start
+        if elapsed < SAMPLE_TIME:
+            return
+        rate = self.sample_bytes / elapsed
+        self.sample_bytes = 0
+        self.sample_start = now
+        self.adjust(rate)
+        self.grow_buffer(rate)
+
+    # Hill climbing on throughput, falling to half of the best one (other route, congestion) starts it again
+    def adjust(self, rate: float):
+        if self.growing:
+            if rate >= self.best_rate * GAIN:
+                self.best_rate, self.best_size = rate, self.size
+                if self.size < self.max_size:
+                    self.size = min(self.size * 2, self.max_size)
+                    return
+            self.size = self.best_size
+            self.growing = False
+        elif rate < self.best_rate / 2:
+            self.size = self.best_size = self.packet_size
+            self.best_rate = 0.0
+            self.growing = self.max_size > self.packet_size
+
+    # Buffer is only grown over what kernel already has: setting it turns kernel autotuning off
+    def grow_buffer(self, rate: float):
+        rtt = tcp_rtt(self.sock)
+        if rtt is None:
+            return
+        target = min(int(2 * rate * rtt), MAX_SOCKET_BUFFER)
+        try:
+            if target > self.sock.getsockopt(socket.SOL_SOCKET, self.option):
+                self.sock.setsockopt(socket.SOL_SOCKET, self.option, target)
+        except OSError:
+            pass
@@ -1,28 +1,43 @@
-import math
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import shutil
 import socket
 import signal
 import os
+import tempfile
 import time
 import dotenv
-import json
 
 from threading import Thread
 
-from alive_progress import alive_bar
 from loguru import logger
 
-from utils.download_status import DownloadStatus
 from utils.status_codes import StatusCode
 from utils.session import Session
-
-threads = []
+from utils.async_session import AsyncSession
+from utils.framing import FrameReader, FrameWriter
+from utils.udp_dispatcher import UdpDispatcher
+from utils.parallel_transfer import ParallelTransfers, SharedParallelTransfers
+from utils.session_store import SessionStore
+from utils.directory_index import DirectoryIndex
+from utils.metrics import Metrics, MetricsWriter
+from utils.tuning import set_buffers
+from utils.bandwidth import Bandwidth
+from utils.admission import Admission, AsyncAdmission, reject, reject_stream
 
 
 class Server:
-    def __init__(self):
+    admission_class = Admission
+
+    # `worker` - index of process in pre-fork mode, its state shared with other workers lives in `shared_dir`
+    def __init__(self, worker: int | None = None, shared_dir: str | None = None):
         self.conn = None
-        logger.info("INITIALIZING SERVER...")
-        signal.signal(signal.SIGINT, self.handler)
+        logger.info("INITIALIZING SERVER..." if worker is None else f"INITIALIZING WORKER {worker}, pid {os.getpid()}")
+        # Ctrl+C of workers is handled by supervisor
+        signal.signal(signal.SIGINT, self.handler if worker is None else signal.SIG_IGN)
+        self.worker = worker
+        workers = int(os.getenv('SERVER_WORKERS', 1)) if worker is not None else 1
         self.ip = None
         self.port = None
         self.start_path = os.getenv('SERVER_FILES_PATH')
@@ -30,13 +45,51 @@ class Server:
         self.packets_per_check = int(os.getenv('PACKETS_PER_CHECK'))
         self.start_time = time.time()
         self.addr = None
-        self.current_session = None
         self.server_debug_loading = os.getenv('SERVER_DEBUG_LOADING') == 'true'
         self.enable_check = os.getenv('ENABLE_CHECK') == 'true'
+        self.zero_copy = os.getenv('SERVER_ZERO_COPY') == 'true'
+        self.window_size = int(os.getenv('WINDOW_SIZE', 64)) * self.packet_size if self.enable_check else 0
         self.max_connections = int(os.getenv('SERVER_MAX_CONNECTIONS'))
-        self.sessions: list = []
-        self.cleaner = Thread(target=clean_threads)
-        self.cleaner.start()
+        self.backlog = int(os.getenv('SERVER_BACKLOG', socket.SOMAXCONN))
+        # UDP datagrams can't be routed between workers, every worker has a port of its own and tells it to client
+        self.udp_port = int(os.getenv('SERVER_UDP_PORT')) + (worker or 0)
+        self.udp_dispatcher: UdpDispatcher = None
+        # Empty SERVER_SESSION_JOURNAL turns journal off
+        journal = os.getenv('SERVER_SESSION_JOURNAL') or None
+        if worker is None:
+            self.parallel_transfers = ParallelTransfers()
+        else:
+            self.parallel_transfers = SharedParallelTransfers(shared_dir)
+            # Without journal sessions could be restored only by the worker which served them
+            journal = journal or os.path.join(shared_dir, 'sessions')
+        self.session_store = SessionStore(
+            journal,
+            ttl=float(os.getenv('SERVER_SESSION_TTL', 24 * 60 * 60)),
+            max_sessions=int(os.getenv('SERVER_MAX_SESSIONS', 10000)),
+            shared=worker is not None
+        )
+        self.directory_index = DirectoryIndex(
+            self.start_path, check_interval=float(os.getenv('SERVER_TREE_CHECK_INTERVAL', 5))
+        )
+        self.metrics = Metrics()
+        # Server rate is split between workers evenly, kernel spreads connections evenly too
+        self.bandwidth = Bandwidth(
+            rate=float(os.getenv('SERVER_RATE_LIMIT', 0)) / workers,
+            session_rate=float(os.getenv('SERVER_SESSION_RATE_LIMIT', 0)),
+            burst=float(os.getenv('SERVER_RATE_BURST', 0.25))
+        )
+        self.metrics_file = os.getenv('SERVER_METRICS_FILE')
+        if self.metrics_file and worker is not None:
+            root, ext = os.path.splitext(self.metrics_file)
+            self.metrics_file = f'{root}.{worker}{ext}'
+        self.metrics_interval = float(os.getenv('SERVER_METRICS_INTERVAL', 10))
+        self.admission = self.admission_class(
+            self.max_connections,
+            queue=int(os.getenv('SERVER_ADMISSION_QUEUE', 16)),
+            timeout=float(os.getenv('SERVER_ADMISSION_TIMEOUT', 10)),
+            retry_after=float(os.getenv('SERVER_RETRY_AFTER', 1)),
+            metrics=self.metrics
+        )
         self.sock = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
@@ -52,6 +105,15 @@ class Server:
             socket.SO_KEEPALIVE,
             1
         )
+        if worker is not None:
+            # Every worker listens on the same port, kernel picks one for every new connection
+            self.sock.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_REUSEPORT,
+                1
+            )
+        # Accepted connections inherit buffers of listening socket
+        set_buffers(self.sock, int(os.getenv('SOCKET_BUFFER_SIZE', 0)))
         self.data = bytes()
 
     def start_server(self, ip, port):
@@ -59,176 +121,49 @@ class Server:
             self.ip = ip
             self.port = port
             logger.info("STARTING SERVER...")
+            self.start_udp(ip)
+            self.start_metrics()
             self.sock.bind((ip, port))
             logger.info("SOCKET BINDED")
-            self.sock.listen(1)
+            self.sock.listen(self.backlog)
+            # Accept never waits for a slot: connection either queues in a thread of its own or is rejected at once
             while True:
-                if len(threads) < self.max_connections:
-                    conn, addr = self.sock.accept()
-                    threads.append(Thread(target=self.listen, args=(
-                        self.sock, conn, addr, self.packet_size, self.start_path, self.start_time)))
-                    threads[-1].start()
-                print(threads)
-                time.sleep(0.5)
+                conn, addr = self.sock.accept()
+                if not self.admission.enter():
+                    logger.warning(f"Server is busy, rejected {addr}")
+                    reject(conn, self.admission.retry_after)
+                    continue
+                Thread(target=self.admit, args=(
+                    self.sock, conn, addr, self.packet_size, self.start_path, self.start_time)).start()
         except Exception as e:
             logger.exception(e)
 
-    """
-    RESTORING SESSION
-    #1 S <- C [session_id]
-           if no need to restore session
-    #2     S -> C [ok]
-           ... (create new session)
-           if there is need to restore session
-    #2     S -> C [err]
-    #3     S <- C [ok]
-               if there is no need to restore upload/download
-    #4         S -> C [ok]
-               ... (continue session)
-               if there is need to restore upload/download
-    #4         S -> C [err]
-    #5         S -> C [object] ({download: true/false, client_file_path: str, file_size: int})
-    #6         S <- C [ok]
-    #7         S -> C [ok]
-    #8         S <- C [ok]
-    #9         S <- C [amount of downloaded bytes]
-    #10        S -> C [ok]
-               ... (download/upload process)
-    """
-
-    def restore(self):
+    def admit(self, sock, conn, addr, packet_size, start_path, start_time):
+        if not self.admission.wait():
+            logger.warning(f"No free slot for {addr} in {self.admission.timeout}s, rejected")
+            reject(conn, self.admission.retry_after)
+            return
         try:
-            logger.info('Check if there is need to restore session')
-            session_id = self.conn.recv(self.packet_size).decode('utf-8')  # 1
-            is_saved_session = False
-            for session in self.sessions:
-                if session.get_session_id() == session_id:
-                    self.current_session = session
-                    is_saved_session = True
-                    break
-            if is_saved_session:
-                logger.warning('Previous session was unexpectedly disconnected. Trying to bring it back...')
-                self.conn.send(StatusCode.err)  # 2
-                self.conn.recv(1)  # 3
-                if self.current_session.is_downloading == DownloadStatus.none:
-                    logger.info('Previous session is restored')
-                    self.conn.send(StatusCode.ok)  # 4
-                else:
-                    logger.warning(
-                        'Previous session had some unfinished downloading/uploading. Restoring that actions...')
-                    self.conn.send(StatusCode.err)  # 4
-                    sz = os.path.getsize(
-                        self.start_path +
-                        self.current_session.remote_current_file
-                        .removeprefix('/')
-                        .removeprefix('files/')
-                    )
-                    self.conn.send(  # 5
-                        json.dumps(
-                            {
-                                'download': str(self.current_session.is_downloading == DownloadStatus.download).lower(),
-                                'client_file_path': self.current_session.local_current_file,
-                                'file_size': sz
-                            }
-                        ).encode('utf-8')
-                    )
-                    self.conn.recv(1)  # 6
-                    self.conn.send(StatusCode.ok)  # 7
-                    self.conn.recv(1)  # 8
-                    remote_file_size: bytes = self.conn.recv(self.packet_size)  # 9
-                    self.conn.send(StatusCode.ok)  # 10
-                    if self.current_session.is_downloading == DownloadStatus.download:
-                        self.restore_download(
-                            self.start_path +
-                            self.current_session.remote_current_file
-                            .removeprefix('/')
-                            .removeprefix('files/'),
-                            int(remote_file_size.decode('utf-8')),
-                            sz
-                        )
-                    else:
-                        self.restore_upload(
-                            self.start_path +
-                            self.current_session.remote_current_file
-                            .removeprefix('/')
-                            .removeprefix('files/'),
-                            sz,
-                            int(remote_file_size.decode('utf-8'))
-                        )
-            else:
-                logger.info('No need to restore session')
-                self.current_session = Session(
-                    self.ip,
-                    self.port,
-                    self.packet_size,
-                    self.start_path,
-                    self.start_time
-                )
-                self.current_session.set_session_id(session_id)
-                self.sessions.append(self.current_session)
-                self.conn.send(StatusCode.ok)  # 2
-        except Exception as e:
-            logger.exception(e)
-
-    # That func stands for restoring downloading files from server from broken session
-    def restore_download(self, abs_path: str, sz: int, full_sz: int):
-        to_send = [i for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size))]
-        file = open(abs_path, 'rb')
-        file.seek(sz)
-        check = 0
-        with alive_bar(len(to_send)) as bar:
-            for _ in to_send:
-                bar()
-                data = file.read(self.packet_size)
-                self.conn.send(data)
-                if self.server_debug_loading:
-                    time.sleep(0.001)
-                if self.enable_check:
-                    if check % self.packets_per_check == 0:
-                        self.conn.recv(1)
-                    check += 1
-
-    # That func stands for restoring uploading files to server from broken session
-    def restore_upload(self, abs_path: str, sz: int, full_sz: int):
-        p_bar = [i for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size))]
-        file = open(abs_path, 'ab')
-        downloaded_bytes = 0
-        check = 0
-        with alive_bar(len(p_bar)) as bar:
-            for i in range(math.ceil(sz / self.packet_size), math.ceil(full_sz / self.packet_size)):
-                line = bytes()
-                if full_sz - sz - downloaded_bytes >= self.packet_size:
-                    while len(line) < self.packet_size:
-                        buff = self.conn.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                else:
-                    while len(line) < full_sz - sz - downloaded_bytes:
-                        buff = self.conn.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                if self.enable_check:
-                    if check % self.packets_per_check == 0:
-                        self.conn.recv(1)
-                    check += 1
-                downloaded_bytes += len(line)
-                file.write(line)
-                bar()
+            self.listen(sock, conn, addr, packet_size, start_path, start_time)
+        finally:
+            self.admission.leave()
 
     def listen(self, sock, conn, addr, packet_size, start_path, start_time):
         logger.info("LISTENING FOR CONNECTIONS...")
-        # conn, addr = sock.accept()
         host, port = conn.getpeername()
         logger.info("ACCEPTED CONNECTION: ", f"{host}:{port}")
-        # self.restore()
         current_session = Session(
             host,
             port,
             packet_size,
             start_path,
-            start_time
+            start_time,
+            self.udp_dispatcher,
+            self.parallel_transfers,
+            self.session_store,
+            self.directory_index,
+            self.metrics,
+            self.bandwidth
         )
         current_session.poll(conn)
         logger.warning(
@@ -241,6 +176,16 @@ class Server:
             logger.info("Deleting session...")
             current_session = None
 
+    # UDP transfers of all sessions share one port, datagrams are routed to transfers by id
+    def start_udp(self, ip):
+        self.udp_dispatcher = UdpDispatcher(ip, self.udp_port)
+        self.udp_dispatcher.start()
+
+    # Metrics file is written by a thread of its own, so it's there even when loop or sessions are stuck
+    def start_metrics(self):
+        if self.metrics_file:
+            MetricsWriter(self.metrics, self.metrics_file, self.metrics_interval).start()
+
     def handler(self, signum, frame):
         print("Do you really want to shutdown server? [Y/n] ", end="", flush=True)
         res = input()
@@ -252,39 +197,189 @@ class Server:
     def synchronize_recv(self):
         response = StatusCode.none
         try:
-            self.sock.settimeout(1)
-            response = self.sock.recv(1)
+            self.conn.settimeout(1)
+            response = FrameReader(self.conn).read_status()
         except Exception as e:
             pass
         finally:
-            self.sock.settimeout(None)
+            self.conn.settimeout(None)
             return response
 
     def synchronize_send(self):
         try:
             self.conn.settimeout(0.5)
-            self.conn.send(StatusCode.ok)
+            FrameWriter(self.conn).write_status(StatusCode.ok)
         except Exception as e:
             pass
         finally:
             self.conn.settimeout(None)
 
 
-def clean_threads():
-    while True:
-        to_clean = []
-        for i in range(len(threads)):
-            if not threads[i].is_alive():
-                to_clean.append(i)
-        for i in to_clean:
-            try:
-                threads.pop(i)
-            except:
-                pass
-        time.sleep(2)
+class AsyncServer(Server):
+    """
+    Serves every connection as a coroutine on one event loop: connections are accepted as soon as they arrive
+    and idle sessions don't hold a thread. Sessions over SERVER_MAX_CONNECTIONS wait for a free slot in admission queue.
+    """
+    admission_class = AsyncAdmission
+
+    def __init__(self, worker: int | None = None, shared_dir: str | None = None):
+        super().__init__(worker, shared_dir)
+        self.stopped: asyncio.Event = None
+
+    def start_server(self, ip, port):
+        try:
+            asyncio.run(self.serve(ip, port))
+        except Exception as e:
+            logger.exception(e)
+
+    async def serve(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.stopped = asyncio.Event()
+        logger.info("STARTING ASYNCIO SERVER...")
+        self.start_udp(ip)
+        self.start_metrics()
+        self.sock.bind((ip, port))
+        logger.info("SOCKET BINDED")
+        server = await asyncio.start_server(self.admit, sock=self.sock, backlog=self.backlog)
+        async with server:
+            await self.stopped.wait()
+        logger.info("Server performing shutdown...")
+
+    async def admit(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        if not self.admission.enter():
+            logger.warning(f"Server is busy, rejected {addr}")
+            await reject_stream(reader, writer, self.admission.retry_after)
+            return
+        if not await self.admission.wait():
+            logger.warning(f"No free slot for {addr} in {self.admission.timeout}s, rejected")
+            await reject_stream(reader, writer, self.admission.retry_after)
+            return
+        try:
+            await self.listen(reader, writer)
+        finally:
+            self.admission.leave()
+
+    async def listen(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        host, port = writer.get_extra_info('peername')
+        logger.info("ACCEPTED CONNECTION: ", f"{host}:{port}")
+        current_session = AsyncSession(
+            host,
+            port,
+            self.packet_size,
+            self.start_path,
+            self.start_time,
+            self.udp_dispatcher,
+            self.parallel_transfers,
+            self.session_store,
+            self.directory_index,
+            self.metrics,
+            self.bandwidth
+        )
+        await current_session.poll(reader, writer)
+        logger.warning(
+            f"Session ended: Active: {current_session.is_active}, Shutdown: {current_session.is_requested_shutdown}"
+        )
+        if current_session.is_requested_shutdown:
+            self.stopped.set()
+
+
+class Workers:
+    """
+    Pre-fork mode, SERVER_WORKERS > 1: transfer loops of one process are bound to one core by GIL,
+    so server runs that many worker processes of SERVER_ENGINE, all listening on the same port with SO_REUSEPORT.
+    Sessions are restored by whichever worker accepts the client: session journal is shared
+    (SERVER_SESSION_JOURNAL, or a file in temporary directory of the server without it),
+    so are open parallel downloads, whose data connections may land on any worker.
+    Per worker: UDP port (SERVER_UDP_PORT + index), SERVER_MAX_CONNECTIONS and admission queue, `stats`
+    and metrics file (index is added before extension). SERVER_RATE_LIMIT is split between workers.
+    Worker which crashed is started again, one which exited on shutdown command stops the others,
+    so does one which didn't live for RESPAWN_AFTER seconds: it would fail the same way again.
+    """
+    RESPAWN_AFTER = 1
+
+    def __init__(self, server_class: type[Server], count: int):
+        self.server_class = server_class
+        self.count = count
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self.started: dict[int, float] = {}
+        self.context = multiprocessing.get_context('fork')
+        # Only supervisor keeps write end open, workers see end of file once it's gone
+        self.alive_r, self.alive_w = os.pipe()
+        self.shared_dir = None
+        signal.signal(signal.SIGINT, self.handler)
+
+    def start_server(self, ip, port):
+        logger.info(f"STARTING {self.count} WORKERS...")
+        self.shared_dir = tempfile.mkdtemp(prefix='spolks-')
+        try:
+            for worker in range(self.count):
+                self.spawn(worker, ip, port)
+            while self.processes:
+                multiprocessing.connection.wait([process.sentinel for process in self.processes.values()])
+                if not self.restart_exited(ip, port):
+                    break
+        finally:
+            self.stop()
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    # Starts crashed workers again, False once server has to stop
+    def restart_exited(self, ip, port) -> bool:
+        for worker, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            del self.processes[worker]
+            if process.exitcode == 0:
+                logger.info(f"Worker {worker} stopped, server performing shutdown...")
+                return False
+            if time.monotonic() - self.started[worker] < self.RESPAWN_AFTER:
+                logger.error(f"Worker {worker} failed to start, server performing shutdown...")
+                return False
+            logger.warning(f"Worker {worker} exited with {process.exitcode}, starting it again")
+            self.spawn(worker, ip, port)
+        return True
+
+    def spawn(self, worker: int, ip, port):
+        process = self.context.Process(
+            target=run_worker, args=(self.server_class, worker, self.shared_dir, ip, port, self.alive_r, self.alive_w),
+            name=f'worker-{worker}'
+        )
+        process.start()
+        self.processes[worker] = process
+        self.started[worker] = time.monotonic()
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+        self.processes.clear()
+
+    def handler(self, signum, frame):
+        print("Do you really want to shutdown server? [Y/n] ", end="", flush=True)
+        res = input()
+        if res.lower() == 'y':
+            logger.info("Performing shutdown...")
+            self.stop()
+            exit(0)
+
+
+def run_worker(server_class: type[Server], worker: int, shared_dir: str, ip, port, alive_r: int, alive_w: int):
+    os.close(alive_w)
+    Thread(target=exit_with_supervisor, args=(alive_r,), daemon=True).start()
+    server_class(worker, shared_dir).start_server(ip, port)
+
+
+# Worker must not outlive supervisor, even killed one, or it would keep the port
+def exit_with_supervisor(alive_r: int):
+    os.read(alive_r, 1)
+    os._exit(1)
 
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
-    server = Server()
+    server_class = AsyncServer if os.getenv('SERVER_ENGINE') == 'asyncio' else Server
+    workers = int(os.getenv('SERVER_WORKERS', 1))
+    server = Workers(server_class, workers) if workers > 1 else server_class()
     server.start_server(os.getenv('SERVER_IP'), int(os.getenv('SERVER_PORT')))
@@ -0,0 +1,27 @@
+import pytest
+
+from utils.bandwidth import TokenBucket
+
+
+def test_burst_goes_without_delay():
+    bucket = TokenBucket(1000, 500)
+    assert bucket.reserve(500) == 0.0
+
+
+def test_delay_covers_missing_tokens():
+    bucket = TokenBucket(1000, 500)
+    bucket.reserve(500)
+    assert bucket.reserve(1000) == pytest.approx(1.0, abs=0.05)
+    # Reservations queue up behind each other
+    assert bucket.reserve(500) == pytest.approx(1.5, abs=0.05)
+
+
+def test_idle_bucket_saves_up_to_burst(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('utils.bandwidth.time.monotonic', lambda: now[0])
+    bucket = TokenBucket(1000, 500)
+    bucket.reserve(500)
+    now[0] += 10
+    assert bucket.tokens == 0
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(500) == pytest.approx(0.5)
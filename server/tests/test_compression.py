@@ -0,0 +1,68 @@
+import io
+import os
+
+import pytest
+
+from utils.compression import Codec, choose, offer, parse_setting
+from utils.exception import SocketException
+
+DATA = b''.join(f'2026-10-17 {i} INFO request served in {i % 97} ms\n'.encode() for i in range(20000))
+
+
+@pytest.mark.parametrize('spec', ['zlib:1', 'zlib:6', 'lzma:1'])
+def test_blocks_unpack_to_file(spec):
+    codec = Codec(spec, 4096)
+    decompress = codec.decompressor()
+    blocks = list(codec.blocks(io.BytesIO(DATA), len(DATA)))
+    assert sum(size for size, _ in blocks) == len(DATA)
+    assert sum(len(payload) for _, payload in blocks) < len(DATA)
+    assert b''.join(decompress(payload) for _, payload in blocks) == DATA
+
+
+@pytest.mark.parametrize('spec', ['zlib:6', 'lzma:1'])
+def test_chunk_round_trip(spec):
+    codec = Codec(spec, 4096)
+    chunk = DATA[:4096]
+    assert codec.decompress_chunk(codec.compress_chunk(chunk), 4096) == chunk
+
+
+@pytest.mark.parametrize('spec', ['zlib:6', 'lzma:1'])
+def test_chunk_over_limit_is_refused(spec):
+    codec = Codec(spec, 4096)
+    with pytest.raises(SocketException):
+        codec.decompress_chunk(codec.compress_chunk(DATA[:8192]), 4096)
+
+
+def test_broken_block_is_refused():
+    decompress = Codec('zlib:6', 4096).decompressor()
+    with pytest.raises(SocketException):
+        decompress(b'not zlib at all')
+
+
+def test_settings():
+    assert parse_setting('none') is None
+    assert parse_setting('zlib') == ('zlib', 6)
+    assert parse_setting('lzma:9') == ('lzma', 9)
+    with pytest.raises(ValueError):
+        parse_setting('brotli')
+    with pytest.raises(ValueError):
+        parse_setting('zlib:10')
+
+
+def test_receiver_picks_its_own_codec():
+    assert choose('lzma:3', ['zlib', 'lzma']) == 'lzma:3'
+    assert choose('zlib', []) is None
+    assert choose('none', ['zlib', 'lzma']) is None
+
+
+def test_sender_offers_only_for_compressible_files(tmp_path):
+    text = tmp_path / 'log.txt'
+    text.write_bytes(DATA)
+    noise = tmp_path / 'noise.bin'
+    noise.write_bytes(os.urandom(65536))
+    packed = tmp_path / 'photo.jpg'
+    packed.write_bytes(DATA)
+    assert offer('zlib', str(text)) == ['zlib', 'lzma']
+    assert offer('zlib', str(noise)) == []
+    assert offer('zlib', str(packed)) == []
+    assert offer('none', str(text)) == []
@@ -0,0 +1,72 @@
+import io
+import os
+import random
+
+import pytest
+
+from utils.delta import DELTA_SUFFIX, DeltaEncoder, DeltaDecoder, block_size, signature
+from utils.framing import FrameType
+
+
+def sync(tmp_path, basis: bytes, new: bytes, block: int = 2048) -> DeltaDecoder:
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as file:
+        file.write(basis)
+    with open(path, 'rb') as file:
+        sig = signature(file, block)
+    encoder = DeltaEncoder(sig, block)
+    decoder = DeltaDecoder(path, block)
+    try:
+        for frame in encoder.frames(io.BytesIO(new)):
+            if decoder.apply(*frame):
+                break
+    finally:
+        decoder.close()
+    return decoder
+
+
+@pytest.fixture
+def basis():
+    return random.Random(1).randbytes(256 * 1024)
+
+
+def test_changed_file_is_rebuilt_from_basis(tmp_path, basis):
+    new = basis[:50000] + b'inserted' + basis[50000:200000] + basis[210000:] + b'appended tail'
+    decoder = sync(tmp_path, basis, new)
+    assert decoder.ok
+    assert (tmp_path / 'file.bin').read_bytes() == new
+    # Only the changed spots go as literals
+    assert decoder.literal_bytes < 5 * 2048
+    assert not os.path.exists(str(tmp_path / 'file.bin') + DELTA_SUFFIX)
+
+
+def test_same_file_goes_as_copies_only(tmp_path, basis):
+    decoder = sync(tmp_path, basis, basis)
+    assert decoder.ok
+    assert decoder.literal_bytes == 0
+
+
+def test_empty_basis_sends_whole_file(tmp_path, basis):
+    decoder = sync(tmp_path, b'', basis[:10000])
+    assert decoder.ok
+    assert (tmp_path / 'file.bin').read_bytes() == basis[:10000]
+    assert decoder.literal_bytes == 10000
+
+
+def test_basis_is_kept_when_digest_does_not_match(tmp_path, basis):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as file:
+        file.write(basis)
+    decoder = DeltaDecoder(path, 2048)
+    decoder.apply(FrameType.literal, b'something else')
+    assert decoder.apply(FrameType.json, b'{"size": 14, "digest": "00"}')
+    decoder.close()
+    assert not decoder.ok
+    assert (tmp_path / 'file.bin').read_bytes() == basis
+    assert not os.path.exists(path + DELTA_SUFFIX)
+
+
+def test_block_size_is_bounded():
+    assert block_size(0) == 2048
+    assert block_size(10 ** 12) == 128 * 1024
+    assert 2048 <= block_size(100 * 1024 * 1024) <= 128 * 1024
@@ -0,0 +1,93 @@
+import socket
+
+import pytest
+
+from utils.flow_control import ACK, CumulativeAck, SlidingWindow, agree_window
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    right.setblocking(False)
+    yield left, right
+    left.close()
+    right.close()
+
+
+def acks(sock: socket.socket) -> list[int]:
+    try:
+        data = sock.recv(1024)
+    except BlockingIOError:
+        return []
+    return [ACK.unpack_from(data, i)[0] for i in range(0, len(data), ACK.size)]
+
+
+def test_acks_every_ack_every_bytes(pair):
+    receiver, sender = pair
+    flow = CumulativeAck(receiver, 1000, 100)
+    assert not flow.ack_due(60)
+    flow.received_bytes(60)
+    assert acks(sender) == []
+    assert flow.ack_due(40)
+    flow.received_bytes(40)
+    assert acks(sender) == [100]
+    flow.received_bytes(30)
+    flow.finish()
+    assert acks(sender) == [130]
+
+
+def test_acks_at_least_twice_per_window(pair):
+    receiver, sender = pair
+    flow = CumulativeAck(receiver, 100, 1000)
+    assert flow.ack_every == 50
+    flow.received_bytes(50)
+    assert acks(sender) == [50]
+
+
+def test_final_ack_is_not_repeated(pair):
+    receiver, sender = pair
+    flow = CumulativeAck(receiver, 1000, 100)
+    flow.received_bytes(100)
+    flow.finish()
+    assert acks(sender) == [100]
+
+
+def test_no_acks_without_window(pair):
+    receiver, sender = pair
+    flow = CumulativeAck(receiver, 0, 100)
+    assert not flow.ack_due(1000)
+    flow.received_bytes(1000)
+    flow.finish()
+    assert acks(sender) == []
+
+
+def test_restored_transfer_acks_absolute_offsets(pair):
+    receiver, sender = pair
+    flow = CumulativeAck(receiver, 1000, 100, offset=5000)
+    flow.received_bytes(100)
+    assert acks(sender) == [5100]
+
+
+def test_ack_opens_sliding_window():
+    sender, receiver = socket.socketpair()
+    try:
+        window = SlidingWindow(sender, 200, timeout=0.1)
+        window.wait_open(100)
+        window.sent_bytes(100)
+        window.wait_open(100)
+        window.sent_bytes(100)
+        with pytest.raises(TimeoutError):
+            window.wait_open(100)
+        CumulativeAck(receiver, 200, 100).received_bytes(200)
+        window.wait_open(100)
+        assert window.acked == 200
+        window.finish()
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_agree_window():
+    assert agree_window(100, 50) == 50
+    assert agree_window(0, 50) == 0
+    assert agree_window(100, 0) == 0
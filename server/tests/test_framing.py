@@ -0,0 +1,56 @@
+import socket
+
+import pytest
+
+from utils.framing import HEADER, FrameType, FrameReader, FrameWriter
+from utils.exception import SocketException
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield FrameWriter(left), FrameReader(right, max_size=1024), right
+    left.close()
+    right.close()
+
+
+def test_frames_keep_type_and_payload(pair):
+    writer, reader, _ = pair
+    writer.write_text('hello')
+    writer.write_status(b'\x01')
+    writer.write_json({'size': 10, 'window': 0})
+    writer.write(FrameType.literal)
+    assert reader.read() == (FrameType.text, b'hello')
+    assert reader.read_status() == b'\x01'
+    assert reader.read_json() == {'size': 10, 'window': 0}
+    assert reader.read() == (FrameType.literal, b'')
+
+
+def test_reader_stops_at_end_of_frame(pair):
+    writer, reader, sock = pair
+    writer.write_text('tree')
+    writer.sock.sendall(b'raw file data')
+    assert reader.read_text() == 'tree'
+    assert sock.recv(64) == b'raw file data'
+
+
+def test_unexpected_frame_type_is_refused(pair):
+    writer, reader, _ = pair
+    writer.write_text('not a status')
+    with pytest.raises(SocketException):
+        reader.read_status()
+
+
+def test_oversized_frame_is_refused(pair):
+    writer, reader, _ = pair
+    writer.sock.sendall(HEADER.pack(FrameType.text, 1025))
+    with pytest.raises(SocketException):
+        reader.read()
+
+
+def test_closed_connection_in_the_middle_of_frame(pair):
+    writer, reader, _ = pair
+    writer.sock.sendall(HEADER.pack(FrameType.text, 10) + b'cut')
+    writer.sock.close()
+    with pytest.raises(ConnectionError):
+        reader.read()
@@ -0,0 +1,75 @@
+import json
+
+from utils.download_status import DownloadStatus
+from utils.session_store import SessionStore
+
+
+def journal_lines(path) -> list[dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def test_unfinished_transfer_is_replayed(tmp_path):
+    path = str(tmp_path / 'journal')
+    store = SessionStore(path, save_interval=0)
+    store.begin('a', DownloadStatus.download, 'files/a', 'files/a', 0)
+    store.progress('a', 4096)
+    store.begin('b', DownloadStatus.upload, 'files/b', 'files/b', None)
+    store.finish('b')
+    store.close()
+    store = SessionStore(path)
+    record = store.get('a')
+    assert record.direction == DownloadStatus.download
+    assert record.remote_file == 'files/a'
+    assert record.acked == 4096
+    assert store.get('b') is None
+    store.close()
+
+
+def test_cut_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'journal')
+    store = SessionStore(path)
+    store.begin('a', DownloadStatus.upload, 'files/a', 'files/a', 100)
+    store.close()
+    with open(path, 'a') as file:
+        file.write('{"id": "b", "dir": 1, "rem')
+    store = SessionStore(path)
+    assert store.get('a').acked == 100
+    assert store.get('b') is None
+    store.close()
+
+
+def test_journal_is_compacted_to_live_transfers(tmp_path):
+    path = str(tmp_path / 'journal')
+    store = SessionStore(path)
+    store.begin('live', DownloadStatus.download, 'files/live', 'files/live', 0)
+    for i in range(200):
+        store.begin(str(i), DownloadStatus.download, 'files/x', 'files/x', 0)
+        store.finish(str(i))
+    lines = journal_lines(path)
+    assert len(lines) <= 2 * 1 + 64
+    assert any(line['id'] == 'live' and line['dir'] == DownloadStatus.download for line in lines)
+    store.close()
+    # Loading compacts too
+    store = SessionStore(path)
+    assert journal_lines(path) == [store.get('live').to_json()]
+    store.close()
+
+
+def test_logged_out_session_has_nothing_to_restore(tmp_path):
+    path = str(tmp_path / 'journal')
+    store = SessionStore(path)
+    store.begin('a', DownloadStatus.download, 'files/a', 'files/a', 0)
+    store.remove('a')
+    store.close()
+    store = SessionStore(path)
+    assert store.get('a') is None
+    store.close()
+
+
+def test_oldest_sessions_over_limit_are_dropped():
+    store = SessionStore(max_sessions=2)
+    for session_id in ('a', 'b', 'c'):
+        store.touch(session_id)
+    assert store.get('a') is None
+    assert store.get('b') is not None and store.get('c') is not None
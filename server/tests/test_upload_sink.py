@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from utils.upload_sink import PART_SUFFIX, UploadSink
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(b'old version')
+    return str(path)
+
+
+@pytest.mark.parametrize('coalesce', [0, 4])
+def test_commit_replaces_file(path, coalesce):
+    with UploadSink(path, 11, preallocate=True, coalesce=coalesce, fsync='close') as file:
+        file.write(b'new ')
+        file.write(memoryview(b'version'))
+        # Old file stays until upload is committed
+        assert open(path, 'rb').read() == b'old version'
+        file.commit()
+    assert open(path, 'rb').read() == b'new version'
+    assert not os.path.exists(path + PART_SUFFIX)
+
+
+def test_discard_keeps_old_file(path):
+    file = UploadSink(path, 11)
+    file.write(b'new ')
+    file.discard()
+    assert open(path, 'rb').read() == b'old version'
+    assert not os.path.exists(path + PART_SUFFIX)
+
+
+def test_broken_upload_leaves_part_for_restore(path):
+    with UploadSink(path, 11, coalesce=1024) as file:
+        file.write(b'new ')
+        # Flush before ack puts buffered data into part
+        file.flush()
+    assert open(path + PART_SUFFIX, 'rb').read() == b'new '
+    with UploadSink(path, 11, offset=4) as file:
+        file.write(b'version')
+        file.commit()
+    assert open(path, 'rb').read() == b'new version'
+
+
+def test_writes_land_at_their_offsets(path):
+    with UploadSink(path, 8, coalesce=4) as file:
+        file.seek(4)
+        file.write(b'5678')
+        file.seek(0)
+        file.write(b'1234')
+        assert file.tell() == 4
+        file.commit()
+    assert open(path, 'rb').read() == b'12345678'
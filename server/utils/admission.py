@@ -0,0 +1,126 @@
+import asyncio
+import json
+import socket
+import threading
+
+from .framing import HEADER, FrameType
+from .status_codes import StatusCode
+
+"""
+# Admission control #
+SERVER_MAX_CONNECTIONS      sessions served at once (data connections of parallel downloads included)
+SERVER_ADMISSION_QUEUE      connections which may wait for a free slot, over it new ones are rejected right away
+SERVER_ADMISSION_TIMEOUT    seconds connection may wait in queue before it's rejected
+SERVER_RETRY_AFTER          seconds rejected client is told to wait before it connects again
+SERVER_BACKLOG              listen backlog, connections kernel holds until server accepts them
+Server accepts every connection as soon as it comes, so the backlog only has to cover a burst between two accepts.
+Rejected connection gets, instead of the reply to its first frame:
+S -> C (busy)
+S -> C [json] (retry_after)
+and server closes it. Slot is freed the moment session ends and goes to the connection which waits longest.
+"""
+
+
+class Admission:
+    def __init__(self, slots: int, queue: int, timeout: float, retry_after: float, metrics=None):
+        self.slots = slots
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.metrics = metrics
+        self.active = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.free = threading.Semaphore(slots)
+
+    # Takes place in queue, False if there is no room even there
+    def enter(self) -> bool:
+        with self.lock:
+            if self.active + self.waiting >= self.slots + self.queue:
+                self.count_rejected()
+                return False
+            self.waiting += 1
+            self.count_waiting()
+            return True
+
+    # Waits for a free slot, False if it didn't come in time
+    def wait(self) -> bool:
+        return self.admitted(self.free.acquire(timeout=self.timeout))
+
+    def admitted(self, got_slot: bool) -> bool:
+        with self.lock:
+            self.waiting -= 1
+            self.active += got_slot
+            self.count_waiting()
+            if not got_slot:
+                self.count_rejected()
+        return got_slot
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+        self.free.release()
+
+    def count_waiting(self):
+        if self.metrics is not None:
+            self.metrics.waiting = self.waiting
+
+    def count_rejected(self):
+        if self.metrics is not None:
+            self.metrics.rejected += 1
+
+
+class AsyncAdmission(Admission):
+    """Same queue for asyncio engine, connection awaits its slot"""
+
+    def __init__(self, slots: int, queue: int, timeout: float, retry_after: float, metrics=None):
+        super().__init__(slots, queue, timeout, retry_after, metrics)
+        self.free = asyncio.Semaphore(slots)
+
+    async def wait(self) -> bool:
+        try:
+            await asyncio.wait_for(self.free.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return self.admitted(False)
+        return self.admitted(True)
+
+
+# Busy status and retry hint, both frames in one write
+def busy_reply(retry_after: float) -> bytes:
+    payload = json.dumps({'retry_after': retry_after}).encode('utf-8')
+    return (HEADER.pack(FrameType.status, len(StatusCode.busy)) + StatusCode.busy
+            + HEADER.pack(FrameType.json, len(payload)) + payload)
+
+
+def reject(conn: socket.socket, retry_after: float):
+    try:
+        conn.sendall(busy_reply(retry_after))
+        conn.shutdown(socket.SHUT_WR)
+        # Unread first frame of client would turn close into reset, and reset could take busy reply with it
+        conn.setblocking(False)
+        while conn.recv(4096):
+            pass
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+# Same as reject: client closes once it reads busy reply, so its first frame is read till then or for `timeout`
+async def reject_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, retry_after: float,
+                        timeout: float = 1.0):
+    try:
+        writer.write(busy_reply(retry_after))
+        await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+        await asyncio.wait_for(discard(reader), timeout)
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def discard(reader: asyncio.StreamReader):
+    while await reader.read(4096):
+        pass
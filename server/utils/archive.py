@@ -0,0 +1,160 @@
+import glob
+import os
+import struct
+
+from .framing import HEADER, FrameType
+from .delta import DELTA_SUFFIX
+from .exception.socket_exception import SocketException
+
+# Entry header: number of entry in manifest
+ENTRY = struct.Struct('!I')
+# File is written under this suffix next to its path and replaces it once it's whole
+PART_SUFFIX = '.part'
+# Files of transfers in flight, they are neither listed nor sent
+TEMP_SUFFIXES = (PART_SUFFIX, DELTA_SUFFIX)
+
+"""
+# Archive stream (mdownload / mupload) #
+Many files in one stream, no round trips between them:
+C -> S (mdownload remote_pattern local_dir) or (mupload remote_dir local_pattern)
+X -> R [json] (entries window)          sender's manifest: [path relative to base, size, mtime] of every file
+X <- R [json] (skip window)             numbers of entries receiver already has whole, agreed window
+                                        err status instead if receiver can't take files
+X -> R [entry] (number) + raw bytes     for every entry which isn't skipped, one right after another
+X <- R (ack)...                         cumulative over file bytes of the whole stream, as in download
+C -> S (ok)                             end of stream when window is 0
+Pattern is a file, a directory (taken recursively) or a glob (** matches any depth), matched directories go whole.
+Receiver writes every entry to `<path>.part`, stamps it with sender's mtime and renames it into place once
+it's whole, so entry with the same size and mtime is whole and cut one is never taken for it.
+Archive streams aren't restored with session: broken stream is resumed by running the same command again,
+whole entries are skipped, the cut one is sent again from its start. Size and mtime are all it goes by,
+file changed in place without changing either is taken as whole.
+"""
+
+
+def has_magic(part: str) -> bool:
+    return any(c in part for c in '*?[')
+
+
+# Path inside `root`, refuses one which climbs out of it
+def safe_join(root: str, rel: str) -> str:
+    rel = os.path.normpath(rel.strip('/') or '.')
+    if os.path.isabs(rel) or rel == '..' or rel.startswith('..' + os.sep):
+        raise SocketException(f'Path {rel} is out of shared directory')
+    return os.path.join(root, rel)
+
+
+# Returns (base, manifest) of files which `pattern` matches under `root`,
+# base is directory of non-glob part of pattern, paths in manifest are relative to it
+def collect(root: str, pattern: str) -> tuple[str, list[list]]:
+    pattern = pattern.strip('/') or '.'
+    parts = pattern.split('/')
+    magic = [i for i, part in enumerate(parts) if has_magic(part)]
+    if magic:
+        base = '/'.join(parts[:magic[0]]) or '.'
+        matches = glob.glob(pattern, root_dir=root, recursive=True)
+    else:
+        base = pattern if os.path.isdir(safe_join(root, pattern)) else os.path.dirname(pattern) or '.'
+        matches = [pattern]
+    base_path = safe_join(root, base)
+    files = set()
+    for match in matches:
+        path = safe_join(root, match)
+        if os.path.isfile(path):
+            files.add(path)
+        elif os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.update(os.path.join(directory, name) for name in names)
+    files = {path for path in files if not path.endswith(TEMP_SUFFIXES)}
+    entries = []
+    for path in sorted(files):
+        stat = os.stat(path)
+        entries.append([os.path.relpath(path, base_path).replace(os.sep, '/'), stat.st_size, stat.st_mtime])
+    return base_path, entries
+
+
+# Numbers of entries which are already whole under `root`
+def whole_entries(root: str, entries: list[list]) -> list[int]:
+    skip = []
+    for index, (rel, size, mtime) in enumerate(entries):
+        try:
+            stat = os.stat(safe_join(root, rel))
+        except OSError:
+            continue
+        if stat.st_size == size and int(stat.st_mtime) == int(mtime):
+            skip.append(index)
+    return skip
+
+
+# Returns (path, size, mtime) of entry which header announces
+def next_entry(root: str, entries: list[list], skip: set[int], header: bytes) -> tuple[str, int, float]:
+    index = ENTRY.unpack(header)[0]
+    if index >= len(entries) or index in skip:
+        raise SocketException(f'Unexpected entry {index}')
+    rel, size, mtime = entries[index]
+    if not isinstance(size, int) or size < 0:
+        raise SocketException(f'Bad size {size} of {rel}')
+    path = safe_join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path, size, mtime
+
+
+def entry_header(index: int) -> bytes:
+    return HEADER.pack(FrameType.entry, ENTRY.size) + ENTRY.pack(index)
+
+
+# Yields (data, file bytes in it, is last chunk of entry), header goes together with first chunk of its entry,
+# so small files take one send each
+def entry_chunks(root: str, entries: list[list], skip: list[int], packet_size: int):
+    skip = set(skip)
+    for index, (rel, size, _) in enumerate(entries):
+        if index in skip:
+            continue
+        with open(safe_join(root, rel), 'rb') as file:
+            header = entry_header(index)
+            left = size
+            while True:
+                chunk = file.read(min(packet_size, left))
+                if len(chunk) < min(packet_size, left):
+                    raise SocketException(f'{rel} got shorter while it was sent')
+                left -= len(chunk)
+                yield (header + chunk if header else chunk), len(chunk), not left
+                header = b''
+                if not left:
+                    break
+
+
+def send_entries(sock, flow, root: str, entries: list[list], skip: list[int], packet_size: int, on_entry=None):
+    for data, size, is_last in entry_chunks(root, entries, skip, packet_size):
+        flow.wait_open(size)
+        sock.sendall(data)
+        flow.sent_bytes(size)
+        if is_last and on_entry is not None:
+            on_entry()
+
+
+# Writes every entry which isn't skipped, calls on_entry(path) after entry is whole
+def receive_entries(sock, reader, flow, buffer, root: str, entries: list[list], skip: list[int], packet_size: int,
+                    on_entry=None):
+    skip = set(skip)
+    for _ in range(len(entries) - len(skip)):
+        path, size, mtime = next_entry(root, entries, skip, reader.read(FrameType.entry)[1])
+        part_path = path + PART_SUFFIX
+        try:
+            with open(part_path, 'wb') as file:
+                left = size
+                while left:
+                    chunk = buffer.recv_chunk(sock, min(packet_size, left))
+                    if chunk is None:
+                        raise ConnectionError(f'Connection closed in the middle of {path}')
+                    file.write(chunk)
+                    left -= len(chunk)
+                    flow.received_bytes(len(chunk))
+            os.utime(part_path, (mtime, mtime))
+            os.replace(part_path, path)
+        finally:
+            # Cut entry is sent again whole, its part is of no use
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        if on_entry is not None:
+            on_entry(path)
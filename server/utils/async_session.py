@@ -0,0 +1,234 @@
+import asyncio
+import json
+import time
+
+from loguru import logger
+
+# Local imports
+from .session import Session
+from .udp_dispatcher import UdpDispatcher
+from .parallel_transfer import ParallelTransfers
+from .session_store import SessionStore
+from .directory_index import DirectoryIndex
+from .metrics import Metrics, SessionMetrics
+from .status_codes import StatusCode
+from .zero_copy import ZeroCopySender
+from .flow_control import ACK
+from .framing import HEADER, FrameType, FrameWriter
+from .receive_buffer import ReceiveBuffer
+from .driver import drive_async
+from .bandwidth import Bandwidth, Pacer
+from .exception.socket_exception import SocketException
+
+
+class StreamSocket:
+    """
+    Socket facade over asyncio StreamWriter for code written against blocking sockets (FrameWriter, CumulativeAck).
+    sendall only puts data into transport buffer, caller awaits drain when it's done writing.
+    Everything session writes goes through it, so it counts sent bytes too.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, metrics: SessionMetrics = None):
+        self.writer = writer
+        self.metrics = metrics
+
+    def sendall(self, data: bytes):
+        self.writer.write(data)
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncFrameReader:
+    def __init__(self, reader: asyncio.StreamReader, max_size: int = 16 * 1024 * 1024,
+                 metrics: SessionMetrics = None):
+        self.reader = reader
+        self.max_size = max_size
+        self.metrics = metrics
+
+    async def read_exact(self, size: int) -> bytes:
+        try:
+            data = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Connection closed by peer')
+        if self.metrics is not None:
+            self.metrics.received(len(data))
+        return data
+
+    async def read(self, expected: int | None = None) -> tuple[int, bytes]:
+        frame_type, length = HEADER.unpack(await self.read_exact(HEADER.size))
+        if length > self.max_size:
+            raise SocketException(f'Frame of {length} bytes exceeds limit of {self.max_size}')
+        payload = await self.read_exact(length) if length else b''
+        if expected is not None and frame_type != expected:
+            raise SocketException(f'Expected frame of type {expected}, got {frame_type}')
+        return frame_type, payload
+
+    async def read_status(self, timeout: float | None = None) -> bytes:
+        try:
+            return (await asyncio.wait_for(self.read(FrameType.status), timeout))[1]
+        except (asyncio.TimeoutError, SocketException):
+            return StatusCode.none
+
+    async def read_json(self) -> dict:
+        return json.loads((await self.read(FrameType.json))[1])
+
+
+class AsyncSlidingWindow:
+    """Same window as SlidingWindow, but sender awaits acks instead of blocking in select and awaits its pacer"""
+
+    def __init__(self, reader: AsyncFrameReader, window: int, offset: int = 0, timeout: float = 30, pace=None):
+        self.reader = reader
+        self.window = window
+        self.pace = pace
+        self.sent = offset
+        self.acked = offset
+        self.timeout = timeout
+        # Seconds sender was blocked waiting for acks
+        self.waited = 0.0
+
+    def in_flight(self) -> int:
+        return self.sent - self.acked
+
+    async def read_ack(self, reason: str):
+        try:
+            data = await asyncio.wait_for(self.reader.read_exact(ACK.size), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'{reason} for {self.timeout}s, acked {self.acked} of {self.sent} bytes')
+        self.acked = max(self.acked, ACK.unpack(data)[0])
+
+    async def wait_open(self, size: int):
+        if self.pace is not None:
+            await self.pace.wait(size)
+        if not self.window or not (self.in_flight() and self.in_flight() + size > self.window):
+            return
+        start = time.monotonic()
+        # Oversized chunk is still allowed to go when nothing is in flight
+        while self.in_flight() and self.in_flight() + size > self.window:
+            await self.read_ack('No ack')
+        self.waited += time.monotonic() - start
+
+    def sent_bytes(self, size: int):
+        self.sent += size
+
+    async def finish(self):
+        if not self.window:
+            return
+        start = time.monotonic()
+        while self.acked < self.sent:
+            await self.read_ack('No final ack')
+        self.waited += time.monotonic() - start
+
+
+class AsyncSession(Session):
+    """
+    Session driven by asyncio streams: idle session costs one coroutine instead of a thread.
+    It runs the same handlers as Session, only its I/O steps are coroutines, see driver.py.
+    Replies are buffered in transport and drained before session waits for client and after handler returns.
+    Blocking file work (preallocation, fsync, checksums of delta) and UDP transfers go to worker threads.
+    """
+
+    def __init__(self, ip: str, port: int, packet_size: int, start_path: str, start_time: float,
+                 udp_dispatcher: UdpDispatcher = None, parallel_transfers: ParallelTransfers = None,
+                 session_store: SessionStore = None, directory_index: DirectoryIndex = None,
+                 metrics: Metrics = None, bandwidth: Bandwidth = None):
+        super().__init__(ip, port, packet_size, start_path, start_time, udp_dispatcher, parallel_transfers,
+                         session_store, directory_index, metrics, bandwidth)
+        self.stream_reader: asyncio.StreamReader = None
+        self.stream_writer: asyncio.StreamWriter = None
+
+    async def poll(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stream_reader = reader
+        self.stream_writer = writer
+        self.sock = StreamSocket(writer, self.metrics)
+        self.reader = AsyncFrameReader(reader, metrics=self.metrics)
+        self.writer = FrameWriter(self.sock)
+        recv = None
+        while True:
+            try:
+                recv = await self.receive()
+                if not self.is_active:
+                    logger.info("Client logged out")
+                    break
+            except SocketException:
+                logger.warning("Raised SocketException")
+                break
+            except ConnectionError:
+                logger.info('Client disconnected')
+                break
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if recv is None or not recv:
+                logger.error(f'Received empty data {type(recv)}')
+                break
+        await self.close()
+        self.server_metrics.close(self.metrics)
+
+    async def receive(self) -> bytes:
+        frame_type, self.data = await self.reader.read()
+        await self.run(self.handle_frame(frame_type))
+        await self.stream_writer.drain()
+        return self.data
+
+    def run(self, steps):
+        return drive_async(steps)
+
+    def tcp_socket(self):
+        return self.stream_writer.get_extra_info('socket')
+
+    async def io_read(self, expected: int | None = None) -> tuple[int, bytes]:
+        await self.stream_writer.drain()
+        return await self.reader.read(expected)
+
+    async def io_read_json(self) -> dict:
+        await self.stream_writer.drain()
+        return await self.reader.read_json()
+
+    async def io_read_status(self, timeout: float | None = None) -> bytes:
+        await self.stream_writer.drain()
+        return await self.reader.read_status(timeout)
+
+    # Acks written meanwhile go out on their own, transport sends them while loop waits for data
+    async def io_read_exact(self, buffer: ReceiveBuffer, size: int) -> bytes:
+        return await self.reader.read_exact(size)
+
+    async def io_drain(self):
+        await self.stream_writer.drain()
+
+    async def io_sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def io_pace(self, pace: Pacer, size: int):
+        await pace.wait(size)
+
+    # Plain flush only moves buffered data to page cache, fsync before every ack goes to a thread
+    async def io_flush(self, file):
+        if file.fsync == 'ack':
+            await asyncio.to_thread(file.flush)
+        else:
+            file.flush()
+
+    async def io_blocking(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    async def io_sendfile(self, window, file, offset: int, size: int, on_progress=None):
+        # Transport sends file past StreamSocket, so it's counted here
+        await ZeroCopySender(
+            self.stream_writer.transport,
+            self.packet_size,
+            window
+        ).send_async(file, offset, size, on_progress=on_progress, on_sent=self.metrics.sent)
+
+    def sliding_window(self, window: int, offset: int = 0, pace: Pacer | None = None) -> AsyncSlidingWindow:
+        return AsyncSlidingWindow(self.reader, window, offset=offset, pace=pace)
+
+    async def close(self):
+        logger.info("CLOSING CONNECTION")
+        self.stream_writer.close()
+        try:
+            await self.stream_writer.wait_closed()
+        except ConnectionError:
+            pass
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+import weakref
+
+"""
+# Bandwidth limits #
+SERVER_RATE_LIMIT           bytes per second of all sessions together, 0 - no limit
+SERVER_SESSION_RATE_LIMIT   bytes per second of one client session: its control connection and range streams
+SERVER_RATE_BURST           seconds of rate an idle bucket saves up
+Downloads and uploads have buckets of their own, uplink and downlink are different links.
+Only file data is paced: transfer reserves every chunk in its session bucket, then in server bucket,
+and sleeps until tokens are there. Tokens may go below zero, so reservations queue in order they came.
+Server bucket is reserved `quantum` bytes at a time, one reservation per sleep, so waiting transfers take turns
+quantum by quantum and share server rate equally whatever their chunk size. Transfer which can't use its share
+(slow client, closed window) doesn't reserve it and the others get it.
+Control frames are never paced: interactive commands of every session go ahead of bulk data.
+"""
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes `size` tokens, returns seconds until they are there
+    def reserve(self, size: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            return max(0.0, -self.tokens / self.rate)
+
+
+class Pacer:
+    """Paces file data of one transfer, called with size of chunk before it's sent or after it's received"""
+
+    def __init__(self, session_bucket: TokenBucket | None, server_bucket: TokenBucket | None, quantum: int,
+                 metrics=None):
+        self.session_bucket = session_bucket
+        self.server_bucket = server_bucket
+        self.quantum = quantum
+        self.metrics = metrics
+
+    # Yields seconds to sleep, next reservation is made only after previous sleep
+    def delays(self, size: int):
+        if self.session_bucket is not None:
+            yield self.session_bucket.reserve(size)
+        if self.server_bucket is not None:
+            while size > 0:
+                yield self.server_bucket.reserve(min(self.quantum, size))
+                size -= self.quantum
+
+    def __call__(self, size: int):
+        for delay in self.delays(size):
+            if delay:
+                time.sleep(delay)
+                self.throttled(delay)
+
+    async def wait(self, size: int):
+        for delay in self.delays(size):
+            if delay:
+                await asyncio.sleep(delay)
+                self.throttled(delay)
+
+    def throttled(self, seconds: float):
+        if self.metrics is not None:
+            self.metrics.throttled += seconds
+
+
+class Bandwidth:
+    """Server-wide buckets, session buckets live while any connection of that session holds their pacer"""
+
+    def __init__(self, rate: float = 0, session_rate: float = 0, burst: float = 0.25):
+        self.rate = rate
+        self.session_rate = session_rate
+        self.burst = burst
+        self.server = {direction: TokenBucket(rate, rate * burst) for direction in (DOWNLOAD, UPLOAD)} if rate else {}
+        self.sessions: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    # None when nothing is limited, so transfers skip pacing altogether
+    def pacer(self, session_id: str, direction: str, quantum: int, metrics=None) -> Pacer | None:
+        if not self.rate and not self.session_rate:
+            return None
+        session_bucket = None
+        if self.session_rate:
+            with self.lock:
+                session_bucket = self.sessions.get((session_id, direction))
+                if session_bucket is None:
+                    session_bucket = TokenBucket(self.session_rate, self.session_rate * self.burst)
+                    self.sessions[(session_id, direction)] = session_bucket
+        return Pacer(session_bucket, self.server.get(direction), quantum, metrics)
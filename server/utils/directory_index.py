@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+from .archive import TEMP_SUFFIXES
+
+
+class DirectoryNode:
+    __slots__ = ('mtime', 'entries', 'block')
+
+    def __init__(self, mtime: int, entries: list[tuple[str, bool]]):
+        self.mtime = mtime
+        # (name, is_dir) in the order tree shows them
+        self.entries = entries
+        # Rendered subtree, None once it has to be rendered again
+        self.block: str | None = None
+
+
+class DirectoryIndex:
+    """
+    Server-wide index of files under `root` behind `tree`, draws the same tree as DisplayablePath.
+    Every directory is listed and rendered once, after that `tree` comes from memory.
+    Changes made by sessions (mkdir, rm, upload) mark their directory, it's listed again by the next `tree`,
+    changes made past the server are found by comparing directory mtimes at most every `check_interval` seconds.
+    Only changed directory is listed again, only it and its parents are rendered again.
+    """
+
+    prefix_middle = '├── '
+    prefix_last = '└── '
+    indent_middle = '│   '
+    indent_last = '    '
+
+    def __init__(self, root: str, check_interval: float = 5.0):
+        self.root = os.path.normpath(root)
+        self.check_interval = check_interval
+        self.nodes: dict[str, DirectoryNode] = {}
+        # Directories changed by sessions, they are listed again on next tree
+        self.dirty: set[str] = set()
+        self.checked_at = 0.0
+        self.text: str | None = None
+        self.lock = threading.Lock()
+
+    def render(self) -> str:
+        with self.lock:
+            self.refresh()
+            if self.text is None:
+                block = self.block(self.root)
+                self.text = os.path.basename(self.root) + '/\n' + (block + '\n' if block else '')
+            return self.text
+
+    # Lines of tree under `path` (relative to root) `depth` levels deep, starting from line number `start`.
+    # Lines are made one at a time from index, walk holds only one entry iterator per level.
+    def lines(self, path: str = '', depth: int | None = None, start: int = 0):
+        with self.lock:
+            self.refresh()
+            directory = os.path.normpath(os.path.join(self.root, path))
+            node = self.nodes.get(directory)
+        if node is None:
+            raise FileNotFoundError(f'No directory {path} in index')
+        return self.walk(directory, node, depth, start)
+
+    def walk(self, directory: str, node: DirectoryNode, depth: int | None, start: int):
+        if start == 0:
+            yield os.path.basename(directory) + '/'
+        line = 1
+        # (directory, iterator over its entries, number of entries, indent of its lines)
+        stack = [(directory, enumerate(node.entries), len(node.entries), '')]
+        while stack:
+            directory, entries, total, indent = stack[-1]
+            item = next(entries, None)
+            if item is None:
+                stack.pop()
+                continue
+            i, (name, is_dir) = item
+            is_last = i == total - 1
+            if line >= start:
+                yield indent + (self.prefix_last if is_last else self.prefix_middle) + name + ('/' if is_dir else '')
+            line += 1
+            if not is_dir or (depth is not None and len(stack) >= depth):
+                continue
+            path = os.path.join(directory, name)
+            # Sessions may change index meanwhile, walk goes on with entries it already got
+            child = self.nodes.get(path)
+            if child is not None and child.entries:
+                stack.append((path, enumerate(child.entries), len(child.entries),
+                              indent + (self.indent_last if is_last else self.indent_middle)))
+
+    # Called with path which was created, removed or replaced
+    def invalidate(self, path: str):
+        with self.lock:
+            self.dirty.add(os.path.dirname(os.path.normpath(path)))
+
+    def refresh(self):
+        now = time.monotonic()
+        if not self.nodes:
+            self.scan(self.root)
+            self.dirty.clear()
+            self.checked_at = now
+        for directory in self.dirty:
+            # Directory created by session is listed whole together with its nearest known parent
+            while directory not in self.nodes and len(directory) > len(self.root):
+                directory = os.path.dirname(directory)
+            if directory in self.nodes:
+                self.rescan(directory)
+        self.dirty.clear()
+        if now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            self.check()
+
+    def check(self):
+        for directory in list(self.nodes):
+            node = self.nodes.get(directory)
+            if node is None:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                # Removed directory is dropped when its parent is listed again
+                continue
+            if mtime != node.mtime:
+                self.rescan(directory)
+
+    def list(self, directory: str) -> DirectoryNode:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = [(entry.name, entry.is_dir()) for entry in it]
+        except OSError:
+            mtime, entries = 0, []
+        # Part of upload or delta shows up only once it has replaced the file
+        entries = [(name, is_dir) for name, is_dir in entries if is_dir or not name.endswith(TEMP_SUFFIXES)]
+        entries.sort(key=lambda entry: entry[0].lower())
+        return DirectoryNode(mtime, entries)
+
+    def scan(self, directory: str):
+        node = self.nodes[directory] = self.list(directory)
+        for name, is_dir in node.entries:
+            if is_dir:
+                self.scan(os.path.join(directory, name))
+
+    def rescan(self, directory: str):
+        old = self.nodes[directory]
+        node = self.nodes[directory] = self.list(directory)
+        old_dirs = {name for name, is_dir in old.entries if is_dir}
+        new_dirs = {name for name, is_dir in node.entries if is_dir}
+        for name in old_dirs - new_dirs:
+            self.drop(os.path.join(directory, name))
+        for name in new_dirs - old_dirs:
+            self.scan(os.path.join(directory, name))
+        self.touch(directory)
+
+    def drop(self, directory: str):
+        node = self.nodes.pop(directory, None)
+        if node is None:
+            return
+        for name, is_dir in node.entries:
+            if is_dir:
+                self.drop(os.path.join(directory, name))
+
+    # Cached rendering of directory and every parent of it is stale now
+    def touch(self, directory: str):
+        self.text = None
+        while True:
+            node = self.nodes.get(directory)
+            if node is not None:
+                node.block = None
+            if directory == self.root or len(directory) <= len(self.root):
+                return
+            directory = os.path.dirname(directory)
+
+    def block(self, directory: str) -> str:
+        node = self.nodes[directory]
+        if node.block is None:
+            lines = []
+            for i, (name, is_dir) in enumerate(node.entries):
+                is_last = i == len(node.entries) - 1
+                prefix = self.prefix_last if is_last else self.prefix_middle
+                if not is_dir:
+                    lines.append(prefix + name)
+                    continue
+                lines.append(prefix + name + '/')
+                sub = self.block(os.path.join(directory, name))
+                if sub:
+                    indent = self.indent_last if is_last else self.indent_middle
+                    lines.append(indent + sub.replace('\n', '\n' + indent))
+            node.block = '\n'.join(lines)
+        return node.block
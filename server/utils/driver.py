@@ -0,0 +1,49 @@
+import inspect
+
+"""
+# Handler driver #
+Protocol steps of a session are written once, as generators, and both engines run the same handlers.
+Every place where handler waits for I/O is a `yield` of a function, or of (function, *args),
+driver of the engine runs it and sends its result back into handler:
+threads     `drive` calls it right away, session thread blocks in it
+asyncio     `drive_async` awaits it when it returns an awaitable, AsyncSession overrides I/O steps with coroutines
+Error of a step is thrown into handler at its yield, so except and finally of handlers work as usual.
+Writes don't yield: blocking socket sends in place, asyncio transport buffers them until next drain step.
+"""
+
+
+def drive(steps):
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            func, *args = step if isinstance(step, tuple) else (step,)
+            try:
+                value, error = func(*args), None
+            except Exception as e:
+                value, error = None, e
+    finally:
+        # Handler left at a yield (e.g. task cancelled) runs its finally blocks now
+        steps.close()
+
+
+async def drive_async(steps):
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            func, *args = step if isinstance(step, tuple) else (step,)
+            try:
+                value, error = func(*args), None
+                if inspect.isawaitable(value):
+                    value = await value
+            except Exception as e:
+                value, error = None, e
+    finally:
+        steps.close()
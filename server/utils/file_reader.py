@@ -0,0 +1,106 @@
+import mmap
+import os
+
+"""
+# File readers #
+FILE_READER     how outbound transfers read files:
+                read - plain buffered reads, every chunk is a new bytes object
+                mmap - file is mapped, chunks are memoryview slices of the mapping, nothing is copied in user space
+                fadvise - plain reads, kernel is told access is sequential and asked to prefetch READ_AHEAD bytes
+                ahead of position, so reads are served from page cache instead of waiting for disk
+READ_AHEAD      bytes fadvise reader keeps prefetched, hint is renewed when half of them are read
+Reader acts as file opened 'rb' as far as transfers go (read, seek, tell, fileno, close, `with`),
+so delta, compression, sendfile and UDP sender take it as is.
+Mapped file mustn't shrink while it's sent, touching pages past its end kills the process with SIGBUS.
+Where mmap or posix_fadvise isn't there (empty file, no fadvise on macOS) reader falls back to plain reads.
+"""
+
+READERS = ('read', 'mmap', 'fadvise')
+
+
+def open_reader(path: str, mode: str = 'read', read_ahead: int = 8 * 1024 * 1024):
+    file = open(path, 'rb')
+    if mode == 'mmap':
+        try:
+            return MmapReader(file)
+        except (ValueError, OSError):
+            # Empty file can't be mapped
+            return file
+    if mode == 'fadvise' and hasattr(os, 'posix_fadvise'):
+        return AdvisedReader(file, read_ahead)
+    return file
+
+
+class Reader:
+    def __init__(self, file):
+        self.file = file
+        self.name = file.name
+        self.mode = 'rb'
+        self.pos = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fileno()).st_size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MmapReader(Reader):
+    def __init__(self, file):
+        super().__init__(file)
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.map)
+
+    def read(self, size: int = -1) -> memoryview:
+        data = self.view[self.pos:] if size < 0 else self.view[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Chunk is still held by someone (e.g. transport buffer), mapping goes away with the last of them
+            pass
+        super().close()
+
+
+class AdvisedReader(Reader):
+    def __init__(self, file, read_ahead: int):
+        super().__init__(file)
+        self.read_ahead = read_ahead
+        # Range kernel was last asked to prefetch
+        self.advised = (0, 0)
+        os.posix_fadvise(self.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size: int = -1) -> bytes:
+        start, end = self.advised
+        # Resent UDP chunks go a bit back, that's still in cache
+        if not start <= self.pos <= end - self.read_ahead // 2:
+            os.posix_fadvise(self.fileno(), self.pos, self.read_ahead, os.POSIX_FADV_WILLNEED)
+            self.advised = (self.pos, self.pos + self.read_ahead)
+        if self.file.tell() != self.pos:
+            self.file.seek(self.pos)
+        data = self.file.read(size)
+        self.pos += len(data)
+        return data
@@ -0,0 +1,134 @@
+import select
+import socket
+import struct
+import time
+
+# Cumulative ack: absolute offset in file up to which receiver has written everything
+ACK = struct.Struct('!Q')
+
+"""
+# Sliding window flow control #
+Window is negotiated together with file size:
+S -> R (size window)        window - bytes sender is ready to keep in flight, 0 - no acks
+S <- R (ok)(agreed window)  agreed window = min of both sides, 0 if any side disabled checks
+S -> R (data...)            sender never blocks while unacked bytes fit into agreed window
+S <- R (ack)...             receiver sends cumulative ack every `ack_every` bytes
+S <- R (ack)                final ack (offset == end of file) ends transfer
+"""
+
+
+def agree_window(own: int, proposed: int) -> int:
+    if own <= 0 or proposed <= 0:
+        return 0
+    return min(own, proposed)
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        buff = sock.recv(size - len(data))
+        if not buff:
+            raise ConnectionError('Connection closed by peer')
+        data += buff
+    return bytes(data)
+
+
+# `pace(size)` of both sides blocks while bandwidth limit holds chunk back, it's called even without window
+class SlidingWindow:
+    def __init__(self, sock: socket.socket, window: int, offset: int = 0, timeout: float = 30, pace=None):
+        self.sock = sock
+        self.window = window
+        self.pace = pace
+        self.sent = offset
+        self.acked = offset
+        self.timeout = timeout
+        # Seconds sender was blocked waiting for acks
+        self.waited = 0.0
+        self.__buff = bytearray()
+
+    def in_flight(self) -> int:
+        return self.sent - self.acked
+
+    # Reads acks which are already in socket buffer, waits up to timeout if there are none
+    def poll(self, timeout: float = 0.0) -> bool:
+        got_ack = False
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return got_ack
+            # Never read past ack boundary: next command may already be behind the last ack
+            buff = self.sock.recv(ACK.size - len(self.__buff))
+            if not buff:
+                raise ConnectionError('Connection closed while waiting for ack')
+            self.__buff += buff
+            if len(self.__buff) == ACK.size:
+                self.acked = max(self.acked, ACK.unpack(self.__buff)[0])
+                self.__buff.clear()
+                got_ack = True
+                # Nothing is in flight after full ack, whatever follows belongs to next command
+                if self.acked >= self.sent:
+                    return got_ack
+            timeout = 0.0
+
+    def wait_open(self, size: int):
+        if self.pace is not None:
+            self.pace(size)
+        if not self.window:
+            return
+        self.poll()
+        if not (self.in_flight() and self.in_flight() + size > self.window):
+            return
+        start = time.monotonic()
+        # Oversized chunk is still allowed to go when nothing is in flight
+        while self.in_flight() and self.in_flight() + size > self.window:
+            if not self.poll(self.timeout):
+                raise TimeoutError(f'No ack for {self.timeout}s, acked {self.acked} of {self.sent} bytes')
+        self.waited += time.monotonic() - start
+
+    def sent_bytes(self, size: int):
+        self.sent += size
+
+    def finish(self):
+        if not self.window:
+            return
+        start = time.monotonic()
+        while self.acked < self.sent:
+            if not self.poll(self.timeout):
+                raise TimeoutError(f'No final ack for {self.timeout}s, acked {self.acked} of {self.sent} bytes')
+        self.waited += time.monotonic() - start
+
+
+class CumulativeAck:
+    def __init__(self, sock: socket.socket, window: int, ack_every: int, offset: int = 0, before_ack=None,
+                 pace=None):
+        self.sock = sock
+        self.window = window
+        # Ack at least twice per window, otherwise sender stalls waiting for ack which never comes
+        self.ack_every = max(1, min(ack_every, window // 2)) if window else 0
+        self.received = offset
+        self.acked = offset
+        self.before_ack = before_ack
+        self.pace = pace
+
+    # True if receiving `size` more bytes sends an ack, so receiver can get ready for it in its own way
+    def ack_due(self, size: int) -> bool:
+        return bool(self.window) and self.received + size - self.acked >= self.ack_every
+
+    def received_bytes(self, size: int):
+        self.received += size
+        if self.window and self.received - self.acked >= self.ack_every:
+            self.ack()
+        # Receiver that reads slower makes TCP hold sender back
+        if self.pace is not None:
+            self.pace(size)
+
+    def ack(self):
+        if self.before_ack is not None:
+            self.before_ack()
+        self.sock.sendall(ACK.pack(self.received))
+        self.acked = self.received
+
+    def finish(self):
+        # Periodic ack may already cover the whole file, sending it twice would leave stale bytes in stream
+        if self.window and self.received > self.acked:
+            self.ack()
@@ -0,0 +1,318 @@
+import bisect
+import os
+import threading
+import time
+
+from loguru import logger
+
+"""
+# Transfer metrics #
+Every session keeps its counters in SessionMetrics, server-wide Metrics holds live sessions and folds
+counters of closed ones into totals, so server totals only grow.
+bytes/packets     everything session sent or received: frames, file data, acks, UDP datagrams,
+                  packet is one socket send or receive (one datagram for UDP)
+ack_wait          seconds sender was blocked waiting for acks to open window
+throttled         seconds transfers slept in bandwidth limits
+retransmits       UDP chunks sent again
+commands          latency histogram of every command, from its frame to the end of handler
+active            transfer commands running now
+waiting/rejected  connections waiting for a session slot now and ever rejected by admission control
+Server writes them to SERVER_METRICS_FILE in Prometheus text format every SERVER_METRICS_INTERVAL seconds,
+`stats` command shows the same numbers to client.
+"""
+
+# Upper bounds of latency buckets, seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COMMANDS = {'echo', 'time', 'stime', 'help', 'tree', 'mkdir', 'rm', 'stats', 'logout', 'shutdown', 'download',
+            'upload', 'pdownload', 'mdownload', 'mupload', 'udpdownload', 'udpupload', 'restore', 'range'}
+TRANSFER_COMMANDS = {'download', 'upload', 'pdownload', 'mdownload', 'mupload', 'udpdownload', 'udpupload',
+                     'restore', 'range'}
+COUNTERS = ('bytes_in', 'bytes_out', 'packets_in', 'packets_out', 'ack_wait', 'throttled', 'retransmits')
+SECONDS = {'ack_wait', 'throttled'}
+
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # Last bucket is +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram'):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.count += other.count
+
+    # Upper bound of bucket which holds `q` quantile, None if nothing was observed
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+class SessionMetrics:
+    def __init__(self, peer: str):
+        self.peer = peer
+        self.session_id: str | None = None
+        self.started = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets_in = 0
+        self.packets_out = 0
+        self.ack_wait = 0.0
+        self.throttled = 0.0
+        self.retransmits = 0
+        self.active = 0
+        self.commands: dict[str, Histogram] = {}
+        self.last_flow = None
+        # (label, done, total) of running transfer
+        self.progress: tuple[str, int, int] | None = None
+
+    def received(self, size: int, packets: int = 1):
+        self.bytes_in += size
+        self.packets_in += packets
+
+    def sent(self, size: int, packets: int = 1):
+        self.bytes_out += size
+        self.packets_out += packets
+
+    def observe(self, command: str, seconds: float):
+        # Unknown commands share one histogram, client can't make up new series
+        command = command if command in COMMANDS else 'bad'
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        histogram.observe(seconds)
+
+    # Ack wait of sender side flow, it's counted once, when command which used it is done
+    def add_flow(self, flow):
+        if flow is None or flow is self.last_flow:
+            return
+        self.last_flow = flow
+        self.ack_wait += getattr(flow, 'waited', 0.0)
+
+    def set_progress(self, progress):
+        self.progress = (progress.label, progress.done, progress.total)
+
+    def clear_progress(self, progress):
+        self.progress = None
+
+    # Wire counters of finished UDP transfer
+    def add_udp(self, endpoint):
+        self.sent(endpoint.sent_bytes, endpoint.sent_packets)
+        self.received(endpoint.received_bytes, endpoint.received_packets)
+        self.retransmits += getattr(endpoint, 'retransmits', 0)
+
+
+class Metrics:
+    """Server-wide registry of session metrics"""
+
+    def __init__(self):
+        self.sessions: dict[int, SessionMetrics] = {}
+        self.closed = SessionMetrics('closed')
+        self.closed_sessions = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def session(self, peer: str) -> SessionMetrics:
+        metrics = SessionMetrics(peer)
+        with self.lock:
+            self.sessions[id(metrics)] = metrics
+        return metrics
+
+    def close(self, metrics: SessionMetrics):
+        with self.lock:
+            if self.sessions.pop(id(metrics), None) is None:
+                return
+            self.closed_sessions += 1
+            for name in COUNTERS:
+                setattr(self.closed, name, getattr(self.closed, name) + getattr(metrics, name))
+            for command, histogram in metrics.commands.items():
+                self.closed.commands.setdefault(command, Histogram()).merge(histogram)
+
+    def live(self) -> list[SessionMetrics]:
+        with self.lock:
+            return list(self.sessions.values())
+
+    # Server totals: closed sessions and live ones together
+    def totals(self, live: list[SessionMetrics]) -> tuple[dict, dict[str, Histogram]]:
+        with self.lock:
+            totals = {name: getattr(self.closed, name) for name in COUNTERS}
+            commands = {}
+            for command, histogram in self.closed.commands.items():
+                commands.setdefault(command, Histogram()).merge(histogram)
+        totals['active'] = 0
+        for metrics in live:
+            for name in COUNTERS:
+                totals[name] += getattr(metrics, name)
+            totals['active'] += metrics.active
+            for command, histogram in list(metrics.commands.items()):
+                commands.setdefault(command, Histogram()).merge(histogram)
+        return totals, commands
+
+    # Prometheus text format
+    def render(self) -> str:
+        live = self.live()
+        totals, commands = self.totals(live)
+        lines = [
+            '# TYPE spolks_sessions gauge',
+            f'spolks_sessions {len(live)}',
+            '# TYPE spolks_sessions_closed_total counter',
+            f'spolks_sessions_closed_total {self.closed_sessions}',
+            '# TYPE spolks_connections_waiting gauge',
+            f'spolks_connections_waiting {self.waiting}',
+            '# TYPE spolks_connections_rejected_total counter',
+            f'spolks_connections_rejected_total {self.rejected}',
+            '# TYPE spolks_uptime_seconds gauge',
+            f'spolks_uptime_seconds {time.time() - self.started:.3f}',
+            '# TYPE spolks_active_transfers gauge',
+            f'spolks_active_transfers {totals["active"]}',
+        ]
+        for name in COUNTERS:
+            unit = '_seconds' if name in SECONDS else ''
+            lines.append(f'# TYPE spolks_{name}{unit}_total counter')
+            lines.append(f'spolks_{name}{unit}_total {format_value(totals[name])}')
+        lines.append('# TYPE spolks_command_seconds histogram')
+        for command, histogram in sorted(commands.items()):
+            seen = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                seen += count
+                lines.append(f'spolks_command_seconds_bucket{{command="{command}",le="{bound}"}} {seen}')
+            lines.append(f'spolks_command_seconds_sum{{command="{command}"}} {histogram.total:.6f}')
+            lines.append(f'spolks_command_seconds_count{{command="{command}"}} {histogram.count}')
+        for name in COUNTERS + ('active',):
+            unit = '_seconds' if name in SECONDS else ''
+            kind = 'gauge' if name == 'active' else 'counter'
+            metric = f'spolks_session_{name}{unit}' + ('' if kind == 'gauge' else '_total')
+            lines.append(f'# TYPE {metric} {kind}')
+            for metrics in live:
+                lines.append(f'{metric}{{session="{label(metrics.session_id or "")}",peer="{label(metrics.peer)}"}} '
+                             f'{format_value(getattr(metrics, name))}')
+        return '\n'.join(lines) + '\n'
+
+    # Human-readable summary for `stats` command, sessions which moved most bytes first
+    def summary(self, top: int = 20) -> str:
+        live = self.live()
+        totals, commands = self.totals(live)
+        lines = [
+            f'Sessions: {len(live)} live, {self.closed_sessions} closed, active transfers: {totals["active"]}, '
+            f'connections waiting: {self.waiting}, rejected: {self.rejected}',
+            f'Bytes in/out: {totals["bytes_in"]}/{totals["bytes_out"]}, '
+            f'packets in/out: {totals["packets_in"]}/{totals["packets_out"]}',
+            f'Ack wait: {totals["ack_wait"]:.3f}s, throttled: {totals["throttled"]:.3f}s, '
+            f'UDP retransmits: {totals["retransmits"]}',
+            'Commands:          count    p50 <=    p99 <=    total',
+        ]
+        for command, histogram in sorted(commands.items()):
+            lines.append(f'  {command:<12} {histogram.count:>9} {format_bound(histogram.quantile(0.5)):>9} '
+                         f'{format_bound(histogram.quantile(0.99)):>9} {histogram.total:>8.3f}s')
+        lines.append('Sessions:')
+        live.sort(key=lambda metrics: metrics.bytes_in + metrics.bytes_out, reverse=True)
+        for metrics in live[:top]:
+            lines.append(f'  {metrics.session_id} {metrics.peer} in {metrics.bytes_in} out {metrics.bytes_out} '
+                         f'ack wait {metrics.ack_wait:.3f}s throttled {metrics.throttled:.3f}s '
+                         f'retransmits {metrics.retransmits} '
+                         f'active {metrics.active} up {time.time() - metrics.started:.0f}s')
+            if metrics.progress is not None:
+                transfer, done, total = metrics.progress
+                lines.append(f'    {transfer}: {done}/{total} packets')
+        if len(live) > top:
+            lines.append(f'  ... {len(live) - top} more')
+        return '\n'.join(lines)
+
+
+def format_value(value: int | float) -> str:
+    return str(value) if isinstance(value, int) else f'{value:.6f}'
+
+
+# Session id comes from client, it must not break the file
+def label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(bound: float | None) -> str:
+    if bound is None:
+        return '-'
+    if bound == float('inf'):
+        return f'>{BUCKETS[-1]:g}s'
+    return f'{bound * 1000:g}ms' if bound < 1 else f'{bound:g}s'
+
+
+class MetricsWriter:
+    """Writes metrics to `path` every `interval` seconds, file is replaced whole, so readers never see half of it"""
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.write()
+            time.sleep(self.interval)
+
+    def write(self):
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w') as file:
+                file.write(self.metrics.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Can't write metrics: {e}")
+
+
+class CountingSocket:
+    """Socket proxy which counts bytes and packets of session, everything else goes to socket as is"""
+
+    def __init__(self, sock, metrics: SessionMetrics):
+        self.sock = sock
+        self.metrics = metrics
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.metrics.sent(len(data))
+
+    def send(self, data) -> int:
+        sent = self.sock.send(data)
+        self.metrics.sent(sent)
+        return sent
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        sent = self.sock.sendfile(file, offset, count)
+        self.metrics.sent(sent)
+        return sent
+
+    def recv(self, size: int, *args) -> bytes:
+        data = self.sock.recv(size, *args)
+        if data:
+            self.metrics.received(len(data))
+        return data
+
+    def recv_into(self, buffer, size: int = 0, *args) -> int:
+        received = self.sock.recv_into(buffer, size, *args)
+        if received:
+            self.metrics.received(received)
+        return received
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
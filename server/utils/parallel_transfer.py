@@ -0,0 +1,92 @@
+import json
+import os
+import random
+import threading
+
+"""
+# Parallel range download #
+C -> S (pdownload remote local)         on control connection
+S -> C (ok)(ok)                         args are fine, file exists
+S -> C (size transfer_id streams)       streams - most data connections server wants for one transfer
+S <- C (ok)                             client opened local file, err if it can't
+    every data connection is a new TCP connection to the same port:
+    C -> S [stream] (session_id transfer_id offset size)
+    S -> C (ok) + raw bytes [offset, offset + size), then server closes data connection
+    err instead of ok if transfer isn't open for that session or range is out of file
+S <- C (ok)                             on control connection, every range is written, err - some ranges failed
+Transfer stays open on server until that final status. Broken range is requested again from the byte it stopped at,
+client keeps ranges progress next to the file, so next pdownload of the same file resumes every range.
+"""
+
+
+class ParallelTransfers:
+    """
+    Server-wide registry of open parallel downloads.
+    Data connections are sessions of their own, they find the file by transfer id and prove it's theirs by session id.
+    """
+
+    def __init__(self):
+        self.transfers: dict[int, tuple[str, str, int]] = {}
+        self.lock = threading.Lock()
+
+    def open(self, session_id: str, abs_path: str, size: int) -> int:
+        with self.lock:
+            transfer_id = random.getrandbits(32)
+            while transfer_id in self.transfers:
+                transfer_id = random.getrandbits(32)
+            self.transfers[transfer_id] = (session_id, abs_path, size)
+        return transfer_id
+
+    # Returns (abs_path, size) of the transfer, None if it isn't open for that session
+    def get(self, transfer_id: int, session_id: str) -> tuple[str, int] | None:
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+        if transfer is None or transfer[0] != session_id:
+            return None
+        return transfer[1], transfer[2]
+
+    def close(self, transfer_id: int):
+        with self.lock:
+            self.transfers.pop(transfer_id, None)
+
+
+class SharedParallelTransfers(ParallelTransfers):
+    """
+    Registry of server workers, one file per open transfer in a directory they share:
+    data connection may be accepted by another worker than its control connection.
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+
+    def open(self, session_id: str, abs_path: str, size: int) -> int:
+        while True:
+            transfer_id = random.getrandbits(32)
+            try:
+                fd = os.open(self.path(transfer_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                continue
+            # Client learns transfer id only after file is written
+            with os.fdopen(fd, 'w') as file:
+                json.dump([session_id, abs_path, size], file)
+            return transfer_id
+
+    def get(self, transfer_id: int, session_id: str) -> tuple[str, int] | None:
+        try:
+            with open(self.path(transfer_id)) as file:
+                transfer = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if transfer[0] != session_id:
+            return None
+        return transfer[1], transfer[2]
+
+    def close(self, transfer_id: int):
+        try:
+            os.remove(self.path(transfer_id))
+        except FileNotFoundError:
+            pass
+
+    def path(self, transfer_id: int) -> str:
+        return os.path.join(self.directory, f'{int(transfer_id)}.transfer')
@@ -0,0 +1,152 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+from alive_progress import alive_bar
+from loguru import logger
+
+"""
+# Transfer progress events #
+Transfer loop calls progress step once per packet (or with number of packets), that's only a counter increment.
+Sinks get `update` at most `rate` times per second per transfer, `start` before the first packet
+and `finish` after the last one, also when transfer breaks. Server picks sinks with SERVER_PROGRESS:
+bar     terminal bar of alive_progress, only one transfer at a time can draw it
+log     loguru line every `LogSink.interval` seconds
+none    nothing is rendered, for headless server
+Session adds its own sinks on top: restore journal and transfer metrics.
+"""
+
+DEFAULT_RATE = 4.0
+
+# alive_progress hooks process-wide stdout, so only one transfer at a time can draw a bar
+_bar_lock = threading.Lock()
+
+
+class Progress:
+    """Throttled progress of one transfer, called like alive_progress bar"""
+
+    def __init__(self, total: int, label: str = '', sinks: list = (), rate: float = DEFAULT_RATE):
+        self.total = total
+        self.label = label
+        self.sinks = list(sinks)
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.done = 0
+        self.started = time.monotonic()
+        self.next_at = self.started + self.interval
+
+    def __call__(self, count: int = 1):
+        self.done += count
+        if not self.sinks:
+            return
+        now = time.monotonic()
+        if now >= self.next_at:
+            self.next_at = now + self.interval
+            self.emit('update')
+
+    def emit(self, event: str):
+        for sink in self.sinks:
+            try:
+                getattr(sink, event)(self)
+            except Exception as e:
+                # Broken sink must not break transfer
+                logger.error(f'Progress sink {type(sink).__name__} failed: {e}')
+
+
+class ProgressSink:
+    def start(self, progress: Progress):
+        pass
+
+    def update(self, progress: Progress):
+        pass
+
+    def finish(self, progress: Progress):
+        pass
+
+
+class BarSink(ProgressSink):
+    def __init__(self):
+        self.bar = None
+        self.context = None
+        self.shown = 0
+
+    def start(self, progress: Progress):
+        if not _bar_lock.acquire(blocking=False):
+            return
+        self.context = alive_bar(progress.total, title=progress.label or None)
+        self.bar = self.context.__enter__()
+
+    def update(self, progress: Progress):
+        if self.bar is None:
+            return
+        self.bar(progress.done - self.shown)
+        self.shown = progress.done
+
+    def finish(self, progress: Progress):
+        if self.bar is None:
+            return
+        try:
+            self.update(progress)
+            self.context.__exit__(None, None, None)
+        finally:
+            self.bar = self.context = None
+            _bar_lock.release()
+
+
+class LogSink(ProgressSink):
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.logged_at = 0.0
+
+    def start(self, progress: Progress):
+        self.logged_at = progress.started
+        logger.info(f'{progress.label}: started, {progress.total} packets')
+
+    def update(self, progress: Progress):
+        now = time.monotonic()
+        if now - self.logged_at < self.interval:
+            return
+        self.logged_at = now
+        logger.info(f'{progress.label}: {progress.done}/{progress.total} '
+                    f'({100 * progress.done / max(progress.total, 1):.0f}%), '
+                    f'{progress.done / max(now - progress.started, 1e-9):.0f} packets/s')
+
+    def finish(self, progress: Progress):
+        elapsed = time.monotonic() - progress.started
+        logger.info(f'{progress.label}: {progress.done}/{progress.total} packets in {elapsed:.2f}s')
+
+
+class CallbackSink(ProgressSink):
+    """Calls `on_update(progress)` on every event, `on_finish(progress)` at the end if it's given"""
+
+    def __init__(self, on_update, on_finish=None):
+        self.on_update = on_update
+        self.on_finish = on_finish
+
+    def update(self, progress: Progress):
+        self.on_update(progress)
+
+    def finish(self, progress: Progress):
+        (self.on_finish or self.on_update)(progress)
+
+
+SINKS = {'bar': BarSink, 'log': LogSink}
+
+
+# Sink factories for SERVER_PROGRESS value, e.g. "bar", "log", "bar,log", "none"
+def parse_sinks(setting: str | None) -> list:
+    names = [name.strip() for name in (setting or 'bar').split(',') if name.strip() and name.strip() != 'none']
+    unknown = [name for name in names if name not in SINKS]
+    if unknown:
+        raise ValueError(f'Unknown progress sinks {", ".join(unknown)}')
+    return [SINKS[name] for name in names]
+
+
+@contextmanager
+def progress_bar(total: int, label: str = '', sinks: list = (), rate: float = DEFAULT_RATE):
+    progress = Progress(total, label, sinks, rate)
+    progress.emit('start')
+    try:
+        yield progress
+    finally:
+        progress.emit('finish')
@@ -1,28 +1,51 @@
 import errno
+import json
 import math
 import os
 import socket
 import time
 import uuid
 
-from pathlib import Path
-from alive_progress import alive_bar
+from contextlib import contextmanager
 from loguru import logger
 from datetime import datetime as dt
 
 # Local imports
+from .progress import progress_bar, parse_sinks, CallbackSink
 from .status_codes import StatusCode
 from .download_status import DownloadStatus
-from .displayable_path import DisplayablePath
+from .zero_copy import ZeroCopySender
+from .flow_control import SlidingWindow, CumulativeAck, agree_window
+from .framing import TEXT_FRAME, REQUEST_ID, PIPELINED_COMMANDS, FrameType, FrameReader, FrameWriter
+from .receive_buffer import ReceiveBuffer
+from .driver import drive
+from .file_reader import open_reader
+from .upload_sink import PART_SUFFIX, UploadSink
+from .udp_transfer import UdpSender, UdpReceiver
+from .udp_dispatcher import UdpDispatcher, UdpChannel
+from .parallel_transfer import ParallelTransfers
+from .delta import DeltaEncoder, DeltaDecoder, block_size, signature
+from .session_store import SessionStore
+from .compression import Codec, offer, choose
+from .archive import collect, whole_entries, next_entry, entry_chunks
+from .directory_index import DirectoryIndex
+from .metrics import Metrics, CountingSocket, TRANSFER_COMMANDS
+from .tuning import ChunkTuner
+from .bandwidth import Bandwidth, Pacer, DOWNLOAD, UPLOAD
 from .commands import Parser
 from .exception.socket_exception import SocketException
 
 
 class Session:
-    def __init__(self, ip: str, port: int, packet_size: int, start_path: str, start_time: float):
+    def __init__(self, ip: str, port: int, packet_size: int, start_path: str, start_time: float,
+                 udp_dispatcher: UdpDispatcher = None, parallel_transfers: ParallelTransfers = None,
+                 session_store: SessionStore = None, directory_index: DirectoryIndex = None,
+                 metrics: Metrics = None, bandwidth: Bandwidth = None):
         self.start_path = start_path
         logger.info(f"Starting session for {ip, port}")
         self.sock: socket.socket = None
+        self.reader: FrameReader = None
+        self.writer: FrameWriter = None
         self.ip = ip
         self.port = port
         self.packet_size = packet_size
@@ -34,19 +57,46 @@ class Session:
         self.server_debug_loading = os.getenv('SERVER_DEBUG_LOADING') == 'true'
         self.packets_per_check = int(os.getenv('PACKETS_PER_CHECK'))
         self.enable_check = os.getenv('ENABLE_CHECK') == 'true'
+        self.zero_copy = os.getenv('SERVER_ZERO_COPY') == 'true'
+        self.delta_sync = os.getenv('DELTA_SYNC') == 'true'
+        self.compression = os.getenv('COMPRESSION', 'none')
+        self.chunk_tuning = os.getenv('CHUNK_TUNING', 'fixed') == 'auto'
+        self.max_packet_size = int(os.getenv('MAX_PACKET_SIZE', packet_size))
+        self.file_reader = os.getenv('FILE_READER', 'read')
+        self.read_ahead = int(os.getenv('READ_AHEAD', 8 * 1024 * 1024))
+        self.upload_preallocate = os.getenv('SERVER_UPLOAD_PREALLOCATE', 'true') == 'true'
+        self.write_coalesce = int(os.getenv('SERVER_WRITE_COALESCE', 1024 * 1024))
+        self.upload_fsync = os.getenv('SERVER_UPLOAD_FSYNC', 'none')
+        self.progress_sinks = parse_sinks(os.getenv('SERVER_PROGRESS', 'bar'))
+        self.progress_rate = float(os.getenv('SERVER_PROGRESS_RATE', 4))
+        self.window_size = int(os.getenv('WINDOW_SIZE', 64)) * packet_size if self.enable_check else 0
+        self.transfer: SlidingWindow | CumulativeAck | None = None
         self.is_downloading = DownloadStatus.none
         self.start_time = start_time
         self.__session_id = str(uuid.uuid4())
+        self.server_metrics = metrics if metrics is not None else Metrics()
+        self.metrics = self.server_metrics.session(f'{ip}:{port}')
+        self.metrics.session_id = self.__session_id
         self.udp_port = int(os.getenv('SERVER_UDP_PORT'))
-        self.udp_sock = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_DGRAM,
+        self.udp_window = int(os.getenv('UDP_WINDOW_SIZE', 256))
+        self.udp_dispatcher = udp_dispatcher
+        self.parallel_transfers = parallel_transfers
+        self.session_store = session_store if session_store is not None else SessionStore()
+        self.directory_index = directory_index if directory_index is not None else DirectoryIndex(start_path)
+        self.bandwidth = bandwidth if bandwidth is not None else Bandwidth()
+        # Data connections take connection slots too, one is left for control connection
+        self.parallel_streams = max(
+            1, min(int(os.getenv('PARALLEL_STREAMS', 4)), int(os.getenv('SERVER_MAX_CONNECTIONS')) - 1)
         )
-        # self.udp_sock.bind((self.ip, self.udp_port))
         self.data = bytes()
+        # Id of pipelined request being run, its reply goes in reply frame
+        self.request_id: int | None = None
 
     def poll(self, sock: socket.socket):
-        self.sock = sock
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = CountingSocket(sock, self.metrics)
+        self.reader = FrameReader(self.sock)
+        self.writer = FrameWriter(self.sock)
         recv = None
         while True:
             try:
@@ -58,6 +108,9 @@ class Session:
             except SocketException:
                 logger.warning("Raised SocketException")
                 break
+            except ConnectionError:
+                logger.info('Client disconnected')
+                break
             except IOError as e:
                 logger.exception('Client disconnected unexpectedly')
                 if e.errno == errno.EPIPE:
@@ -73,55 +126,332 @@ class Session:
                 logger.error(f'Received empty data {type(recv)}')
                 break
         self.sock.close()
+        self.server_metrics.close(self.metrics)
 
     def receive(self) -> bytes:
-        self.data = self.sock.recv(self.packet_size)
-        try:
-            if not self.data.decode('utf-8'):
-                raise Exception
-        except Exception:
+        frame_type, self.data = self.reader.read()
+        self.run(self.handle_frame(frame_type))
+        return self.data
+
+    # Runs steps of handler, blocking ones block session thread, see driver.py
+    def run(self, steps):
+        return drive(steps)
+
+    # Steps of whatever frame from client asks for, the same for both engines
+    def handle_frame(self, frame_type: int):
+        if frame_type == FrameType.stream:
+            with self.measure('range'):
+                yield from self.handle_stream()
+            return
+        if frame_type == FrameType.session:
+            with self.measure('restore'):
+                yield from self.restore(self.data.decode('utf-8'))
             return
-        if not self.data:
-            return self.data
+        cmd = self.parse_frame(frame_type)
+        if cmd is not None:
+            with self.measure(cmd):
+                yield from self.dispatch(cmd)
+
+    # Counts command in latency histogram and, while it runs, in active transfers if it is one
+    @contextmanager
+    def measure(self, cmd: str):
+        is_transfer = cmd in TRANSFER_COMMANDS
+        self.metrics.active += is_transfer
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metrics.active -= is_transfer
+            self.metrics.observe(cmd, time.perf_counter() - start)
+            self.metrics.add_flow(self.transfer)
+
+    # Returns command to dispatch, None if frame was handled in place
+    def parse_frame(self, frame_type: int) -> str | None:
+        self.request_id = None
+        if frame_type == FrameType.request:
+            if len(self.data) < REQUEST_ID.size:
+                raise SocketException('Request frame without id')
+            self.request_id, = REQUEST_ID.unpack_from(self.data)
+            self.data = self.data[REQUEST_ID.size:]
+        elif frame_type != FrameType.cmd:
+            raise SocketException(f'Expected command frame, got {frame_type}')
+        try:
+            is_empty = not self.data.decode('utf-8')
+        except UnicodeDecodeError:
+            is_empty = True
+        if is_empty:
+            raise SocketException('Got empty command')
         logger.info(f"Got {self.data} from client")
         self.parser.parse(self.data)
         cmd = self.parser.get_cmd()
+        if self.request_id is not None and cmd not in PIPELINED_COMMANDS:
+            self.send(f"{cmd} can't be pipelined".encode('utf-8'))
+            return None
         logger.info(f"Processing cmd {cmd.upper()}")
+        return cmd
+
+    # Returns steps of command handler
+    def dispatch(self, cmd: str):
         if cmd == "echo":
-            self.handle_echo()
+            return self.handle_echo()
         elif cmd == "time":
-            self.handle_time()
+            return self.handle_time()
         elif cmd == "stime":
-            self.handle_stime()
+            return self.handle_stime()
         elif cmd == "help":
-            self.handle_help()
+            return self.handle_help()
         elif cmd == 'tree':
-            self.handle_tree()
+            return self.handle_tree()
         elif cmd == 'mkdir':
-            self.handle_mkdir()
+            return self.handle_mkdir()
         elif cmd == 'rm':
-            self.handle_remove()
+            return self.handle_remove()
         elif cmd == 'download':
-            self.handle_download()
+            return self.handle_download()
         elif cmd == 'upload':
-            self.handle_upload()
+            return self.handle_upload()
+        elif cmd == 'pdownload':
+            return self.handle_parallel_download()
+        elif cmd == 'mdownload':
+            return self.handle_archive_download()
+        elif cmd == 'mupload':
+            return self.handle_archive_upload()
         elif cmd == "udpdownload":
-            self.handle_udp_download()
+            return self.handle_udp_download()
         elif cmd == "udpupload":
-            self.handle_udp_upload()
+            return self.handle_udp_upload()
+        elif cmd == 'stats':
+            return self.handle_stats()
         elif cmd == 'logout':
-            self.handle_logout()
+            return self.handle_logout()
         elif cmd == 'shutdown':
-            self.handle_shutdown()
+            return self.handle_shutdown()
         else:
-            self.handle_bad_request()
-        return self.data
+            return self.handle_bad_request()
+
+    """
+    RESTORING SESSION
+    #1 S <- C [session_id]
+           if no need to restore session
+    #2     S -> C [ok]
+           ... (create new session)
+           if there is need to restore session
+    #2     S -> C [err]
+    #3     S <- C [ok]
+               if there is no need to restore upload/download
+    #4         S -> C [ok]
+               ... (continue session)
+               if there is need to restore upload/download
+    #4         S -> C [err]
+    #5         S -> C [object] ({download: true/false, client_file_path: str, file_size: int, offset: int, window: int})
+    #6         S <- C [ok]
+    #7         S -> C [ok]
+    #8         S <- C [ok]
+    #9         S <- C [object] ({file_size: int, window: int}) (amount of downloaded bytes, agreed window)
+    #10        S -> C [ok] (err if server can't go on with upload, restore ends there)
+               ... (download/upload process)
+    #11        S <- C [ok] (only download without acks: client got all of it)
+    Offset is the acked byte count of broken transfer, side which received data truncates its file to it
+    before resuming. Without acks it's -1: receiver's file is kept as it is and transfer goes on from its size.
+    Session id travels in session frame, codes in status frames, objects in json frames.
+    Sessions and their unfinished transfers are looked up by id in SessionStore, which outlives connections
+    and, with journal, server restarts.
+    """
+
+    def restore(self, session_id: str):
+        self.set_session_id(session_id)
+        record = self.session_store.get(session_id)
+        self.session_store.touch(session_id)
+        if record is None:
+            logger.info('No need to restore session')
+            self.send_status(StatusCode.ok)  # 2
+            return
+        logger.warning('Previous session was unexpectedly disconnected. Trying to bring it back...')
+        self.send_status(StatusCode.err)  # 2
+        yield self.io_read, FrameType.status  # 3
+        if record.direction == DownloadStatus.none:
+            logger.info('Previous session is restored')
+            self.send_status(StatusCode.ok)  # 4
+            return
+        logger.warning('Previous session had some unfinished downloading/uploading. Restoring that actions...')
+        self.send_status(StatusCode.err)  # 4
+        self.remote_current_file = record.remote_file
+        self.local_current_file = record.local_file
+        abs_path, sz, offset, is_download = self.restore_point(record)
+        self.writer.write_json(  # 5
+            {
+                'download': str(is_download).lower(),
+                'client_file_path': record.local_file,
+                'file_size': sz,
+                'offset': offset,
+                'window': self.window_size
+            }
+        )
+        yield self.io_read, FrameType.status  # 6
+        self.send_status(StatusCode.ok)  # 7
+        yield self.io_read, FrameType.status  # 8
+        meta = yield self.io_read_json  # 9
+        remote_file_size, window = meta['file_size'], meta['window']
+        if is_download:
+            yield from self.restore_download(abs_path, remote_file_size, sz, window)
+        else:
+            yield from self.restore_upload(abs_path, sz, remote_file_size, window)
+
+    # Returns (abs_path, file size, offset for #5, is_download) of unfinished transfer
+    def restore_point(self, record) -> tuple[str, int, int, bool]:
+        abs_path = self.start_path + record.remote_file.removeprefix('/').removeprefix('files/')
+        is_download = record.direction == DownloadStatus.download
+        offset = record.acked if record.acked is not None else -1
+        if is_download:
+            return abs_path, os.path.getsize(abs_path), offset, is_download
+        part_path = abs_path + PART_SUFFIX
+        if not os.path.isfile(part_path):
+            # Part is gone, upload starts over
+            open(part_path, 'wb').close()
+        elif record.acked is not None:
+            # Bytes past last ack may be garbage of broken packet or preallocated space, drop them
+            os.truncate(part_path, record.acked)
+        return abs_path, os.path.getsize(part_path), offset, is_download
+
+    # That func stands for restoring downloading files from server from broken session
+    def restore_download(self, abs_path: str, sz: int, full_sz: int, window: int):
+        packets = math.ceil((full_sz - sz) / self.packet_size)
+        self.send_status(StatusCode.ok)  # 10
+        self.transfer = self.sliding_window(window, offset=sz, pace=self.pacer(DOWNLOAD))
+        self.begin_transfer(DownloadStatus.download)
+        label = f'restore download {abs_path}'
+        with self.open_reader(abs_path) as file, self.progress(packets, label, journal=True) as bar:
+            if self.zero_copy:
+                yield self.io_sendfile, self.transfer, file, sz, full_sz - sz, bar
+            else:
+                file.seek(sz)
+                yield from self.send_chunks(file, full_sz - sz, self.chunk_tuner(window), bar)
+        yield self.transfer.finish
+        if not (yield from self.confirmed(window)):
+            return
+        self.end_transfer()
+
+    # That func stands for restoring uploading files to server from broken session
+    def restore_upload(self, abs_path: str, sz: int, full_sz: int, window: int):
+        packets = math.ceil((full_sz - sz) / self.packet_size)
+        try:
+            file = yield self.io_blocking, self.upload_sink, abs_path, full_sz, bool(window), sz
+        except OSError as e:
+            logger.error(e)
+            self.send_status(StatusCode.err)  # 10
+            # Upload which can't go on isn't restored again
+            self.end_transfer()
+            return
+        self.send_status(StatusCode.ok)  # 10
+        self.transfer = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size, offset=sz)
+        self.begin_transfer(DownloadStatus.upload)
+        with file, self.progress(packets, f'restore upload {abs_path}', journal=True) as bar:
+            yield from self.receive_chunks(file, full_sz - sz, self.chunk_tuner(window, sending=False), bar)
+            # File is in place before final ack, so client which got it finds it there
+            yield self.io_blocking, self.commit_upload, file
+            self.transfer.finish()
+        self.end_transfer()
+
+    # Without acks all of download may sit in socket buffers when server is done sending, only receiver knows
+    # how much of it came. Transfer is kept for restore until client confirms it got everything,
+    # restore then goes on from size of client's file (#9)
+    def confirmed(self, window: int):
+        if window:
+            return True
+        if (yield self.io_read_status) != StatusCode.ok:
+            logger.error("Client didn't confirm download, it's kept for restore")
+            return False
+        return True
+
+    # Unfinished transfer is kept in session store until it ends, so broken one can be restored by session id
+    def begin_transfer(self, direction: int):
+        self.is_downloading = direction
+        self.session_store.begin(
+            self.get_session_id(), direction, self.remote_current_file, self.local_current_file, self.get_acked_bytes()
+        )
+
+    def end_transfer(self):
+        self.is_downloading = DownloadStatus.none
+        self.session_store.finish(self.get_session_id())
+
+    # Bandwidth limit of file data going `direction` (from server is download), None if nothing is limited
+    def pacer(self, direction: str, session_id: str | None = None) -> Pacer | None:
+        return self.bandwidth.pacer(session_id or self.get_session_id(), direction, self.packet_size, self.metrics)
+
+    # Upload is written to part file next to abs_path, see upload_sink.py
+    def upload_sink(self, abs_path: str, size: int, preallocate: bool, offset: int = 0) -> UploadSink:
+        return UploadSink(abs_path, size, offset, self.upload_preallocate and preallocate, self.write_coalesce,
+                          self.upload_fsync)
+
+    def commit_upload(self, file: UploadSink):
+        file.commit()
+        self.directory_index.invalidate(file.path)
+
+    # Outbound file data is read through FILE_READER, see file_reader.py
+    def open_reader(self, path: str):
+        return open_reader(path, self.file_reader, self.read_ahead)
+
+    # Chunk size of raw file data, fixed or tuned while transfer goes, see tuning.py
+    def chunk_tuner(self, window: int, sending: bool = True) -> ChunkTuner:
+        return ChunkTuner(self.tcp_socket(), self.packet_size, self.max_packet_size, window, self.chunk_tuning, sending)
+
+    def tcp_socket(self):
+        return self.sock
+
+    # Sends `size` bytes of file from its position through self.transfer window
+    def send_chunks(self, file, size: int, tuner: ChunkTuner, on_progress):
+        while size > 0:
+            data = file.read(min(tuner.size, size))
+            if not data:
+                break
+            yield self.transfer.wait_open, len(data)
+            self.send_raw(data)
+            yield self.io_drain
+            self.transfer.sent_bytes(len(data))
+            if self.server_debug_loading:
+                yield self.io_sleep, 0.001
+            size -= len(data)
+            tuner.measured(len(data))
+            on_progress(tuner.packets(len(data)))
+
+    # Writes `size` bytes of raw data into file and acks them through self.transfer
+    def receive_chunks(self, file, size: int, tuner: ChunkTuner, on_progress):
+        buffer = ReceiveBuffer(tuner.max_size)
+        pace = self.pacer(UPLOAD)
+        while size > 0:
+            line = yield self.io_read_exact, buffer, min(tuner.size, size)
+            yield from self.write_received(file, line, pace)
+            size -= len(line)
+            tuner.measured(len(line))
+            on_progress(tuner.packets(len(line)))
+
+    # Received data goes to file and is counted in window, file is flushed before ack promises it to sender.
+    # Receiver that reads slower makes TCP hold sender back, so uploads are paced here
+    def write_received(self, file, data, pace: Pacer | None):
+        file.write(data)
+        if self.transfer.ack_due(len(data)):
+            yield self.io_flush, file
+        self.transfer.received_bytes(len(data))
+        if pace is not None:
+            yield self.io_pace, pace, len(data)
+
+    # Progress of transfer goes to configured sinks and to metrics, with `journal` also acked offset goes to journal,
+    # all of them at most `progress_rate` times per second
+    def progress(self, total: int, label: str, journal: bool = False):
+        sinks = [factory() for factory in self.progress_sinks]
+        sinks.append(CallbackSink(self.metrics.set_progress, self.metrics.clear_progress))
+        if journal:
+            sinks.append(CallbackSink(
+                lambda progress: self.session_store.progress(self.get_session_id(), self.get_acked_bytes())
+            ))
+        return progress_bar(total, label, sinks, self.progress_rate)
 
     def get_session_id(self):
         return self.__session_id
 
     def set_session_id(self, session_id: str):
         self.__session_id = session_id
+        self.metrics.session_id = session_id
 
     """
     # Decorator to use with command handlers #
@@ -141,10 +471,17 @@ class Session:
         def inner(self):
             logger.info('Starting command execution')
             try:
-                func(self)
+                steps = func(self)
+                # Commands which only write are plain functions
+                if steps is not None:
+                    yield from steps
+            except (ConnectionError, SocketException):
+                # Stream is broken or out of step with client, session ends
+                raise
             except Exception as e:
                 logger.error(e)
-            logger.info('Finishing command execution')
+            finally:
+                logger.info('Finishing command execution')
 
         return inner
 
@@ -168,6 +505,7 @@ class Session:
         self.send(b"logging out...")
         logger.warning("Handling logout...")
         self.is_active = False
+        self.session_store.remove(self.get_session_id())
 
     @command
     def handle_shutdown(self):
@@ -208,20 +546,31 @@ class Session:
         self.send("echo - return argument.                Args: [string...]\r\n"
                   "time - server time.                    Args: no args\r\n"
                   "stime - server uptime.                 Args: no args\r\n"
-                  "tree - show files.                     Args: no args\r\n"
+                  "tree - show files.                     Args: [dir_path] [-d depth] [-n lines] [-c cursor]\r\n"
                   "mkdir - create directory.              Args: [dir_path]\r\n"
                   "rm - remove directory.                 Args: [dir_path]\r\n"
                   "download - download files from server. Args: [remote_dir_path local_dir_path]\r\n"
                   "upload - upload files to server.       Args: [remote_dir_path local_dir_path]\r\n"
+                  "pdownload - parallel download.         Args: [remote_dir_path local_dir_path]\r\n"
+                  "mdownload - download many files.       Args: [remote_dir_or_glob local_dir_path]\r\n"
+                  "mupload - upload many files.           Args: [remote_dir_path local_dir_or_glob]\r\n"
+                  "stats - server transfer statistics.    Args: no args\r\n"
                   "logout - disconnect from server.       Args: no args\r\n"
                   "shutdown - shutdown server.            Args: no args".encode('utf-8'))
 
     @command
-    def handle_tree(self):
+    def handle_stats(self):
         if not self.parser.check_args(0):
             self.send(b"Wrong arguments")
             return
-        self.send(self.list_files().encode('utf-8'))
+        self.send(self.server_metrics.summary().encode('utf-8'))
+
+    # Frames go out as listing is walked, on asyncio drain keeps only about one of them in transport buffer
+    @command
+    def handle_tree(self):
+        for frame in self.tree_frames():
+            self.writer.write(*frame)
+            yield self.io_drain
 
     @command
     def handle_mkdir(self):
@@ -249,200 +598,464 @@ class Session:
 
     @command
     def handle_download(self):
-        try:
-            if not self.parser.check_args(2):
-                self.send_raw(StatusCode.err)
-                return
-            self.send_raw(StatusCode.ok)
-            rel_path = self.parser.get_args()['args'][0]
-            self.remote_current_file = rel_path
-            self.local_current_file = self.parser.get_args()['args'][1]
-            rel_path = rel_path.removeprefix('files/')
-            abs_path = self.start_path + rel_path
-            if os.path.exists(abs_path) and os.path.isfile(abs_path):
-                logger.info(f'Uploading {abs_path}')
-                self.send_raw(StatusCode.ok)
-                file = open(abs_path, "rb")
-                sz = os.path.getsize(abs_path)
-                if self.synchronize_recv() != StatusCode.ok:
-                    logger.error("Client didn't reply on ok")
-                    return
-                self.send(f"{sz}".encode('utf-8'))
-                if self.synchronize_recv() != StatusCode.ok:
-                    logger.error("Client didn't reply on size")
-                    return
-                to_send = [i for i in range(math.ceil(sz / self.packet_size))]
-                self.is_downloading = DownloadStatus.download
-                check = 0
-                with alive_bar(len(to_send)) as bar:
-                    for _ in to_send:
-                        data = file.read(self.packet_size)
-                        self.send_raw(data)
-                        if self.server_debug_loading:
-                            time.sleep(0.001)
-                        if self.enable_check:
-                            if check % self.packets_per_check == 0:
-                                self.synchronize_recv()
-                            check += 1
-                        bar()
-                self.synchronize_recv()
-                self.is_downloading = DownloadStatus.none
-                file.close()
+        if not self.parser.check_args(2):
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        rel_path = self.parser.get_args()['args'][0]
+        self.remote_current_file = rel_path
+        self.local_current_file = self.parser.get_args()['args'][1]
+        abs_path = self.start_path + rel_path.removeprefix('files/')
+        if not (os.path.exists(abs_path) and os.path.isfile(abs_path)):
+            self.send_status(StatusCode.err)
+            return
+        logger.info(f'Uploading {abs_path}')
+        self.send_status(StatusCode.ok)
+        sz = os.path.getsize(abs_path)
+        if (yield self.io_read_status, 1) != StatusCode.ok:
+            logger.error("Client didn't reply on ok")
+            return
+        self.writer.write_json({'size': sz, 'window': self.window_size, 'delta': self.delta_sync,
+                                'compress': offer(self.compression, abs_path)})
+        if (yield self.io_read_status, 1) != StatusCode.ok:
+            logger.error("Client didn't reply on size")
+            return
+        reply = yield self.io_read_json
+        if reply.get('delta'):
+            with self.open_reader(abs_path) as file:
+                yield from self.send_delta(file, reply['block'])
+            return
+        window = reply['window']
+        codec = Codec.from_reply(reply.get('codec'), self.packet_size)
+        self.transfer = self.sliding_window(window, pace=self.pacer(DOWNLOAD))
+        packets = math.ceil(sz / (codec.block if codec else self.packet_size))
+        self.begin_transfer(DownloadStatus.download)
+        with self.open_reader(abs_path) as file, self.progress(packets, f'download {abs_path}', journal=True) as bar:
+            if codec is not None:
+                yield from self.send_compressed(file, sz, codec, on_progress=bar)
+            elif self.zero_copy:
+                yield self.io_sendfile, self.transfer, file, 0, sz, bar
             else:
-                self.send(StatusCode.err)
-        except Exception as e:
-            logger.error(e)
+                yield from self.send_chunks(file, sz, self.chunk_tuner(window), bar)
+        yield self.transfer.finish
+        if not (yield from self.confirmed(window)):
+            return
+        self.end_transfer()
 
     @command
     def handle_upload(self):
-        if self.synchronize_recv() != StatusCode.ok:
+        if (yield self.io_read_status, 1) != StatusCode.ok:
             logger.error("Can't download file: Wrong path")
-            self.sock.send(StatusCode.err)
+            self.send_status(StatusCode.err)
             return
-        self.synchronize_send()
-        sz = int(self.sock.recv(self.packet_size).decode('utf-8'))
-        file = open(
-            f"{self.start_path + self.parser.get_args()['args'][0].removeprefix('/').removeprefix('files/')}", 'wb'
-        )
+        self.send_status(StatusCode.ok)
+        meta = yield self.io_read_json
+        sz, proposed_window = meta['size'], meta['window']
+        abs_path = self.start_path + self.parser.get_args()['args'][0].removeprefix('/').removeprefix('files/')
         logger.info("Got metadata")
         self.remote_current_file = self.parser.get_args()['args'][0]
         self.local_current_file = self.parser.get_args()['args'][1]
-        p_bar = [i for i in range(math.ceil(int(sz) / self.packet_size))]
-        self.synchronize_send()
+        if meta.get('delta') and self.delta_sync and os.path.isfile(abs_path) and os.path.getsize(abs_path):
+            yield from self.receive_delta(abs_path, sz)
+            return
+        window = agree_window(self.window_size, proposed_window)
+        try:
+            file = yield self.io_blocking, self.upload_sink, abs_path, sz, bool(window)
+        except OSError as e:
+            logger.error(e)
+            self.send_status(StatusCode.err)
+            return
+        codec_spec = choose(self.compression, meta.get('compress'))
+        codec = Codec.from_reply(codec_spec, self.packet_size)
+        packets = math.ceil(int(sz) / (codec.block if codec else self.packet_size))
+        self.send_status(StatusCode.ok)
+        self.writer.write_json({'window': window, 'codec': codec_spec})
         logger.info("Synchronized")
-        self.is_downloading = DownloadStatus.upload
-        is_broken = False
-        downloaded_bytes = 0
-        check = 0
-        with alive_bar(len(p_bar)) as bar:
-            for i in range(math.ceil(sz / self.packet_size)):
-                line = bytes()
-                if sz - downloaded_bytes >= self.packet_size:
-                    while len(line) < self.packet_size:
-                        buff = self.sock.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                else:
-                    while len(line) < sz - downloaded_bytes:
-                        buff = self.sock.recv(self.packet_size)
-                        if not buff:
-                            return
-                        line += buff
-                downloaded_bytes += len(line)
-                file.write(line)
-                if self.enable_check:
-                    if check % self.packets_per_check == 0:
-                        self.synchronize_send()
-                    check += 1
-                bar()
-            self.synchronize_recv()
-        if not is_broken:
-            self.is_downloading = DownloadStatus.none
-        file.close()
+        self.transfer = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size)
+        self.begin_transfer(DownloadStatus.upload)
+        with file, self.progress(packets, f'upload {abs_path}', journal=True) as bar:
+            if codec is not None:
+                yield from self.receive_compressed(file, sz, codec, on_progress=bar)
+            else:
+                yield from self.receive_chunks(file, sz, self.chunk_tuner(window, sending=False), bar)
+            # File is in place before final ack, so client which got it finds it there
+            yield self.io_blocking, self.commit_upload, file
+            self.transfer.finish()
+            if not window:
+                yield self.io_read_status, 1
+        self.end_transfer()
 
     @command
     def handle_udp_download(self):
-        # Get sync response from client
-        data, addr = self.udp_sock.recvfrom(self.packet_size)
-
-        # Parse file paths
+        if not self.parser.check_args(2):
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
         rel_path = self.parser.get_args()['args'][0]
         self.remote_current_file = rel_path
         self.local_current_file = self.parser.get_args()['args'][1]
-        rel_path = rel_path.removeprefix('files/')
-        abs_path = self.start_path + rel_path
-        if os.path.exists(abs_path) and os.path.isfile(abs_path):
-            logger.info(f'UDP uploading {abs_path}')
-            file = open(abs_path, "rb")
-            sz = os.path.getsize(abs_path)
-
-            # Send file size to client
-            self.udp_sock.sendto(f"{sz}".encode('utf-8'), addr)
-
-            # Receive OK from client
-            data, _ = self.udp_sock.recvfrom(self.packet_size)
-
-            to_send = [i for i in range(math.ceil(sz / self.packet_size))]
-            self.udp_sock.settimeout(2)
-            i = 0
-            packet_num = 0
-            # Start uploading
-            with alive_bar(len(to_send)) as bar:
-                for _ in to_send:
-                    header = f"{packet_num}:".encode('utf-8')
-                    data = file.read(self.packet_size)
-                    self.udp_sock.sendto(header + data, addr)
-                    if i == 10:
-                        self.udp_sock.recvfrom(self.packet_size)
-                        i = 0
-                    i += 1
-                    packet_num += 1
-                    bar()
-            file.close()
+        abs_path = self.start_path + rel_path.removeprefix('files/')
+        if not (os.path.exists(abs_path) and os.path.isfile(abs_path)):
+            self.send_status(StatusCode.err)
+            return
+        logger.info(f'UDP uploading {abs_path}')
+        self.send_status(StatusCode.ok)
+        sz = os.path.getsize(abs_path)
+        channel = self.udp_dispatcher.open()
+        try:
+            self.writer.write_json(
+                {'size': sz, 'chunk': self.packet_size, 'port': self.udp_dispatcher.port,
+                 'transfer_id': channel.transfer_id, 'compress': offer(self.compression, abs_path)}
+            )
+            if (yield self.io_read_status, 1) != StatusCode.ok:
+                logger.error("Client can't receive file")
+                return
+            reply = yield self.io_read_json
+            # UDP transfer blocks on its dispatcher channel
+            codec = Codec.from_reply(reply.get('codec'), self.packet_size)
+            yield self.io_blocking, self.send_udp, channel, abs_path, sz, codec
+        finally:
+            channel.close()
 
+    @command
     def handle_udp_upload(self):
-        self.udp_sock.settimeout(2)
-        # Sync with server!
-        _, addr = self.udp_sock.recvfrom(self.packet_size)
-        self.udp_sock.sendto("SYNC".encode('utf-8'), addr)
+        if (yield self.io_read_status, 1) != StatusCode.ok:
+            logger.error("Can't download file: Wrong path")
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        meta = yield self.io_read_json
+        self.remote_current_file = self.parser.get_args()['args'][0]
+        self.local_current_file = self.parser.get_args()['args'][1]
+        abs_path = self.start_path + self.remote_current_file.removeprefix('/').removeprefix('files/')
+        try:
+            file = yield self.io_blocking, self.upload_sink, abs_path, meta['size'], True
+        except OSError as e:
+            logger.error(e)
+            self.send_status(StatusCode.err)
+            return
+        channel = self.udp_dispatcher.open()
+        codec_spec = choose(self.compression, meta.get('compress'))
+        try:
+            self.send_status(StatusCode.ok)
+            self.writer.write_json({'port': self.udp_dispatcher.port, 'transfer_id': channel.transfer_id,
+                                    'codec': codec_spec})
+            codec = Codec.from_reply(codec_spec, meta['chunk'])
+            yield self.io_blocking, self.receive_udp, channel, file, meta['size'], meta['chunk'], codec
+        finally:
+            channel.close()
+
+    @command
+    def handle_parallel_download(self):
+        if not self.parser.check_args(2):
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        rel_path = self.parser.get_args()['args'][0]
+        abs_path = self.start_path + rel_path.removeprefix('/').removeprefix('files/')
+        if not (os.path.exists(abs_path) and os.path.isfile(abs_path)):
+            self.send_status(StatusCode.err)
+            return
+        logger.info(f'Parallel uploading {abs_path}')
+        self.send_status(StatusCode.ok)
+        sz = os.path.getsize(abs_path)
+        transfer_id = self.parallel_transfers.open(self.get_session_id(), abs_path, sz)
+        try:
+            self.writer.write_json({'size': sz, 'transfer_id': transfer_id, 'streams': self.parallel_streams})
+            if (yield self.io_read_status, 1) != StatusCode.ok:
+                logger.error("Client can't receive file")
+                return
+            # Ranges go over data connections, control connection only waits for the result
+            if (yield self.io_read_status) != StatusCode.ok:
+                logger.error('Some ranges of parallel download failed')
+        finally:
+            self.parallel_transfers.close(transfer_id)
 
-        # Get file size
-        data, addr = self.udp_sock.recvfrom(self.packet_size)
-        sz = int(data.decode('utf-8'))
+    @command
+    def handle_archive_download(self):
+        base, entries = yield self.io_blocking, self.archive_entries
+        if not entries:
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        self.writer.write_json({'entries': entries, 'window': self.window_size})
+        frame_type, payload = yield self.io_read
+        if frame_type != FrameType.json:
+            logger.error("Client can't receive files")
+            return
+        reply = json.loads(payload)
+        skip, window = reply['skip'], reply['window']
+        logger.info(f'Sending {len(entries) - len(skip)} of {len(entries)} files from {base}')
+        self.transfer = self.sliding_window(window, pace=self.pacer(DOWNLOAD))
+        with self.progress(len(entries) - len(skip), f'mdownload {base}') as bar:
+            for data, size, is_last in entry_chunks(base, entries, skip, self.packet_size):
+                yield self.transfer.wait_open, size
+                self.send_raw(data)
+                yield self.io_drain
+                self.transfer.sent_bytes(size)
+                if is_last:
+                    bar()
+        yield self.transfer.finish
+        if not window:
+            yield self.io_read_status
 
-        # Respond to server with OK
-        self.udp_sock.sendto("OK".encode('utf-8'), addr)
+    @command
+    def handle_archive_upload(self):
+        if not self.parser.check_args(2):
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        frame_type, payload = yield self.io_read
+        if frame_type != FrameType.json:
+            logger.error('Client has no files to upload')
+            return
+        meta = json.loads(payload)
+        entries = meta['entries']
+        root = self.start_path + self.parser.get_args()['args'][0].removeprefix('/').removeprefix('files/')
+        try:
+            os.makedirs(root, exist_ok=True)
+            skip = whole_entries(root, entries)
+        except (OSError, SocketException) as e:
+            logger.error(e)
+            self.send_status(StatusCode.err)
+            return
+        window = agree_window(self.window_size, meta['window'])
+        self.writer.write_json({'skip': skip, 'window': window})
+        logger.info(f'Receiving {len(entries) - len(skip)} of {len(entries)} files into {root}')
+        self.transfer = CumulativeAck(self.sock, window, self.packets_per_check * self.packet_size)
+        skip_set = set(skip)
+        pace = self.pacer(UPLOAD)
+        buffer = ReceiveBuffer(self.packet_size)
+        try:
+            with self.progress(len(entries) - len(skip), f'mupload {root}') as bar:
+                for _ in range(len(entries) - len(skip)):
+                    header = (yield self.io_read, FrameType.entry)[1]
+                    path, size, mtime = next_entry(root, entries, skip_set, header)
+                    file = yield self.io_blocking, self.upload_sink, path, size, True
+                    try:
+                        left = size
+                        while left:
+                            chunk = yield self.io_read_exact, buffer, min(self.packet_size, left)
+                            yield from self.write_received(file, chunk, pace)
+                            left -= len(chunk)
+                        yield self.io_blocking, self.commit_upload, file
+                    finally:
+                        # Cut entry is sent again whole when the command is run again, its part is of no use
+                        file.discard()
+                    os.utime(path, (mtime, mtime))
+                    bar()
+            self.transfer.finish()
+            if not window:
+                yield self.io_read_status
+        finally:
+            # Directories made for entries show up in tree too
+            for rel, _, _ in entries:
+                self.directory_index.invalidate(os.path.join(root, rel))
 
-        # Open file
+    # Returns (base, manifest) of files archive download asked for, empty manifest if nothing matches
+    def archive_entries(self) -> tuple[str, list[list]]:
+        if not self.parser.check_args(2):
+            return '', []
+        pattern = self.parser.get_args()['args'][0].removeprefix('/').removeprefix('files/')
         try:
-            file = open(
-                f'{self.start_path + self.data.decode("utf-8").split(" ")[2].removeprefix("/").removeprefix("files/")}',
-                'wb')
-        except Exception as e:
-            print(e)
-            return
-
-        p_bar = [i for i in range(math.ceil(sz / self.packet_size))]
-        j = 0
-        packet_num = 0
-        with alive_bar(len(p_bar)) as bar:
-            for i in range(math.ceil(sz / self.packet_size)):
-                g_line = self.udp_sock.recvfrom(self.packet_size + 20)[0]
-                split_idx = g_line.find(b':')
-                l_packet_num = int(g_line[:split_idx])
-                data = g_line[split_idx + 1:]
-                if j == 10:
-                    self.udp_sock.sendto(b"OK", addr)
-                    j = 0
-                if packet_num != l_packet_num:
-                    print('Sequence broken!')
-                    exit(1)
-                packet_num += 1
-                bar()
-                file.write(data)
-                j += 1
-        file.close()
+            return collect(self.start_path, '' if pattern == 'files' else pattern)
+        except (OSError, SocketException) as e:
+            logger.error(e)
+            return '', []
 
+    # Data connection of parallel download: serves one range and ends its session
+    def handle_stream(self):
+        self.is_active = False
+        try:
+            request = json.loads(self.data)
+            transfer = self.parallel_transfers.get(request['transfer_id'], request['session_id'])
+            offset, size = int(request['offset']), int(request['size'])
+        except (ValueError, KeyError, TypeError):
+            request, transfer, offset, size = self.data, None, 0, 0
+        if transfer is None or offset < 0 or size < 0 or offset + size > transfer[1]:
+            logger.error(f'Bad range request {request}')
+            self.send_status(StatusCode.err)
+            return
+        self.send_status(StatusCode.ok)
+        logger.info(f'Sending {transfer[0]} [{offset}, {offset + size})')
+        # Range streams are paced in bucket of session they belong to
+        window = self.sliding_window(0, pace=self.pacer(DOWNLOAD, request['session_id']))
+        with self.open_reader(transfer[0]) as file:
+            if self.zero_copy:
+                yield self.io_sendfile, window, file, offset, size
+                return
+            file.seek(offset)
+            while size > 0:
+                data = file.read(min(self.packet_size, size))
+                if not data:
+                    raise ConnectionError(f'File got shorter than {transfer[1]} bytes')
+                yield window.wait_open, len(data)
+                self.send_raw(data)
+                yield self.io_drain
+                size -= len(data)
+
+    # Sender side of delta sync, receiver's signature comes right after its reply.
+    # Encoder reads and checksums the whole file, it's run frame by frame as blocking step
+    def send_delta(self, file, block: int):
+        encoder = DeltaEncoder((yield self.io_read, FrameType.signature)[1], block)
+        frames = encoder.frames(file)
+        while (frame := (yield self.io_blocking, next, frames, None)) is not None:
+            self.writer.write(*frame)
+            yield self.io_drain
+        logger.info(f'Sent delta: {encoder.literal_bytes} literal bytes of {encoder.size}')
+        if (yield self.io_read_status) != StatusCode.ok:
+            logger.error("Client couldn't rebuild file from delta")
+
+    # Receiver side of delta sync, file on server is the basis
+    def receive_delta(self, abs_path: str, sz: int):
+        block = block_size(sz)
+        with open(abs_path, 'rb') as basis:
+            sig = yield self.io_blocking, signature, basis, block
+        self.send_status(StatusCode.ok)
+        self.writer.write_json({'window': 0, 'delta': True, 'block': block})
+        self.writer.write(FrameType.signature, sig)
+        decoder = yield self.io_blocking, DeltaDecoder, abs_path, block
+        try:
+            while True:
+                frame_type, payload = yield self.io_read
+                if (yield self.io_blocking, decoder.apply, frame_type, payload):
+                    break
+        finally:
+            decoder.close()
+        if decoder.ok:
+            # Rebuilt file has replaced the basis
+            self.directory_index.invalidate(abs_path)
+        logger.info(f'Got delta: {decoder.literal_bytes} literal bytes of {decoder.size}, match: {decoder.ok}')
+        self.send_status(StatusCode.ok if decoder.ok else StatusCode.err)
+
+    def send_udp(self, channel: UdpChannel, abs_path: str, sz: int, codec: Codec | None = None):
+        sender = UdpSender(channel, channel.transfer_id, sz, self.packet_size, window=self.udp_window, codec=codec,
+                           pace=self.pacer(DOWNLOAD))
+        try:
+            packets = math.ceil(sz / self.packet_size)
+            with self.open_reader(abs_path) as file, self.progress(packets, f'udpdownload {abs_path}') as bar:
+                sender.send(file, on_progress=bar)
+        finally:
+            self.metrics.add_udp(sender)
+
+    def receive_udp(self, channel: UdpChannel, file, sz: int, chunk: int, codec: Codec | None = None):
+        receiver = UdpReceiver(channel, channel.transfer_id, sz, chunk, window=self.udp_window, codec=codec)
+        try:
+            with file, self.progress(math.ceil(sz / chunk), f'udpupload {file.name}') as bar:
+                receiver.receive(file, on_progress=bar)
+                self.commit_upload(file)
+        finally:
+            # UDP upload isn't restored, so its part is of no use
+            file.discard()
+            self.metrics.add_udp(receiver)
+
+    # Window counts file bytes, so acks and restore offsets don't depend on how well blocks compress
+    def send_compressed(self, file, sz: int, codec: Codec, on_progress=None):
+        for size, payload in codec.blocks(file, sz):
+            yield self.transfer.wait_open, size
+            self.writer.write(FrameType.compressed, payload)
+            yield self.io_drain
+            self.transfer.sent_bytes(size)
+            if on_progress is not None:
+                on_progress()
+
+    def receive_compressed(self, file, sz: int, codec: Codec, on_progress=None):
+        decompress = codec.decompressor()
+        pace = self.pacer(UPLOAD)
+        received = 0
+        while received < sz:
+            data = decompress((yield self.io_read, FrameType.compressed)[1])
+            if not data or received + len(data) > sz:
+                raise SocketException(f'Compressed block of {len(data)} bytes past end of file')
+            received += len(data)
+            yield from self.write_received(file, data, pace)
+            if on_progress is not None:
+                on_progress()
 
     """
     # COMMAND UTILS #
     """
 
     def list_files(self):
-        lst = ''
-        paths = DisplayablePath.make_tree(Path(self.start_path))
-        for path in paths:
-            lst += path.displayable() + '\n'
-        return lst
+        return self.directory_index.render()
+
+    """
+    # Tree listing #
+    C -> S (tree [dir_path] [-d depth] [-n lines] [-c cursor])
+    S -> C [text] (lines)...                     lines of tree, frame is about TEXT_FRAME long
+    S -> C [json] (cursor)                       end of listing, cursor - line to continue from, null if it's all
+    Listing is streamed while index is walked, so it takes memory of one frame and any size of tree fits.
+    Whole tree without arguments is cut from rendering cached in index.
+    Wrong arguments get error text and the same end frame.
+    """
+
+    # Yields (frame_type, payload) of tree listing, end frame included
+    def tree_frames(self):
+        try:
+            path, depth, limit, cursor = self.tree_args()
+            if path == '' and depth is None and limit == 0 and cursor == 0:
+                lines = None
+                text = self.directory_index.render()
+            else:
+                lines = self.directory_index.lines(path, depth, cursor)
+        except (ValueError, IndexError, FileNotFoundError) as e:
+            logger.error(e)
+            yield FrameType.text, b'Wrong arguments'
+            yield FrameType.json, json.dumps({'cursor': None}).encode('utf-8')
+            return
+        if lines is None:
+            start = 0
+            while start < len(text):
+                end = text.find('\n', start + TEXT_FRAME)
+                end = len(text) if end == -1 else end + 1
+                yield FrameType.text, text[start:end].encode('utf-8')
+                start = end
+            yield FrameType.json, json.dumps({'cursor': None}).encode('utf-8')
+            return
+        page = []
+        size = 0
+        line = cursor
+        next_cursor = None
+        for text in lines:
+            if limit and line - cursor == limit:
+                next_cursor = line
+                break
+            page.append(text)
+            size += len(text) + 1
+            line += 1
+            if size >= TEXT_FRAME:
+                yield FrameType.text, ('\n'.join(page) + '\n').encode('utf-8')
+                page = []
+                size = 0
+        if page:
+            yield FrameType.text, ('\n'.join(page) + '\n').encode('utf-8')
+        yield FrameType.json, json.dumps({'cursor': next_cursor}).encode('utf-8')
+
+    # Returns (path relative to start path, depth, lines limit, cursor) of tree command, 0 limit is no limit
+    def tree_args(self) -> tuple[str, int | None, int, int]:
+        args = self.parser.get_args()['args']
+        options = {'-d': None, '-n': 0, '-c': 0}
+        path = None
+        i = 0
+        while i < len(args):
+            if args[i] in options:
+                options[args[i]] = int(args[i + 1])
+                i += 2
+            elif path is None:
+                path = args[i]
+                i += 1
+            else:
+                raise ValueError(f'Unexpected argument {args[i]}')
+        depth, limit, cursor = options['-d'], options['-n'], options['-c']
+        if (depth is not None and depth < 1) or limit < 0 or cursor < 0:
+            raise ValueError('Depth has to be positive, lines and cursor - not negative')
+        path = (path or '').removeprefix('/').removeprefix('files/')
+        return ('' if path == 'files' else path), depth, limit, cursor
 
     def create_dir(self):
-        os.mkdir(
-            self.start_path +
-            self.data.decode('utf-8').split(' ')[1]
-            .removeprefix('/')
-            .removeprefix('files/')
-        )
+        abs_path = self.start_path + self.data.decode('utf-8').split(' ')[1].removeprefix('/').removeprefix('files/')
+        os.mkdir(abs_path)
+        self.directory_index.invalidate(abs_path)
 
     def remove(self):
         abs_path = self.start_path + self.data.decode('utf-8').split(' ')[1].removeprefix('/').removeprefix('files/')
@@ -450,6 +1063,60 @@ class Session:
             os.rmdir(abs_path)
         elif os.path.isfile(abs_path):
             os.remove(abs_path)
+        self.directory_index.invalidate(abs_path)
+
+    """
+    # I/O STEPS #
+    Handlers yield them wherever they wait for client, disk or time, see driver.py.
+    Here they block session thread, AsyncSession overrides them with coroutines.
+    """
+
+    def io_read(self, expected: int | None = None) -> tuple[int, bytes]:
+        return self.reader.read(expected)
+
+    def io_read_json(self) -> dict:
+        return self.reader.read_json()
+
+    # None status if client sent nothing for `timeout` seconds or sent something else
+    def io_read_status(self, timeout: float | None = None) -> bytes:
+        self.sock.settimeout(timeout)
+        try:
+            return self.reader.read_status()
+        except (TimeoutError, SocketException):
+            return StatusCode.none
+        finally:
+            self.sock.settimeout(None)
+
+    # Raw file data, view into buffer is valid until next read
+    def io_read_exact(self, buffer: ReceiveBuffer, size: int) -> memoryview:
+        chunk = buffer.recv_chunk(self.sock, size)
+        if chunk is None:
+            raise ConnectionError('Connection closed in the middle of file data')
+        return chunk
+
+    # Blocking sends are on the wire already
+    def io_drain(self):
+        pass
+
+    def io_sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def io_pace(self, pace: Pacer, size: int):
+        pace(size)
+
+    # File is flushed before ack promises its data to sender
+    def io_flush(self, file):
+        file.flush()
+
+    # Disk or CPU heavy work: opening preallocated file, commit with fsync, checksums of whole file
+    def io_blocking(self, func, *args):
+        return func(*args)
+
+    def io_sendfile(self, window, file, offset: int, size: int, on_progress=None):
+        ZeroCopySender(self.sock, self.packet_size, window).send(file, offset, size, on_progress=on_progress)
+
+    def sliding_window(self, window: int, offset: int = 0, pace: Pacer | None = None) -> SlidingWindow:
+        return SlidingWindow(self.sock, window, offset=offset, pace=pace)
 
     """
     # NETWORK UTILS #
@@ -458,41 +1125,24 @@ class Session:
     def send(self, msg: bytes, verbose=False):
         if verbose:
             logger.info("Sent to client:", msg.decode('utf-8'))
-        self.sock.send(msg + b'\r\n')
+        if self.request_id is None:
+            self.writer.write_text(msg)
+        else:
+            self.writer.write(FrameType.reply, REQUEST_ID.pack(self.request_id) + msg)
+
+    def send_status(self, code: bytes):
+        self.writer.write_status(code)
 
     def send_raw(self, data: bytes, verbose=False):
         if verbose:
             logger.info("Sent to client", data.decode('utf-8'))
-        self.sock.send(data)
+        self.sock.sendall(data)
 
-    def synchronize_recv(self, timeout=1) -> bytes:
-        response = StatusCode.none
-        try:
-            self.sock.settimeout(timeout)
-            response = self.sock.recv(1)
-        except Exception as e:
-            pass
-        finally:
-            self.sock.settimeout(None)
-            return response
-
-    def synchronize_send(self):
-        try:
-            self.sock.settimeout(0.5)
-            self.sock.send(StatusCode.ok)
-        except Exception as e:
-            pass
-        finally:
-            self.sock.settimeout(None)
-
-    def clear_buffer(self):
-        try:
-            self.sock.settimeout(0.1)
-            self.sock.recv(self.packet_size)
-        except Exception as e:
-            pass
-        finally:
-            self.sock.settimeout(None)
+    def get_acked_bytes(self) -> int | None:
+        # Offset both sides agreed on, None if last transfer went without acks
+        if self.transfer is None or not self.transfer.window:
+            return None
+        return self.transfer.acked
 
     def get_connection_status(self):
         return self.is_active
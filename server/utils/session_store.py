@@ -0,0 +1,293 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from loguru import logger
+
+from .download_status import DownloadStatus
+
+"""
+# Session journal #
+One JSON line per change of transfer state, replayed in order on start:
+{"id": session_id, "dir": 1|2, "remote": path, "local": path, "acked": offset|null, "t": time}  transfer started/moved
+{"id": session_id, "dir": 0}                                                                     transfer finished
+Acked offset is journaled at most every `save_interval` seconds, so it may lag behind.
+That's safe: receiving side truncates its file to journaled offset and the rest is sent again.
+Journal is rewritten with live transfers only once dead lines outnumber them.
+Shared journal (server workers): every process appends to the same file under flock of `path`.lock
+and applies lines of the others before it looks a session up or writes, so any worker can restore any session.
+Compaction replaces the file, the others see new inode and read it from the start.
+"""
+
+
+class SessionRecord:
+    __slots__ = ('session_id', 'last_seen', 'direction', 'remote_file', 'local_file', 'acked', 'saved_at')
+
+    def __init__(self, session_id: str, last_seen: float):
+        self.session_id = session_id
+        self.last_seen = last_seen
+        self.direction = DownloadStatus.none
+        self.remote_file: str | None = None
+        self.local_file: str | None = None
+        self.acked: int | None = None
+        self.saved_at = 0.0
+
+    def to_json(self) -> dict:
+        return {'id': self.session_id, 'dir': self.direction, 'remote': self.remote_file, 'local': self.local_file,
+                'acked': self.acked, 't': self.last_seen}
+
+
+class SessionStore:
+    """
+    Sessions by id, least recently seen first, with state of their unfinished transfer.
+    Sessions idle for `ttl` seconds and the oldest ones over `max_sessions` are dropped.
+    With `path` set transfer state goes to journal, so server started again can resume transfers of old sessions.
+    """
+
+    def __init__(self, path: str | None = None, ttl: float = 24 * 60 * 60, max_sessions: int = 10000,
+                 save_interval: float = 1.0, shared: bool = False):
+        # Empty path is no journal, not a file named ''
+        path = path or None
+        self.path = path
+        self.shared = shared and path is not None
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.save_interval = save_interval
+        self.records: OrderedDict[str, SessionRecord] = OrderedDict()
+        self.lock = threading.Lock()
+        self.journal = None
+        # Shared journal only: lock file and tail of lines written by other processes
+        self.lock_file = None
+        self.reader = None
+        self.partial = b''
+        self.lines = 0
+        # Sessions with unfinished transfer, journal is compared against it
+        self.transfers = 0
+        if path is not None:
+            self.load()
+
+    def get(self, session_id: str) -> SessionRecord | None:
+        with self.lock:
+            self.__sync()
+            record = self.records.get(session_id)
+            if record is None or time.time() - record.last_seen > self.ttl:
+                return None
+            return record
+
+    def touch(self, session_id: str) -> SessionRecord:
+        with self.lock, self.__exclusive():
+            return self.__touch(session_id)
+
+    def begin(self, session_id: str, direction: int, remote_file: str, local_file: str, acked: int | None):
+        with self.lock, self.__exclusive():
+            record = self.__touch(session_id)
+            if record.direction == DownloadStatus.none:
+                self.transfers += 1
+            record.direction = direction
+            record.remote_file = remote_file
+            record.local_file = local_file
+            record.acked = acked
+            record.saved_at = time.monotonic()
+            self.__write(record.to_json())
+
+    def progress(self, session_id: str, acked: int | None):
+        with self.lock:
+            record = self.records.get(session_id)
+            if record is None or record.direction == DownloadStatus.none:
+                return
+            record.acked = acked
+            now = time.monotonic()
+            if now - record.saved_at >= self.save_interval:
+                with self.__exclusive():
+                    record.acked = acked
+                    record.saved_at = now
+                    record.last_seen = time.time()
+                    self.__write(record.to_json())
+
+    def finish(self, session_id: str):
+        with self.lock, self.__exclusive():
+            record = self.records.get(session_id)
+            if record is None or record.direction == DownloadStatus.none:
+                return
+            record.direction = DownloadStatus.none
+            record.acked = None
+            self.transfers -= 1
+            self.__write({'id': session_id, 'dir': DownloadStatus.none})
+
+    # Session which logged out properly has nothing to restore
+    def remove(self, session_id: str):
+        with self.lock, self.__exclusive():
+            record = self.records.pop(session_id, None)
+            if record is not None and record.direction != DownloadStatus.none:
+                self.transfers -= 1
+                self.__write({'id': session_id, 'dir': DownloadStatus.none})
+
+    def __touch(self, session_id: str) -> SessionRecord:
+        now = time.time()
+        record = self.records.get(session_id)
+        if record is None:
+            record = SessionRecord(session_id, now)
+            self.records[session_id] = record
+        else:
+            record.last_seen = now
+            self.records.move_to_end(session_id)
+        self.__expire(now)
+        return record
+
+    # Least recently seen sessions are at the front, so expiry never scans live ones
+    def __expire(self, now: float):
+        while self.records:
+            session_id, record = next(iter(self.records.items()))
+            if len(self.records) <= self.max_sessions and now - record.last_seen <= self.ttl:
+                return
+            self.records.popitem(last=False)
+            if record.direction != DownloadStatus.none:
+                self.transfers -= 1
+                self.__write({'id': session_id, 'dir': DownloadStatus.none})
+
+    def __write(self, entry: dict):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        if self.reader is not None:
+            # Own line is applied already, tail skips it
+            self.reader.seek(os.fstat(self.journal.fileno()).st_size)
+            self.partial = b''
+        self.lines += 1
+        if self.lines > 2 * self.transfers + 64:
+            self.__compact()
+
+    # Shared journal is written by one process at a time, and only by one which applied every line before it
+    @contextlib.contextmanager
+    def __exclusive(self):
+        if self.lock_file is None:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            self.__sync()
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    # Applies lines other processes appended to shared journal since last call
+    def __sync(self):
+        if self.reader is None:
+            return
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(self.path).st_ino != os.fstat(self.reader.fileno()).st_ino:
+                self.__reopen()
+        data = self.partial + self.reader.read()
+        lines = data.split(b'\n')
+        # Line may be read while it's being written, the rest of it comes next time
+        self.partial = lines.pop()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.__apply(entry)
+
+    # Journal was compacted by another process: it holds every live transfer, so state is read from scratch
+    def __reopen(self):
+        for record in self.records.values():
+            record.direction = DownloadStatus.none
+            record.acked = None
+        self.transfers = 0
+        self.lines = 0
+        self.partial = b''
+        self.reader.close()
+        self.reader = open(self.path, 'rb')
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = open(self.path, 'a')
+
+    # Records are changed in place, sessions never hold them but the caller may
+    def __apply(self, entry: dict):
+        self.lines += 1
+        record = self.records.get(entry['id'])
+        if entry['dir'] == DownloadStatus.none:
+            if record is not None and record.direction != DownloadStatus.none:
+                record.direction = DownloadStatus.none
+                record.acked = None
+                self.transfers -= 1
+            return
+        if record is None:
+            record = SessionRecord(entry['id'], entry['t'])
+            self.records[entry['id']] = record
+        else:
+            record.last_seen = max(record.last_seen, entry['t'])
+            self.records.move_to_end(entry['id'])
+        if record.direction == DownloadStatus.none:
+            self.transfers += 1
+        record.direction = entry['dir']
+        record.remote_file = entry['remote']
+        record.local_file = entry['local']
+        record.acked = entry['acked']
+
+    def __compact(self):
+        tmp_path = self.path + '.tmp'
+        self.lines = 0
+        with open(tmp_path, 'w') as file:
+            for record in self.records.values():
+                if record.direction != DownloadStatus.none:
+                    file.write(json.dumps(record.to_json()) + '\n')
+                    self.lines += 1
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(tmp_path, self.path)
+        self.journal = open(self.path, 'a')
+        if self.shared:
+            if self.reader is not None:
+                self.reader.close()
+            self.reader = open(self.path, 'rb')
+            self.reader.seek(0, os.SEEK_END)
+            self.partial = b''
+
+    def load(self):
+        if self.shared:
+            self.lock_file = open(self.path + '.lock', 'a')
+        with self.lock, self.__exclusive():
+            self.__load()
+        logger.info(f'Loaded {len(self.records)} unfinished transfers from {self.path}')
+
+    def __load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut by crash in the middle of write
+                        continue
+                    if entry['dir'] == DownloadStatus.none:
+                        self.records.pop(entry['id'], None)
+                        continue
+                    record = SessionRecord(entry['id'], entry['t'])
+                    record.direction = entry['dir']
+                    record.remote_file = entry['remote']
+                    record.local_file = entry['local']
+                    record.acked = entry['acked']
+                    self.records.pop(entry['id'], None)
+                    self.records[entry['id']] = record
+        self.transfers = len(self.records)
+        self.__expire(time.time())
+        self.__compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
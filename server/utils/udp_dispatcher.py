@@ -0,0 +1,117 @@
+import queue
+import random
+import socket
+import threading
+
+from loguru import logger
+
+from .udp_transfer import HEADER
+
+
+class UdpChannel:
+    """
+    Per-transfer end of UdpDispatcher, looks like a UDP socket to UdpSender/UdpReceiver.
+    Datagrams are sent through shared socket and received from the transfer's own queue.
+    """
+
+    def __init__(self, dispatcher: 'UdpDispatcher', transfer_id: int, max_queued: int):
+        self.dispatcher = dispatcher
+        self.transfer_id = transfer_id
+        self.queue = queue.Queue(max_queued)
+        self.timeout = None
+
+    def settimeout(self, timeout: float | None):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        # Buffers belong to shared socket
+        pass
+
+    def sendto(self, data: bytes, addr: tuple) -> int:
+        return self.dispatcher.sock.sendto(data, addr)
+
+    def sendmsg(self, buffers, ancdata, flags: int, addr: tuple) -> int:
+        return self.dispatcher.sock.sendmsg(buffers, ancdata, flags, addr)
+
+    def recvfrom_into(self, buff: bytearray) -> tuple[int, tuple]:
+        try:
+            if self.timeout == 0:
+                data, addr = self.queue.get_nowait()
+            else:
+                data, addr = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            if self.timeout == 0:
+                raise BlockingIOError
+            raise TimeoutError
+        size = min(len(data), len(buff))
+        buff[:size] = data[:size]
+        return size, addr
+
+    def put(self, data: bytes, addr: tuple):
+        try:
+            self.queue.put_nowait((data, addr))
+        except queue.Full:
+            # Same as full socket buffer: datagram is lost and will be resent
+            pass
+
+    def close(self):
+        self.dispatcher.close_channel(self.transfer_id)
+
+
+class UdpDispatcher:
+    """
+    One UDP socket on SERVER_UDP_PORT for transfers of every session.
+    Reader thread routes datagrams to transfer channels by transfer id from header,
+    datagrams of unknown transfers are dropped.
+    """
+
+    def __init__(self, ip: str, port: int, max_datagram: int = 65535, max_queued: int = 4096):
+        self.sock = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_DGRAM,
+        )
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, 8 * 1024 * 1024)
+            except OSError:
+                pass
+        self.sock.bind((ip, port))
+        self.port = self.sock.getsockname()[1]
+        self.max_datagram = max_datagram
+        self.max_queued = max_queued
+        self.channels: dict[int, UdpChannel] = {}
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        logger.info(f"UDP DISPATCHER LISTENING ON {self.port}")
+        self.reader.start()
+
+    def open(self) -> UdpChannel:
+        with self.lock:
+            transfer_id = random.getrandbits(32)
+            while transfer_id in self.channels:
+                transfer_id = random.getrandbits(32)
+            channel = UdpChannel(self, transfer_id, self.max_queued)
+            self.channels[transfer_id] = channel
+        return channel
+
+    def close_channel(self, transfer_id: int):
+        with self.lock:
+            self.channels.pop(transfer_id, None)
+
+    def run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(self.max_datagram)
+            except OSError as e:
+                logger.error(e)
+                return
+            if len(data) < HEADER.size:
+                continue
+            channel = self.channels.get(HEADER.unpack_from(data)[1])
+            if channel is not None:
+                channel.put(data, addr)
+
+    def close(self):
+        self.sock.close()
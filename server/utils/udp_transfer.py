@@ -0,0 +1,341 @@
+import array
+import heapq
+import math
+import socket
+import struct
+import time
+
+from collections import deque
+
+from .exception.socket_exception import SocketException
+
+# Datagram header: kind, transfer id, chunk number (base for status)
+HEADER = struct.Struct('!BII')
+
+"""
+# Reliable UDP transfer #
+File is cut into chunks of `chunk` bytes, chunk N is written at offset N * chunk, so it can arrive in any order.
+C -> S (hello)                  client side always speaks first, server learns client address from it
+S -> R (data N)...              sender keeps chunks below lowest unacked one + `window` in flight
+S -> R (packed N)               chunk compressed by negotiated codec, goes instead of data when it's smaller
+S <- R (status base bitmap)     base - every chunk below it is received, bitmap - which of next chunks are received
+                                sent every `status_every` chunks, on every new gap and when data stops for a while
+                                chunks missing in bitmap before a received one are NACKed and resent right away,
+                                in flight chunks without ack for retransmit timeout are resent too
+S <- R (status total)           every chunk is received
+S -> R (fin)                    receiver answers late data with final status until fin comes or `linger` passes
+"""
+
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+# Chunk is lost once that many chunks sent after it are received, less than that is just reordering
+DUP_THRESHOLD = 3
+
+
+class Kind:
+    hello = 1
+    data = 2
+    status = 3
+    fin = 4
+    packed = 5
+
+
+class UdpEndpoint:
+    """
+    `sock` is a UDP socket or anything with the same sendto/recvfrom_into/settimeout (sendmsg where it's there),
+    e.g. a channel of server-wide dispatcher.
+    `codec` is compression.Codec agreed for transfer, None - chunks go raw.
+    """
+
+    def __init__(self, sock: socket.socket, transfer_id: int, size: int, chunk: int,
+                 peer: tuple | None = None, window: int = 256, timeout: float = 30, codec=None):
+        self.sock = sock
+        self.codec = codec
+        self.transfer_id = transfer_id
+        self.size = size
+        self.chunk = chunk
+        self.total = math.ceil(size / chunk)
+        self.peer = peer
+        self.window = window
+        self.timeout = timeout
+        # Wire counters, headers included
+        self.sent_bytes = 0
+        self.sent_packets = 0
+        self.received_bytes = 0
+        self.received_packets = 0
+        self.buff = bytearray(HEADER.size + max(chunk, math.ceil(window / 8)))
+        self.view = memoryview(self.buff)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, 4 * 1024 * 1024)
+            except OSError:
+                pass
+
+    def chunk_size(self, seq: int) -> int:
+        return min(self.chunk, self.size - seq * self.chunk)
+
+    # Header and payload go as two buffers of one datagram, payload (e.g. slice of mapped file) isn't copied
+    def send_packet(self, kind: int, seq: int = 0, payload: bytes | memoryview = b''):
+        header = HEADER.pack(kind, self.transfer_id, seq)
+        self.sock.settimeout(self.timeout)
+        if hasattr(self.sock, 'sendmsg'):
+            self.sock.sendmsg((header, payload), (), 0, self.peer)
+        else:
+            self.sock.sendto(header + payload, self.peer)
+        self.sent_bytes += len(header) + len(payload)
+        self.sent_packets += 1
+
+    # Returns (kind, seq, payload) of next datagram of this transfer, None if nothing came in `timeout`
+    def recv_packet(self, timeout: float = 0.0) -> tuple[int, int, memoryview] | None:
+        deadline = time.monotonic() + timeout
+        while True:
+            # Zero timeout makes socket non-blocking, so pending datagrams are drained without waiting
+            self.sock.settimeout(max(deadline - time.monotonic(), 0))
+            try:
+                received, addr = self.sock.recvfrom_into(self.buff)
+            except (BlockingIOError, TimeoutError):
+                return None
+            if received < HEADER.size:
+                continue
+            kind, transfer_id, seq = HEADER.unpack_from(self.buff)
+            # Datagrams of previous transfers may still wander around
+            if transfer_id != self.transfer_id:
+                continue
+            self.received_bytes += received
+            self.received_packets += 1
+            if self.peer is None:
+                if kind != Kind.hello:
+                    continue
+                self.peer = addr
+            return kind, seq, self.view[HEADER.size:received]
+
+    def wait_hello(self):
+        deadline = time.monotonic() + self.timeout
+        while self.peer is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'No hello for {self.timeout}s')
+            self.recv_packet(deadline - time.monotonic())
+
+
+class UdpSender(UdpEndpoint):
+    def __init__(self, sock: socket.socket, transfer_id: int, size: int, chunk: int,
+                 peer: tuple | None = None, window: int = 256, timeout: float = 30, codec=None, pace=None):
+        super().__init__(sock, transfer_id, size, chunk, peer, window, timeout, codec)
+        # Bandwidth limit, blocks until chunk of given size may go
+        self.pace = pace
+        self.acked = bytearray(self.total)
+        self.acked_count = 0
+        self.base = 0
+        self.next_seq = 0
+        # Plain doubles, list of floats would hold an object per chunk
+        self.sent_at = array.array('d', bytes(8 * self.total))
+        self.resent = bytearray(self.total)
+        self.retransmits = 0
+        self.retransmit = deque()
+        self.queued = bytearray(self.total)
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 1.0
+        self.on_progress = None
+
+    def sample_rtt(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def mark_acked(self, seq: int, now: float):
+        if self.acked[seq]:
+            return
+        self.acked[seq] = 1
+        self.acked_count += 1
+        # Karn: ack of resent chunk can't tell which copy it acks
+        if not self.resent[seq]:
+            self.sample_rtt(now - self.sent_at[seq])
+        if self.on_progress is not None:
+            self.on_progress()
+
+    def handle_status(self, base: int, bitmap: memoryview):
+        now = time.monotonic()
+        base = min(base, self.total)
+        for seq in range(self.base, base):
+            self.mark_acked(seq, now)
+        highest = base
+        received_at = []
+        for i in range(min(len(bitmap) * 8, self.total - base)):
+            if bitmap[i >> 3] & (1 << (i & 7)):
+                self.mark_acked(base + i, now)
+                highest = base + i
+                received_at.append(self.sent_at[base + i])
+        if len(received_at) >= DUP_THRESHOLD:
+            sent_before = heapq.nlargest(DUP_THRESHOLD, received_at)[-1]
+            for seq in range(base, highest):
+                if not self.acked[seq] and self.sent_at[seq] < sent_before:
+                    self.queue_retransmit(seq)
+        while self.base < self.total and self.acked[self.base]:
+            self.base += 1
+
+    def queue_retransmit(self, seq: int):
+        if not self.queued[seq]:
+            self.queued[seq] = 1
+            self.retransmit.append(seq)
+
+    def retransmit_expired(self):
+        now = time.monotonic()
+        expired = False
+        for seq in range(self.base, self.next_seq):
+            if not self.acked[seq] and now - self.sent_at[seq] >= self.rto:
+                self.queue_retransmit(seq)
+                expired = True
+        if expired:
+            self.rto = min(self.rto * 2, MAX_RTO)
+
+    def send_chunk(self, file, seq: int):
+        if self.pace is not None:
+            self.pace(self.chunk_size(seq))
+        file.seek(seq * self.chunk)
+        if self.sent_at[seq]:
+            self.resent[seq] = 1
+            self.retransmits += 1
+        self.sent_at[seq] = time.monotonic()
+        data = file.read(self.chunk_size(seq))
+        if self.codec is not None:
+            packed = self.codec.compress_chunk(data)
+            if len(packed) < len(data):
+                self.send_packet(Kind.packed, seq, packed)
+                return
+        self.send_packet(Kind.data, seq, data)
+
+    def send(self, file, on_progress=None):
+        self.on_progress = on_progress
+        if self.total == 0:
+            return
+        if self.peer is None:
+            self.wait_hello()
+        else:
+            self.connect()
+        last_feedback = time.monotonic()
+        while self.acked_count < self.total:
+            packet = self.recv_packet()
+            if packet is not None:
+                if packet[0] == Kind.status:
+                    self.handle_status(packet[1], packet[2])
+                    last_feedback = time.monotonic()
+                continue
+            if self.retransmit:
+                seq = self.retransmit.popleft()
+                self.queued[seq] = 0
+                if not self.acked[seq]:
+                    self.send_chunk(file, seq)
+                continue
+            if self.next_seq < self.total and self.next_seq < self.base + self.window:
+                self.send_chunk(file, self.next_seq)
+                self.next_seq += 1
+                continue
+            # Window is closed or everything is sent, nothing to do until status comes
+            packet = self.recv_packet(self.rto)
+            if packet is not None and packet[0] == Kind.status:
+                self.handle_status(packet[1], packet[2])
+                last_feedback = time.monotonic()
+            if time.monotonic() - last_feedback > self.timeout:
+                raise TimeoutError(f'No status for {self.timeout}s, acked {self.acked_count} of {self.total} chunks')
+            # Idle receiver keeps sending statuses, so lost tail chunks are only found by timer
+            self.retransmit_expired()
+        self.send_packet(Kind.fin)
+
+    # Sender on client side says hello until receiver replies with status
+    def connect(self):
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            self.send_packet(Kind.hello)
+            packet = self.recv_packet(self.rto)
+            if packet is not None and packet[0] == Kind.status:
+                self.handle_status(packet[1], packet[2])
+                return
+        raise TimeoutError(f'Receiver did not answer hello for {self.timeout}s')
+
+
+class UdpReceiver(UdpEndpoint):
+    def __init__(self, sock: socket.socket, transfer_id: int, size: int, chunk: int,
+                 peer: tuple | None = None, window: int = 256, timeout: float = 30,
+                 status_every: int = 16, status_interval: float = 0.05, linger: float = 1.0, codec=None):
+        super().__init__(sock, transfer_id, size, chunk, peer, window, timeout, codec)
+        self.received = bytearray(self.total)
+        self.received_count = 0
+        self.base = 0
+        self.status_every = status_every
+        self.status_interval = status_interval
+        self.linger = linger
+
+    def send_status(self):
+        count = min(self.window, self.total - self.base)
+        bitmap = bytearray(math.ceil(count / 8))
+        for i in range(count):
+            if self.received[self.base + i]:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        self.send_packet(Kind.status, self.base, bitmap)
+
+    def receive(self, file, on_progress=None):
+        if self.total == 0:
+            return
+        # Chunks land at their own offsets, file gets its final size up front
+        file.truncate(self.size)
+        if self.peer is None:
+            self.wait_hello()
+            self.send_status()
+        else:
+            self.send_packet(Kind.hello)
+        highest = -1
+        since_status = 0
+        last_data = time.monotonic()
+        while self.received_count < self.total:
+            packet = self.recv_packet(self.status_interval)
+            if packet is None:
+                if time.monotonic() - last_data > self.timeout:
+                    raise TimeoutError(f'No data for {self.timeout}s, got {self.received_count} of {self.total} chunks')
+                # Hello of client side receiver may be lost, sender waits for it before first chunk
+                if highest < 0:
+                    self.send_packet(Kind.hello)
+                self.send_status()
+                since_status = 0
+                continue
+            kind, seq, payload = packet
+            if kind == Kind.hello:
+                # Sender didn't get status for its hello
+                self.send_status()
+                continue
+            if kind == Kind.packed and self.codec is not None and seq < self.total:
+                try:
+                    payload = self.codec.decompress_chunk(payload, self.chunk_size(seq))
+                except SocketException:
+                    continue
+                kind = Kind.data
+            if kind != Kind.data or seq >= self.total or len(payload) != self.chunk_size(seq):
+                continue
+            last_data = time.monotonic()
+            since_status += 1
+            if not self.received[seq]:
+                file.seek(seq * self.chunk)
+                file.write(payload)
+                self.received[seq] = 1
+                self.received_count += 1
+                if on_progress is not None:
+                    on_progress()
+                while self.base < self.total and self.received[self.base]:
+                    self.base += 1
+            new_gap = seq > highest + 1
+            highest = max(highest, seq)
+            if new_gap or since_status >= self.status_every:
+                self.send_status()
+                since_status = 0
+        self.send_status()
+        deadline = time.monotonic() + self.linger
+        while time.monotonic() < deadline:
+            packet = self.recv_packet(deadline - time.monotonic())
+            if packet is None or packet[0] == Kind.fin:
+                return
+            if packet[0] == Kind.data:
+                self.send_status()
@@ -0,0 +1,123 @@
+import os
+
+from .archive import PART_SUFFIX
+
+"""
+# Upload sink #
+SERVER_UPLOAD_PREALLOCATE   true - disk space of whole file is reserved up front with posix_fallocate
+SERVER_WRITE_COALESCE       bytes of received data gathered in memory before they go to disk in one write,
+                            writes end on multiples of it in file, 0 - every chunk is written as it comes
+SERVER_UPLOAD_FSYNC         none - kernel writes data back when it likes, close - fsync before file replaces
+                            the old one, ack - also fsync before every ack, so acked bytes survive power loss
+Upload goes to `<path>.part` and replaces path only when all of it came, so nobody sees half of a file
+and broken upload leaves old file as it was.
+Part stays for restore: buffered data is written before every ack, so whatever was acked is in part file,
+and restore truncates part to acked offset from journal and goes on from there. Without acks length of part
+is the only record of what came, so such uploads aren't preallocated.
+"""
+
+FSYNC_POLICIES = ('none', 'close', 'ack')
+
+
+class UploadSink:
+    """File opened for writing as far as receivers go (write, flush, seek, tell, truncate, close, `with`)"""
+
+    def __init__(self, path: str, size: int, offset: int = 0, preallocate: bool = False, coalesce: int = 0,
+                 fsync: str = 'none'):
+        self.path = path
+        self.name = path
+        self.part_path = path + PART_SUFFIX
+        self.coalesce = coalesce
+        self.fsync = fsync
+        # Buffer is our own, so part is opened unbuffered
+        self.file = open(self.part_path, 'r+b' if offset else 'wb', buffering=0)
+        self.file.seek(offset)
+        # File offset where buffered data goes
+        self.start = offset
+        self.buffer = bytearray()
+        self.committed = False
+        if preallocate and size > offset and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), offset, size - offset)
+            except OSError:
+                # Filesystem can't do it, space is taken as data comes
+                pass
+
+    def write(self, data: bytes | memoryview) -> int:
+        self.buffer += data
+        if not self.coalesce:
+            self.write_out(len(self.buffer))
+        elif len(self.buffer) >= self.coalesce:
+            # Tail past last multiple of `coalesce` waits for more data
+            end = (self.start + len(self.buffer)) // self.coalesce * self.coalesce
+            self.write_out(end - self.start)
+        return len(data)
+
+    def write_out(self, size: int):
+        with memoryview(self.buffer) as view:
+            written = 0
+            while written < size:
+                written += self.file.write(view[written:size])
+        del self.buffer[:size]
+        self.start += size
+
+    # Called before ack: everything acked must be in part file, committed file already has it all
+    def flush(self):
+        if self.file.closed:
+            return
+        self.write_out(len(self.buffer))
+        if self.fsync == 'ack':
+            os.fsync(self.file.fileno())
+
+    # UDP chunks land at their own offsets, buffer only gathers ones which go one after another
+    def seek(self, offset: int) -> int:
+        if offset != self.tell():
+            self.write_out(len(self.buffer))
+            self.file.seek(offset)
+            self.start = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.start + len(self.buffer)
+
+    def truncate(self, size: int) -> int:
+        self.write_out(len(self.buffer))
+        return self.file.truncate(size)
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    # Part replaces old file, upload is done
+    def commit(self):
+        self.write_out(len(self.buffer))
+        if self.fsync != 'none':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.part_path, self.path)
+        if self.fsync != 'none':
+            # Rename is durable only once directory is synced
+            directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self.committed = True
+
+    # Part of upload which can't be restored is of no use
+    def discard(self):
+        self.close()
+        if not self.committed and os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def close(self):
+        if not self.file.closed:
+            try:
+                self.write_out(len(self.buffer))
+            finally:
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
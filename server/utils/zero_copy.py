@@ -0,0 +1,55 @@
+import asyncio
+import math
+import socket
+
+from .flow_control import SlidingWindow
+
+
+class ZeroCopySender:
+    """
+    Streams file ranges straight from the page cache with socket.sendfile (os.sendfile under the hood).
+    Range is cut into packet aligned segments which fit into agreed window,
+    so acks keep flowing and progress bar is updated once per segment instead of once per packet.
+    """
+
+    def __init__(self, sock: socket.socket | asyncio.Transport, packet_size: int, window: SlidingWindow,
+                 segment_size: int = 1024 * 1024):
+        self.sock = sock
+        self.packet_size = packet_size
+        self.window = window
+        if window.window:
+            # Receiver acks at least every half of window, bigger segment could wait for ack forever
+            segment_size = min(segment_size, window.window // 2)
+        self.segment_size = max(1, segment_size // packet_size) * packet_size
+
+    def segments(self, offset: int, count: int):
+        end = offset + count
+        while offset < end:
+            seg_len = min(self.segment_size, end - offset)
+            yield offset, seg_len
+            offset += seg_len
+
+    def send(self, file, offset: int, count: int, on_progress=None):
+        for seg_offset, seg_len in self.segments(offset, count):
+            self.window.wait_open(seg_len)
+            sent = self.sock.sendfile(file, seg_offset, seg_len)
+            if sent != seg_len:
+                raise ConnectionError(f'sendfile sent {sent} of {seg_len} bytes')
+            self.window.sent_bytes(seg_len)
+            if on_progress is not None:
+                on_progress(math.ceil(seg_len / self.packet_size))
+
+    # Same for asyncio engine: sock is a transport and window is AsyncSlidingWindow,
+    # on_sent(bytes) counts what went past session's socket facade
+    async def send_async(self, file, offset: int, count: int, on_progress=None, on_sent=None):
+        loop = asyncio.get_running_loop()
+        for seg_offset, seg_len in self.segments(offset, count):
+            await self.window.wait_open(seg_len)
+            sent = await loop.sendfile(self.sock, file, seg_offset, seg_len)
+            if sent != seg_len:
+                raise ConnectionError(f'sendfile sent {sent} of {seg_len} bytes')
+            self.window.sent_bytes(seg_len)
+            if on_progress is not None:
+                on_progress(math.ceil(seg_len / self.packet_size))
+            if on_sent is not None:
+                on_sent(seg_len)